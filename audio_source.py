@@ -0,0 +1,223 @@
+"""Audio-reactive user colors, from a WAV file or raw PCM on stdin.
+
+Reads fixed blocks of samples and runs NumPy FFTs over overlapping Hann
+windows, all of a block's windows in one batched call. It sums the power
+into one log-spaced band per user color, bass first. Each band's level
+follows its energy relative to a slowly decaying peak, and sets the
+brightness of that slot's hue. Colors go to the controller's sinks like
+MQTT colors, so WLED segment i follows user color i.
+
+    $ python3 spdsxpro_controller.py --audio song.wav
+    $ arecord -f S16_LE -r 48000 -c 2 -t raw | \\
+        python3 spdsxpro_controller.py --audio - --audio-rate 48000 --audio-channels 2
+
+Raw PCM is 16-bit little-endian; WAV files may be 8, 16 or 32-bit.
+
+A block is analyzed as soon as it's read, so colors lag the audio by less
+than one block (--audio-block samples). Files are played in real time.
+"""
+
+import sys
+import threading
+import time
+import wave
+
+import numpy
+
+import color_pipeline
+
+# Bass to treble
+DEFAULT_HUES = (0, 30, 60, 180, 270)
+
+_DTYPES = {1: numpy.uint8, 2: numpy.dtype('<i2'), 4: numpy.dtype('<i4')}
+
+
+class BandAnalyzer:
+    """ Block of samples in, one level in 0..1 per band out """
+
+    def __init__(self, rate: int, bands: int = 5, fft_size: int = 2048, hop: int = 512,
+                 fmin: float = 40, fmax: float = 12000, release: float = 0.15,
+                 peak_release: float = 5.0):
+        self.rate = rate
+        self.fft_size = fft_size
+        self.hop = hop
+        self.window = numpy.hanning(fft_size).astype(numpy.float32)
+        # Band edges as FFT bins, log spaced, at least one bin per band
+        edges = numpy.geomspace(fmin, min(fmax, rate / 2), bands + 1) * fft_size / rate
+        edges = numpy.maximum(edges.astype(numpy.int64), numpy.arange(bands + 1) + 1)
+        self.edges = edges[:-1]
+        self.end = edges[-1]
+        self.history = numpy.zeros(fft_size - hop, dtype=numpy.float32)
+        self.release = release
+        self.peak_release = peak_release
+        self.levels = numpy.zeros(bands, dtype=numpy.float32)
+        self.peaks = numpy.full(bands, 1e-9, dtype=numpy.float32)
+
+    def process(self, samples) -> numpy.ndarray:
+        """ samples: mono float32 in -1..1. Returns the band levels. """
+        x = numpy.concatenate((self.history, samples))
+        count = (len(x) - self.fft_size) // self.hop + 1
+        if count <= 0:
+            self.history = x[-(self.fft_size - self.hop):]
+            return self.levels
+        frames = numpy.lib.stride_tricks.sliding_window_view(x, self.fft_size)[::self.hop][:count]
+        # Keep what the next block's first window overlaps
+        self.history = x[count * self.hop:]
+        power = numpy.abs(numpy.fft.rfft(frames * self.window, axis=1)) ** 2
+        energy = numpy.add.reduceat(power[:, :self.end], self.edges, axis=1).max(axis=0)
+        dt = len(samples) / self.rate
+        self.peaks = numpy.maximum(energy, self.peaks * numpy.exp(-dt / self.peak_release))
+        level = numpy.sqrt(energy / numpy.maximum(self.peaks, 1e-9))
+        # Rise at once, fall off over `release` seconds
+        self.levels = numpy.maximum(level, self.levels * numpy.exp(-dt / self.release))
+        return self.levels
+
+
+class AudioSource:
+    """ Reads blocks on its own thread and passes the colors that changed
+        to `emit(colors, t, due)`, as App's MQTT ingest does.
+    """
+
+    name = 'audio'
+
+    def __init__(self, path: str, emit, block: int = 1024, rate: int = 48000,
+                 channels: int = 2, width: int = 2, hues=DEFAULT_HUES, **analyzer_options):
+        self.path = path
+        self.emit = emit
+        self.block = block
+        if path == '-':
+            self.stream = sys.stdin.buffer
+            self.realtime = False  # the pipe sets the pace
+        else:
+            wav = wave.open(path, 'rb')
+            rate, channels, width = wav.getframerate(), wav.getnchannels(), wav.getsampwidth()
+            self.stream = wav
+            self.realtime = True
+        if width not in _DTYPES:
+            raise ValueError(f"{path}: {8 * width}-bit samples aren't supported")
+        self.rate = rate
+        self.channels = channels
+        self.width = width
+        self.hues = numpy.array(hues, dtype=numpy.float32)
+        self.hsv = numpy.zeros((len(hues), 3), dtype=numpy.float32)
+        self.hsv[:, 0] = self.hues
+        self.hsv[:, 1] = 100
+        self.analyzer = BandAnalyzer(rate, bands=len(hues), **analyzer_options)
+        self.last = None
+        self.blocks = 0
+        self.emitted = 0
+        self.busy = 0.  # seconds spent analyzing
+        self.max_busy = 0.
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="audio", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            # A read from a stalled pipe can't be interrupted; don't wait on it.
+            self.thread.join(timeout=1.0)
+
+    def _read(self) -> bytes:
+        n = self.block * self.channels * self.width
+        if isinstance(self.stream, wave.Wave_read):
+            return self.stream.readframes(self.block)
+        data = self.stream.read(n)
+        while data and len(data) < n:
+            more = self.stream.read(n - len(data))
+            if not more:
+                break
+            data += more
+        return data
+
+    def _samples(self, data: bytes):
+        frame = self.channels * self.width
+        x = numpy.frombuffer(data, dtype=_DTYPES[self.width], count=len(data) // frame * self.channels)
+        x = x.reshape(-1, self.channels).mean(axis=1, dtype=numpy.float32)
+        if self.width == 1:
+            return (x - 128) / 128
+        return x / float(1 << (8 * self.width - 1))
+
+    def colors(self, data: bytes) -> dict:
+        """ Analyze one block. Returns the user colors that changed. """
+        self.hsv[:, 2] = self.analyzer.process(self._samples(data)) * 100
+        rgb = color_pipeline.to_rgb(self.hsv, 'hsv')
+        changed = range(len(rgb)) if self.last is None else numpy.flatnonzero((rgb != self.last).any(axis=1))
+        self.last = rgb
+        return {int(i): tuple(rgb[i].tolist()) for i in changed}
+
+    def _run(self):
+        t_next = time.perf_counter()
+        while self.running:
+            if self.realtime:
+                delay = t_next - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                t_next += self.block / self.rate
+            data = self._read()
+            if not data:
+                print(f"audio: end of {self.path}")
+                break
+            t = time.perf_counter()
+            colors = self.colors(data)
+            busy = time.perf_counter() - t
+            self.blocks += 1
+            self.busy += busy
+            self.max_busy = max(self.max_busy, busy)
+            if colors:
+                self.emitted += 1
+                self.emit(colors, t, None)
+
+    def summary(self) -> str:
+        audio_s = self.blocks * self.block / self.rate
+        share = self.busy / audio_s if audio_s else 0
+        per_block = 1e3 * self.busy / self.blocks if self.blocks else 0
+        return (f"blocks={self.blocks} emitted={self.emitted} analysis_ms(mean={per_block:.3f} "
+                f"max={1e3 * self.max_busy:.3f}) cpu={100 * share:.1f}%")
+
+
+def _self_test():
+    import os
+    import tempfile
+
+    rate = 48000
+    t = numpy.arange(rate * 2) / rate
+    path = os.path.join(tempfile.mkdtemp(), 'tone.wav')
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        for f in (60, 5000):  # one second of bass, then one of treble
+            tone = (numpy.sin(2 * numpy.pi * f * t[:rate]) * 16000).astype('<i2')
+            wav.writeframes(numpy.repeat(tone, 2).tobytes())
+
+    got = []
+    source = AudioSource(path, None)
+    levels = []
+    while data := source._read():
+        got.append(source.colors(data))
+        levels.append(source.analyzer.levels.copy())
+    bass = levels[rate // source.block - 2]
+    treble = levels[-1]
+    assert bass.argmax() == 0 and bass[0] > 0.9 and bass[1:].max() < 0.5, bass
+    assert treble.argmax() == 4 and treble[4] > 0.9, treble
+    assert got[0] and all(isinstance(i, int) for c in got for i in c)
+
+    # Cost: ten minutes of stereo audio, analysis only
+    source = AudioSource(path, None)
+    noise = (numpy.random.default_rng(1).standard_normal(source.block * 2) * 8000).astype('<i2').tobytes()
+    n = 600 * rate // source.block
+    t0 = time.perf_counter()
+    for _ in range(n):
+        source.colors(noise)
+    dt = time.perf_counter() - t0
+    print(f"audio_source: ok; {1e3 * dt / n:.3f} ms per {source.block}-sample block, "
+          f"{100 * dt / 600:.2f}% of one core in real time")
+
+
+if __name__ == '__main__':
+    _self_test()
@@ -8,37 +8,196 @@ This one uses websockets
 
 import asyncio
 import click
-import rtmidi
+import collections
+import json
 import time
 import websockets
 
+
+def _segments(segs: list) -> dict:
+    """ id => segment. WLED gives an entry without "id" the id of its position. """
+    return {seg.get('id', i): seg for i, seg in enumerate(segs) if isinstance(seg, dict)}
+
+
+def merge_state(into: dict, delta: dict):
+    """ Fold a WLED JSON state delta into `into`. Later values win.
+        Nested objects are merged, and so are "seg" entries with the same id;
+        other lists are replaced whole.
+    """
+    for k, v in delta.items():
+        if isinstance(v, dict) and isinstance(into.get(k), dict):
+            merge_state(into[k], v)
+        elif isinstance(v, dict):
+            into[k] = merge_state({}, v)
+        elif k == 'seg' and isinstance(v, list):
+            segs = _segments(into[k]) if isinstance(into.get(k), list) else {}
+            for i, seg in _segments(v).items():
+                merge_state(segs.setdefault(i, {}), seg)
+            into[k] = [dict(seg, id=i) for i, seg in segs.items()]
+        else:
+            into[k] = v
+    return into
+
+
+def reflects(state: dict, delta: dict) -> bool:
+    """ Whether a reported WLED state shows every value `delta` sets.
+        Keys the state doesn't report (e.g. "tt", "v") are ignored.
+    """
+    for k, v in delta.items():
+        if k == 'bri' and v == 0:
+            # WLED turns off and keeps reporting the last brightness
+            if state.get('on') is not False:
+                return False
+        elif k not in state:
+            continue
+        elif isinstance(v, dict) and isinstance(state[k], dict):
+            if not reflects(state[k], v):
+                return False
+        elif k == 'seg' and isinstance(v, list) and isinstance(state[k], list):
+            have = _segments(state[k])
+            for i, seg in _segments(v).items():
+                if i not in have or not reflects(have[i], seg):
+                    return False
+        elif isinstance(v, dict) or state[k] != v:
+            return False
+    return True
+
+
 class WledConnection:
+    """ One persistent /ws connection to a WLED node.
+
+        `send` never blocks. Updates queue up while a command is in flight
+        and go out together as one merged delta once WLED answers. WLED
+        answers a command with {"success": true}, or with the full state
+        it broadcasts to every client when something changed. Broadcasts
+        also come for changes made elsewhere, so a state only counts as
+        the reply if it shows what the command in flight set. Each reply
+        gives a round-trip time.
+    """
+
+    # Give up waiting for a reply after this long and send anyway.
+    _REPLY_TIMEOUT = 1.0
+    # Reconnect backoff, doubled per consecutive failure.
+    _BACKOFF_MIN = 0.25
+    _BACKOFF_MAX = 8.0
+
     def __init__(self, uri : str):
         self.t0 = time.time()
         self.uri = uri
         self.bg_tasks = set()
         self.workload = asyncio.Queue()
+        self.connection = None
+        self.connected = asyncio.Event()
+        self.replied = asyncio.Event()
+        self.state = None  # last full state reported by WLED
+        self.pending = None  # delta in flight, until WLED answers it
+        self.sent_at = 0.
+        self.rtts = collections.deque(maxlen=256)
+        self.sent = 0
+        self.merged = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.broadcasts = 0  # states that didn't answer our command
 
     def now(self):
-        return time.time() - t0
+        return time.time() - self.t0
 
-    async def worker(self):
+    def send(self, delta: dict):
+        """ Queue a JSON state delta, e.g. {"on": True, "bri": 128} """
+        self.workload.put_nowait(delta)
+
+    def stats(self) -> dict:
+        rtts = sorted(self.rtts)
+        out = {'sent': self.sent, 'merged': self.merged,
+               'timeouts': self.timeouts, 'reconnects': self.reconnects,
+               'broadcasts': self.broadcasts}
+        if rtts:
+            out['rtt_ms'] = {
+                'min': 1e3 * rtts[0],
+                'p50': 1e3 * rtts[len(rtts) // 2],
+                'p95': 1e3 * rtts[int(len(rtts) * .95)],
+                'max': 1e3 * rtts[-1],
+            }
+        return out
+
+    def _take(self, delta: dict) -> dict:
+        """ Merge everything queued so far onto `delta` """
         while True:
-            print(f'worker awaiting a task')
-            task = await self.workload.get()
-            print(f'worker got a task')
+            try:
+                more = self.workload.get_nowait()
+            except asyncio.QueueEmpty:
+                return delta
+            merge_state(delta, more)
             self.workload.task_done()
-            print(f'worker finished a task')
-        
+            self.merged += 1
+
+    async def worker(self):
+        delta = {}
+        while True:
+            if not delta:
+                delta = merge_state({}, await self.workload.get())
+                self.workload.task_done()
+            await self.connected.wait()
+            delta = self._take(delta)
+
+            self.replied.clear()
+            self.pending = delta
+            self.sent_at = time.perf_counter()
+            try:
+                await self.connection.send(json.dumps(delta))
+            except websockets.ConnectionClosed:
+                self.pending = None
+                self.connected.clear()
+                continue  # keep delta; resend after reconnect
+            delta = {}
+            self.sent += 1
+
+            try:
+                await asyncio.wait_for(self.replied.wait(), self._REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+            self.pending = None
 
     async def connect(self):
-        print(f"connect('{self.uri}')")
-        async for connection in websockets.connect(self.uri):
-            print(f"connected {self.uri}")
-            while True:
-                message = await connection.recv()
-                print(f'message: {message}')
-        print(f"return from connect")
+        backoff = self._BACKOFF_MIN
+        while True:
+            print(f"connect('{self.uri}')")
+            try:
+                async with websockets.connect(self.uri) as connection:
+                    print(f"connected {self.uri}")
+                    backoff = self._BACKOFF_MIN
+                    self.connection = connection
+                    self.connected.set()
+                    async for message in connection:
+                        self._on_message(message)
+            except (OSError, websockets.WebSocketException) as ex:
+                print(f"connection error: {ex!r}")
+            finally:
+                self.connected.clear()
+                self.connection = None
+                self.replied.set()  # release a worker waiting on a reply
+            self.reconnects += 1
+            print(f"reconnecting in {backoff:.2f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self._BACKOFF_MAX)
+
+    def _on_message(self, message):
+        try:
+            doc = json.loads(message)
+        except json.JSONDecodeError:
+            return
+        if not isinstance(doc, dict):
+            return
+        if 'state' in doc:
+            self.state = doc['state']
+            if self.pending is None or not reflects(self.state, self.pending):
+                self.broadcasts += 1
+                return
+        elif not doc.get('success') or self.pending is None:
+            return
+        self.rtts.append(time.perf_counter() - self.sent_at)
+        self.pending = None
+        self.replied.set()
 
     async def run(self):
         self.bg_tasks.add(asyncio.create_task(self.connect()))
@@ -46,15 +205,33 @@ class WledConnection:
         await asyncio.gather(*self.bg_tasks, return_exceptions=True)
         await self.workload.join()
 
-async def async_main() -> None:
-    wled = WledConnection('ws://wled-1.local/ws')
-    await wled.run()
-    print(f"Awaiting asyncio.Future")
-    await asyncio.Future()  # run forever
+async def async_main(host: str, rate: float) -> None:
+    wled = WledConnection(f'ws://{host}/ws')
+    # The loop only keeps a weak reference to tasks
+    runner = asyncio.create_task(wled.run())
+
+    wled.send({'on': True})
+    period = 1. / rate
+    t_next = time.perf_counter()
+    t_report = t_next + 1
+    while True:
+        # Ramp brightness up and down
+        for br in list(range(0, 255, 8)) + list(range(255, 0, -8)):
+            wled.send({'bri': br})
+            t_next += period
+            await asyncio.sleep(max(0, t_next - time.perf_counter()))
+            if runner.done():
+                runner.result()  # re-raises whatever ended it
+                raise RuntimeError("connection task ended")
+            if time.perf_counter() >= t_report:
+                t_report += 1
+                print(f't={wled.now():9.3f}: {json.dumps(wled.stats())}')
 
 @click.command
-def main() -> None:
-    asyncio.run(async_main())
+@click.option('--host', default='wled-1.local', help='WLED host')
+@click.option('--rate', default=30., help='brightness steps per second')
+def main(host: str, rate: float) -> None:
+    asyncio.run(async_main(host, rate))
 
 if __name__ == "__main__":
     main()
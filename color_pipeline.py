@@ -0,0 +1,147 @@
+"""Color conversion and correction between ingest and the output sinks.
+
+Input: an MQTT doc may give its colors in HSV or HSL instead of RGB,
+    {"space": "hsv", "colors": [[h, s, v], ...]}
+with h in degrees and s, v (or l) in percent. All of a doc's colors, or
+all of a "frames" doc's frames, are converted in one NumPy call against
+a precomputed hue table.
+
+Output: each sink can have its own gamma and white point (the pad LEDs and
+a WLED strip don't agree on either). These become a 3 x 256 lookup table
+when the sink is set up, so correcting a batch is one table lookup per
+channel:
+
+    $ python3 spdsxpro_controller.py --correct spdsxpro=2.2:ffd0b0 --correct wled=1.8
+"""
+
+import numpy
+
+HUE_STEPS = 3600  # 0.1 degree
+
+
+def hue_table(n: int = HUE_STEPS):
+    """ (n, 3) float32 RGB in 0..1 of the pure hues, 0 to 360 degrees
+        exclusive: HSL with s=100%, l=50%, or HSV with s=v=100%.
+    """
+    hue = numpy.arange(n, dtype=numpy.float32) * (6.0 / n)
+    k = (numpy.array([5.0, 3.0, 1.0], dtype=numpy.float32) + hue[:, None]) % 6.0
+    return 1.0 - numpy.clip(numpy.minimum(k, 4.0 - k), 0.0, 1.0)
+
+
+_HUES = hue_table()
+
+
+def to_rgb(colors, space: str):
+    """ (N, 3) uint8 RGB from N [h, s, v] or [h, s, l] triples """
+    c = numpy.asarray(colors, dtype=numpy.float32).reshape(-1, 3)
+    idx = (c[:, 0] * (HUE_STEPS / 360.)).astype(numpy.int64) % HUE_STEPS
+    pure = _HUES[idx]
+    s = numpy.clip(c[:, 1:2] / 100., 0., 1.)
+    x = numpy.clip(c[:, 2:3] / 100., 0., 1.)
+    if space == 'hsv':
+        rgb = x * (1. - s * (1. - pure))
+    elif space == 'hsl':
+        rgb = x + s * numpy.minimum(x, 1. - x) * (2. * pure - 1.)
+    else:
+        raise ValueError(f"unknown color space: {space}")
+    return (rgb * 255. + .5).astype(numpy.uint8)
+
+
+def convert_doc(doc: dict):
+    """ Rewrite an HSV/HSL doc's colors, or its frames' colors, as RGB lists """
+    space = doc.pop('space', 'rgb')
+    if space == 'rgb':
+        return
+    frames = doc['frames'] if 'frames' in doc else [doc]
+    # Every color of every frame in one batch
+    counts = [len(frame['colors']) for frame in frames]
+    values = [c for frame in frames for c in (frame['colors'].values()
+              if isinstance(frame['colors'], dict) else frame['colors'])]
+    rgb = to_rgb(values, space).tolist() if values else []
+    n = 0
+    for frame, count in zip(frames, counts):
+        colors = frame['colors']
+        if isinstance(colors, dict):
+            frame['colors'] = dict(zip(colors, rgb[n:n + count]))
+        else:
+            frame['colors'] = rgb[n:n + count]
+        n += count
+
+
+class Correction:
+    """ Gamma and white point for one sink, as a lookup table """
+
+    def __init__(self, gamma: float = 1.0, white: tuple = (255, 255, 255)):
+        self.gamma = gamma
+        self.white = tuple(white)
+        v = numpy.arange(256, dtype=numpy.float64) / 255.
+        scale = numpy.array(white, dtype=numpy.float64)[:, None]
+        self.lut = (v[None, :] ** gamma * scale + .5).astype(numpy.uint8)  # [channel, value]
+        self._channels = numpy.arange(3)
+
+    @classmethod
+    def parse(cls, spec: str):
+        """ "GAMMA[:RRGGBB]", e.g. "2.2" or "2.2:ffd0b0" """
+        gamma, _, white = spec.partition(':')
+        return cls(float(gamma), tuple(bytes.fromhex(white)) if white else (255, 255, 255))
+
+    def apply_array(self, rgb):
+        """ (N, 3) uint8 in, corrected (N, 3) uint8 out """
+        return self.lut[self._channels, rgb]
+
+    def apply(self, colors: dict) -> dict:
+        """ user color index => rgb, corrected. Values outside 0..255 are clipped. """
+        if not colors:
+            return colors
+        rgb = numpy.clip(numpy.array(list(colors.values()), dtype=numpy.int64).reshape(-1, 3), 0, 255)
+        rgb = self.apply_array(rgb)
+        return dict(zip(colors, map(tuple, rgb.tolist())))
+
+    def __str__(self):
+        return f"gamma={self.gamma:g} white={bytes(self.white).hex()}"
+
+
+def _self_test():
+    import colorsys
+    import random
+    import time
+
+    rng = random.Random(1)
+    hsv = [[rng.uniform(0, 360), rng.uniform(0, 100), rng.uniform(0, 100)] for _ in range(1000)]
+    for space, ref in (('hsv', colorsys.hsv_to_rgb), ('hsl', None)):
+        out = to_rgb(hsv, space)
+        for (h, s, x), got in zip(hsv, out):
+            if ref:
+                want = ref(h / 360, s / 100, x / 100)
+            else:
+                want = colorsys.hls_to_rgb(h / 360, x / 100, s / 100)
+            # The hue table is quantized to 0.1 degree
+            assert all(abs(int(g) - w * 255) <= 1.5 for g, w in zip(got, want)), (space, h, s, x, got, want)
+
+    doc = {'space': 'hsl', 't0': 0, 'frames': [{'t': 0, 'colors': [[0, 100, 50]]},
+                                                {'t': 1, 'colors': [[120, 100, 50], [240, 100, 25]]}]}
+    convert_doc(doc)
+    assert doc['frames'][1]['colors'] == [[0, 255, 0], [0, 0, 128]], doc
+    assert 'space' not in doc
+
+    identity = Correction()
+    assert identity.apply({0: (1, 2, 3), 4: (255, 128, 0)}) == {0: (1, 2, 3), 4: (255, 128, 0)}
+    warm = Correction.parse('2.2:ff8000')
+    assert warm.apply({1: (255, 255, 255)}) == {1: (255, 128, 0)}
+    assert warm.apply({1: (128, 128, 128)})[1][0] == round(255 * (128 / 255) ** 2.2)
+    assert warm.apply({0: (300, -5, 0)}) == {0: (255, 0, 0)}
+
+    batch = numpy.random.default_rng(1).integers(0, 256, (100000, 3), dtype=numpy.uint8)
+    t0 = time.perf_counter()
+    warm.apply_array(batch)
+    dt = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(1000):
+        warm.apply({0: (1, 2, 3), 1: (4, 5, 6), 2: (7, 8, 9), 3: (1, 1, 1), 4: (2, 2, 2)})
+    dt_apply = (time.perf_counter() - t0) / 1000
+    print(f"color_pipeline: ok; 100k colors in {1e3 * dt:.2f} ms, "
+          f"5 user colors in {1e6 * dt_apply:.1f} us")
+
+
+if __name__ == '__main__':
+    _self_test()
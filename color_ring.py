@@ -0,0 +1,218 @@
+"""Fixed-record ring buffer of user color updates in shared memory.
+
+Connects the ingest process to the output process in the controller's
+--split mode. One producer, one consumer, and the producer never waits:
+if the consumer falls more than `capacity` records behind, the oldest
+records are overwritten and the consumer skips to the newest ones.
+
+Records carry only some slots, so a skipped record may hold the last
+update to a slot. The producer therefore also keeps each slot's latest
+update in a per-slot area, guarded by a seqlock. When records were
+skipped, read() returns, after the records it did read, the latest
+update of every slot whose last update was skipped. The sinks are latest
+wins per slot, so only updates that a newer one would have replaced are
+lost. A skipped timed frame keeps its due time and may simply be late.
+
+Each record carries a stamp, its record number + 1, that the producer
+writes after the payload. The consumer checks the stamp before and after
+copying the record, so one overwritten mid-read is counted as overrun
+instead of being returned torn.
+
+    ring = ColorRing.create()           # consumer side, owns the memory
+    ... pass ring.name to the producer ...
+    ring = ColorRing.attach(name)       # producer side
+    ring.put({0: (255, 0, 0)}, time.perf_counter())
+"""
+
+import struct
+from multiprocessing import shared_memory
+
+# head: records written so far
+_HEADER = struct.Struct('<Q')
+_HEADER_SIZE = 64
+# Per slot: seqlock version (odd while being written), record number + 1
+# of its latest update (0: none), due, submit time, rgb, kind
+_SLOT = struct.Struct('<QQdd3sB4x')
+_SLOTS_OFFSET = _HEADER_SIZE
+_RECORDS_OFFSET = 320
+# stamp, kind, slot mask, due, submit time, 5 x rgb
+_RECORD = struct.Struct('<QBB6xdd15sx')
+
+_KIND_COLORS = 0
+_KIND_TIMED = 1
+
+MAX_SLOTS = 5
+assert _SLOTS_OFFSET + MAX_SLOTS * _SLOT.size <= _RECORDS_OFFSET
+
+
+class ColorRing:
+    def __init__(self, shm: shared_memory.SharedMemory, capacity: int, owner: bool):
+        self.shm = shm
+        self.buf = shm.buf
+        self.capacity = capacity
+        self.owner = owner
+        self.head = 0  # producer: records written
+        self.tail = 0  # consumer: next record to read
+        self.overruns = 0
+        self.folded = 0  # records read() made up from the per-slot area
+
+    @staticmethod
+    def size(capacity: int) -> int:
+        return _RECORDS_OFFSET + capacity * _RECORD.size
+
+    @classmethod
+    def create(cls, capacity: int = 256):
+        shm = shared_memory.SharedMemory(create=True, size=cls.size(capacity))
+        shm.buf[:_RECORDS_OFFSET] = bytes(_RECORDS_OFFSET)
+        return cls(shm, capacity, owner=True)
+
+    @classmethod
+    def attach(cls, name: str, capacity: int = 256):
+        return cls(shared_memory.SharedMemory(name), capacity, owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def written(self) -> int:
+        return _HEADER.unpack_from(self.buf, 0)[0]
+
+    def put(self, colors, t: float, due: float = None):
+        """ colors[i] is the rgb for user color i, as a list or a dict.
+            `due` marks a jitter-buffered frame for that perf_counter time.
+            Values are clipped to 0..255. Raises TypeError or ValueError,
+            before anything is written, if a color isn't three numbers.
+        """
+        mask = 0
+        rgb = bytearray(3 * MAX_SLOTS)
+        for i, c in (colors.items() if isinstance(colors, dict) else enumerate(colors)):
+            if 0 <= i < MAX_SLOTS:
+                if len(c) != 3:
+                    raise ValueError(f"user color {i}: expected r, g, b, got {c!r}")
+                mask |= 1 << i
+                rgb[3 * i:3 * i + 3] = bytes(min(255, max(0, int(x))) for x in c)
+        n = self.head
+        offset = _RECORDS_OFFSET + (n % self.capacity) * _RECORD.size
+        kind = _KIND_COLORS if due is None else _KIND_TIMED
+        # Invalidate, fill in, then publish the stamp and the new head.
+        _RECORD.pack_into(self.buf, offset, 0, kind, mask, due or 0., t, bytes(rgb))
+        struct.pack_into('<Q', self.buf, offset, n + 1)
+        for i in range(MAX_SLOTS):
+            if mask & (1 << i):
+                slot = _SLOTS_OFFSET + i * _SLOT.size
+                version = struct.unpack_from('<Q', self.buf, slot)[0]
+                struct.pack_into('<Q', self.buf, slot, version + 1)
+                _SLOT.pack_into(self.buf, slot, version + 1, n + 1, due or 0., t,
+                                bytes(rgb[3 * i:3 * i + 3]), kind)
+                struct.pack_into('<Q', self.buf, slot, version + 2)
+        self.head = n + 1
+        _HEADER.pack_into(self.buf, 0, self.head)
+
+    def read(self) -> list:
+        """ [(colors dict, t, due or None)] written since the last read """
+        out = []
+        skipped = []  # [start, end) ranges of record numbers not read
+        head = self.written()
+        if head - self.tail > self.capacity:
+            self.overruns += head - self.capacity - self.tail
+            skipped.append((self.tail, head - self.capacity))
+            self.tail = head - self.capacity
+        while self.tail < head:
+            n = self.tail
+            self.tail += 1
+            offset = _RECORDS_OFFSET + (n % self.capacity) * _RECORD.size
+            stamp, kind, mask, due, t, rgb = _RECORD.unpack_from(self.buf, offset)
+            if stamp != n + 1 or struct.unpack_from('<Q', self.buf, offset)[0] != n + 1:
+                self.overruns += 1
+                skipped.append((n, n + 1))
+                continue
+            colors = {i: tuple(rgb[3 * i:3 * i + 3]) for i in range(MAX_SLOTS) if mask & (1 << i)}
+            out.append((colors, t, due if kind == _KIND_TIMED else None))
+        if skipped:
+            # No record read here touches these slots after their update.
+            out.extend(self._fold(skipped))
+        return out
+
+    def _read_slot(self, i: int):
+        """ (record number + 1, due, t, rgb, kind) of slot i's latest update """
+        slot = _SLOTS_OFFSET + i * _SLOT.size
+        while True:
+            version, n, due, t, rgb, kind = _SLOT.unpack_from(self.buf, slot)
+            if not version & 1 and struct.unpack_from('<Q', self.buf, slot)[0] == version:
+                return n, due, t, rgb, kind
+
+    def _fold(self, skipped: list) -> list:
+        """ The latest update of each slot whose last update was skipped.
+            Any slot updated since will be in a record still to be read.
+        """
+        updates = {}  # (t, due) => colors, so a frame's slots stay together
+        for i in range(MAX_SLOTS):
+            n, due, t, rgb, kind = self._read_slot(i)
+            if n and any(start <= n - 1 < end for start, end in skipped):
+                key = (t, due if kind == _KIND_TIMED else None)
+                updates.setdefault(key, {})[i] = tuple(rgb)
+        self.folded += len(updates)
+        return [(colors, t, due) for (t, due), colors in sorted(updates.items(), key=lambda kv: kv[0][0])]
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _produce(name: str, count: int):
+    import time
+    ring = ColorRing.attach(name, 64)
+    for n in range(count):
+        ring.put([((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff)], time.perf_counter(),
+                 due=n if n % 2 else None)
+    ring.close()
+
+
+def _self_test():
+    import multiprocessing
+
+    # A skipped record that was the only update to its slot still arrives.
+    ring = ColorRing.create(4)
+    ring.put({0: (1, 2, 3)}, 1.)
+    for n in range(10):
+        ring.put({1: (0, 0, n)}, 2. + n, due=5. if n == 3 else None)
+    ring.put({2: (9, 9, 9)}, 20., due=30.)
+    got = ring.read()
+    assert got[-1] == ({0: (1, 2, 3)}, 1., None), got
+    assert [c for c, _, _ in got[:-1]] == [{1: (0, 0, n)} for n in (7, 8, 9)] + [{2: (9, 9, 9)}], got
+    assert got[-2][2] == 30. and ring.overruns == 8 and ring.folded == 1
+
+    # Out-of-range values clip; a malformed color raises and writes nothing.
+    ring.put({3: (300, -5, 128.9)}, 40.)
+    for bad in ([5], {0: (1, 2)}, {'0': (1, 2, 3)}, [('a', 0, 0)]):
+        try:
+            ring.put(bad, 41.)
+        except (TypeError, ValueError):
+            continue
+        raise AssertionError(bad)
+    assert ring.read() == [({3: (255, 0, 128)}, 40., None)]
+    ring.close()
+
+    ring = ColorRing.create(64)
+    count = 100000
+    p = multiprocessing.Process(target=_produce, args=(ring.name, count))
+    p.start()
+    got = []
+    while p.is_alive() or ring.tail < ring.written():
+        got.extend(ring.read())
+    p.join()
+    # In order, never torn, and the last update always gets through
+    values = [(c[0][0] << 16) | (c[0][1] << 8) | c[0][2] for c, _, _ in got]
+    assert values == sorted(set(values))
+    assert values[-1] == count - 1
+    for n, (_, _, due) in zip(values, got):
+        assert due == (n if n % 2 else None)
+    assert len(got) - ring.folded + ring.overruns == count, (len(got), ring.folded, ring.overruns)
+    ring.close()
+    print(f"color_ring: {len(got)} read ({ring.folded} folded), {ring.overruns} overrun of {count} ok")
+
+
+if __name__ == '__main__':
+    _self_test()
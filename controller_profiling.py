@@ -0,0 +1,272 @@
+"""Profiling hooks for the long-running controller.
+
+    SIGUSR1: start the sampling profiler, or stop it and write the stacks
+    SIGUSR2: take a tracemalloc snapshot and write the diff against the
+             previous one (the first signal starts tracing)
+
+Sampled stacks are written in the "folded" format understood by
+flamegraph.pl and speedscope:
+    $ flamegraph.pl profile-1234-1700000000.folded > profile.svg
+
+Example, from another shell:
+    $ kill -USR1 $(pgrep -f spdsxpro_controller)   # start
+    $ kill -USR1 $(pgrep -f spdsxpro_controller)   # stop and write
+"""
+
+import collections
+import fnmatch
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+# Allocation diffs are reported per path: the entry point nearest the root
+# of the allocating traceback, as (filename pattern, function) or, with no
+# function, any frame in a matching file. queue.SimpleQueue is C, so what
+# it holds shows up under whoever put it there.
+_TRACE_PATHS = {
+    'mqtt': [('*/paho/*', None), ('*spdsxpro_controller.py', 'MqttListener.subscribe.on_message')],
+    'sinks': [('*spdsxpro_controller.py', 'OutputSink._run')],
+    'midi': [('*spdsxpro_controller.py', 'MidiShaper._run'),
+             ('*spdsxpro_controller.py', 'AbstractMidi._read_input')],
+    'main': [('*spdsxpro_controller.py', 'App.run')],
+}
+
+
+def _function_lines(filename: str) -> dict:
+    """ {qualified name: (first line, last line)} of every function in filename """
+    import ast
+    with open(filename) as f:
+        tree = ast.parse(f.read())
+    out = {}
+
+    def walk(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                name = prefix + child.name
+                if not isinstance(child, ast.ClassDef):
+                    out[name] = (child.lineno, child.end_lineno)
+                walk(child, name + '.')
+    walk(tree, '')
+    return out
+
+
+class _PathClassifier:
+    """ Maps tracebacks to _TRACE_PATHS names, or 'other' """
+
+    def __init__(self, paths: dict):
+        self.paths = paths
+        self.functions = {}  # filename => _function_lines, or {} if unreadable
+        self.cache = {}
+
+    def _lines(self, filename: str, function: str):
+        if filename not in self.functions:
+            try:
+                self.functions[filename] = _function_lines(filename)
+            except (OSError, SyntaxError, ValueError):
+                self.functions[filename] = {}
+        return self.functions[filename].get(function)
+
+    def _match(self, frame):
+        for path, entries in self.paths.items():
+            for pattern, function in entries:
+                if not fnmatch.fnmatch(frame.filename, pattern):
+                    continue
+                if function is None:
+                    return path
+                lines = self._lines(frame.filename, function)
+                if lines and lines[0] <= frame.lineno <= lines[1]:
+                    return path
+        return None
+
+    def classify(self, traceback) -> str:
+        path = self.cache.get(traceback)
+        if path is None:
+            # Frames run most recent first; the root is last.
+            path = next((p for p in map(self._match, reversed(traceback)) if p), 'other')
+            self.cache[traceback] = path
+        return path
+
+
+class SamplingProfiler:
+    """ Samples every thread's stack from a background thread.
+
+        Cost is one sys._current_frames() walk per interval, independent
+        of how busy the profiled threads are.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.running = False
+        self.t_start = None
+
+    def start(self):
+        self.stacks.clear()
+        self.samples = 0
+        self.running = True
+        self.t_start = time.time()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while self.running:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def write(self, path: str):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                print(f"{stack} {count}", file=f)
+
+
+class AllocationTracer:
+    def __init__(self, frames: int = 64, top: int = 15, paths: dict = None):
+        # Deep enough to reach each thread's entry point
+        self.frames = frames
+        self.top = top
+        self.classifier = _PathClassifier(paths or _TRACE_PATHS)
+        self.snapshot = None
+        self.sites = None  # {path: Counter of size by allocation site}
+
+    def _sites(self, snapshot) -> dict:
+        sites = {path: collections.Counter() for path in self.classifier.paths}
+        sites['other'] = collections.Counter()
+        for trace in snapshot.traces:
+            frame = trace.traceback[0]
+            sites[self.classifier.classify(trace.traceback)][(frame.filename, frame.lineno)] += trace.size
+        return sites
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.snapshot = tracemalloc.take_snapshot()
+        self.sites = self._sites(self.snapshot)
+
+    def diff(self) -> str:
+        """ Snapshot, and describe growth per path since the last one """
+        if self.snapshot is None:
+            self.start()
+            return "tracemalloc: started tracing"
+        snapshot = tracemalloc.take_snapshot()
+        sites = self._sites(snapshot)
+        lines = []
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"tracemalloc: current={current} peak={peak}")
+        for path, now in sites.items():
+            before = self.sites[path]
+            diffs = collections.Counter({site: now[site] - before[site] for site in now.keys() | before.keys()})
+            lines.append(f"[{path}] size_diff={sum(diffs.values()):+d}")
+            for (filename, lineno), size_diff in diffs.most_common(self.top):
+                if size_diff <= 0:
+                    break
+                lines.append(f"    {size_diff:+9d} B  {filename}:{lineno}")
+        self.snapshot = snapshot
+        self.sites = sites
+        return '\n'.join(lines)
+
+    def growth(self) -> dict:
+        """ {path: bytes} since the last snapshot, without taking a new one """
+        sites = self._sites(tracemalloc.take_snapshot())
+        return {path: sum(now.values()) - sum(self.sites[path].values()) for path, now in sites.items()}
+
+
+class Profiling:
+    """ Signal and flag driven controls. See the module docstring. """
+
+    def __init__(self, out_dir: str = '.', interval: float = 0.005):
+        self.out_dir = out_dir
+        self.profiler = SamplingProfiler(interval)
+        self.tracer = AllocationTracer()
+
+    def _path(self, kind: str, ext: str):
+        return os.path.join(self.out_dir, f"{kind}-{os.getpid()}-{int(time.time())}.{ext}")
+
+    def toggle_profiler(self):
+        if not self.profiler.running:
+            self.profiler.start()
+            print(f"profile: sampling every {1e3 * self.profiler.interval:g} ms")
+            return
+        self.profiler.stop()
+        path = self._path('profile', 'folded')
+        self.profiler.write(path)
+        print(f"profile: {self.profiler.samples} samples over "
+              f"{time.time() - self.profiler.t_start:.1f} s written to {path}")
+
+    def allocation_diff(self):
+        report = self.tracer.diff()
+        path = self._path('tracemalloc', 'txt')
+        with open(path, 'w') as f:
+            print(report, file=f)
+        print(report)
+
+    def install(self):
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda *_: self.toggle_profiler())
+            signal.signal(signal.SIGUSR2, lambda *_: self.allocation_diff())
+
+    def shutdown(self):
+        """ Flush a running profile on exit """
+        if self.profiler.running:
+            self.toggle_profiler()
+
+
+def _self_test():
+    """ Allocations on known threads land in their paths """
+    import queue
+    import types
+
+    import spdsxpro_controller
+
+    tracer = AllocationTracer()
+    tracer.start()
+    kept = []
+
+    class Sink (spdsxpro_controller.OutputSink):
+        def apply(self, colors):
+            kept.append(bytearray(1 << 20))
+
+    sink = Sink('test', 1000)
+    sink.start()
+    sink.submit({0: (1, 2, 3)})
+    time.sleep(0.05)
+    sink.stop()
+
+    # MQTT docs, decoded by the listener's on_message and left queued
+    listener = spdsxpro_controller.MqttListener('', 0, 't', queue.SimpleQueue(), verbose=False)
+    listener.client = types.SimpleNamespace(subscribe=lambda topic: None)
+    listener.subscribe()
+    payload = ('{"colors": [' + ','.join(['[1, 2, 3]'] * 2000) + ']}').encode()
+    for _ in range(10):
+        listener.client.on_message(None, listener, types.SimpleNamespace(payload=payload, topic='t'))
+
+    growth = tracer.growth()
+    assert growth['sinks'] >= 1 << 20, growth
+    assert growth['mqtt'] >= 500000, growth
+    assert growth['midi'] < 100000 and growth['main'] < 100000, growth
+    tracemalloc.stop()
+    print(f"controller_profiling: ok {growth}")
+
+
+if __name__ == '__main__':
+    _self_test()
@@ -0,0 +1,215 @@
+"""User colors from what's on screen: image files or a raw RGB video stream.
+
+Each frame is subsampled to about --frame-samples pixels, and a 5-color
+palette is fitted with k-means in NumPy. The palette starts from the
+previous frame's, so a few iterations per frame are enough and slot i
+keeps following the same region of color instead of reshuffling. A slot
+is only sent when it moved by more than --frame-threshold, so a static
+picture costs nothing after the first frame.
+
+    $ ffmpeg -re -i clip.mp4 -f rawvideo -pix_fmt rgb24 - | \\
+        python3 spdsxpro_controller.py --frames - --frame-size 1920x1080
+    $ python3 spdsxpro_controller.py --frames poster.png
+
+Raw streams are read into one preallocated buffer. Images are decoded
+with pygame, imported only for them.
+"""
+
+import sys
+import threading
+import time
+
+import numpy
+
+
+class PaletteExtractor:
+    """ Frame in, k colors out, warm-started from the last frame """
+
+    def __init__(self, k: int = 5, samples: int = 4096, iterations: int = 4):
+        self.k = k
+        self.samples = samples
+        self.iterations = iterations
+        self.centroids = None  # (k, 3) float32
+
+    def subsample(self, frame):
+        """ (H, W, 3) uint8 => (N, 3) float32, N about `samples` """
+        h, w, _ = frame.shape
+        step = max(1, int((h * w / self.samples) ** .5))
+        return frame[step // 2::step, step // 2::step].reshape(-1, 3).astype(numpy.float32)
+
+    def _seed(self, pixels):
+        # Farthest-first: each new centroid is the pixel furthest from the
+        # ones picked so far, so the first palette spans the frame.
+        picks = [int(((pixels - pixels.mean(axis=0)) ** 2).sum(axis=1).argmax())]
+        d = ((pixels - pixels[picks[0]]) ** 2).sum(axis=1)
+        for _ in range(self.k - 1):
+            picks.append(int(d.argmax()))
+            d = numpy.minimum(d, ((pixels - pixels[picks[-1]]) ** 2).sum(axis=1))
+        return pixels[picks].copy()
+
+    def fit(self, frame) -> numpy.ndarray:
+        """ (k, 3) float32 palette of frame """
+        pixels = self.subsample(frame)
+        centroids = self._seed(pixels) if self.centroids is None else self.centroids.copy()
+        sq = (pixels * pixels).sum(axis=1)[:, None]
+        for _ in range(self.iterations):
+            # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, as one matrix product
+            d = sq - 2 * pixels @ centroids.T + (centroids * centroids).sum(axis=1)
+            labels = d.argmin(axis=1)
+            counts = numpy.bincount(labels, minlength=self.k)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, labels, pixels)
+            used = counts > 0
+            # An empty cluster keeps its color until the scene brings it back.
+            centroids[used] = sums[used] / counts[used, None]
+        self.centroids = centroids
+        return centroids
+
+
+class FrameSource:
+    """ Reads frames on its own thread and passes the user colors that
+        changed to `emit(colors, t, due)`, as App's MQTT ingest does.
+    """
+
+    name = 'frames'
+
+    def __init__(self, paths: list, emit, size: tuple = None, fps: float = 30,
+                 threshold: float = 8, **extractor_options):
+        self.paths = paths
+        self.emit = emit
+        self.fps = fps
+        self.threshold = threshold
+        self.extractor = PaletteExtractor(**extractor_options)
+        self.raw = paths == ['-'] or all(p.endswith(('.rgb', '.raw')) for p in paths)
+        self.buffer = None
+        if self.raw:
+            if size is None:
+                raise ValueError("raw RGB frames need a frame size (WxH)")
+            w, h = size
+            self.buffer = bytearray(w * h * 3)
+            self.frame = numpy.frombuffer(self.buffer, dtype=numpy.uint8).reshape(h, w, 3)
+        self.sent = None  # (k, 3) float32, the palette as last sent
+        self.frames = 0
+        self.emitted = 0
+        self.busy = 0.
+        self.max_busy = 0.
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="frames", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            # A read from a stalled pipe can't be interrupted; don't wait on it.
+            self.thread.join(timeout=1.0)
+
+    def colors(self, frame) -> dict:
+        """ Analyze one (H, W, 3) frame. Returns the user colors that changed. """
+        palette = self.extractor.fit(frame)
+        if self.sent is None:
+            changed = numpy.ones(len(palette), dtype=bool)
+            self.sent = palette.copy()
+        else:
+            changed = numpy.abs(palette - self.sent).max(axis=1) > self.threshold
+            self.sent[changed] = palette[changed]
+        rgb = (self.sent + .5).astype(numpy.uint8)
+        return {int(i): tuple(rgb[i].tolist()) for i in numpy.flatnonzero(changed)}
+
+    def _read_into(self, stream) -> bool:
+        view = memoryview(self.buffer)
+        got = 0
+        while got < len(view):
+            n = stream.readinto(view[got:])
+            if not n:
+                return False
+            got += n
+        return True
+
+    def _frames(self):
+        """ Yields (H, W, 3) uint8 frames; raw frames all share one buffer """
+        if not self.raw:
+            import pygame
+            import pygame.surfarray
+            for path in self.paths:
+                yield pygame.surfarray.pixels3d(pygame.image.load(path)).transpose(1, 0, 2)
+            return
+        for path in self.paths:
+            stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+            with stream:
+                while self._read_into(stream):
+                    yield self.frame
+
+    def _run(self):
+        # A pipe sets its own pace; files play at `fps`.
+        paced = self.paths != ['-']
+        t_next = time.perf_counter()
+        for frame in self._frames():
+            if not self.running:
+                break
+            t = time.perf_counter()
+            colors = self.colors(frame)
+            busy = time.perf_counter() - t
+            self.frames += 1
+            self.busy += busy
+            self.max_busy = max(self.max_busy, busy)
+            if colors:
+                self.emitted += 1
+                self.emit(colors, t, None)
+            if paced:
+                t_next += 1. / self.fps
+                delay = t_next - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        print(f"frames: end of {', '.join(self.paths)}")
+
+    def summary(self) -> str:
+        per_frame = 1e3 * self.busy / self.frames if self.frames else 0
+        return (f"frames={self.frames} emitted={self.emitted} analysis_ms(mean={per_frame:.2f} "
+                f"max={1e3 * self.max_busy:.2f})")
+
+
+def _self_test():
+    import io
+
+    w, h = 1920, 1080
+    colors = numpy.array([[200, 30, 30], [30, 200, 30], [30, 30, 200], [220, 220, 220], [10, 10, 10]],
+                         dtype=numpy.uint8)
+    frame = numpy.empty((h, w, 3), dtype=numpy.uint8)
+    for i, c in enumerate(colors):
+        frame[:, i * w // 5:(i + 1) * w // 5] = c
+    noise = numpy.random.default_rng(1).integers(-6, 7, frame.shape)
+    frame = numpy.clip(frame + noise, 0, 255).astype(numpy.uint8)
+    shifted = numpy.clip(frame.astype(numpy.int16) + [40, 0, 0], 0, 255).astype(numpy.uint8)
+
+    got = []
+    source = FrameSource(['-'], None, size=(w, h))
+    stream = io.BytesIO(frame.tobytes() * 10 + shifted.tobytes() * 10)
+    t0 = time.perf_counter()
+    while source._read_into(stream):
+        got.append(source.colors(source.frame))
+    dt = (time.perf_counter() - t0) / len(got)
+
+    # All five found, each to within the noise
+    palette = numpy.array([got[0][i] for i in range(5)])
+    dist = numpy.abs(palette[:, None, :].astype(int) - colors[None, :, :]).max(axis=2)
+    assert (dist.min(axis=1) <= 3).all() and len(set(dist.argmin(axis=1))) == 5, palette
+    # Still frames send nothing. Adding red moves every slot, and each
+    # slot keeps following the same color.
+    assert not any(got[1:10]), got[1:10]
+    moved = {}
+    for c in got[10:]:
+        moved.update(c)
+    assert set(moved) == set(range(5)), moved
+    for i in range(5):
+        assert abs(moved[i][0] - min(255, got[0][i][0] + 40)) <= 3, (i, moved[i], got[0][i])
+        assert all(abs(a - b) <= 1 for a, b in zip(moved[i][1:], got[0][i][1:])), (i, moved[i], got[0][i])
+    print(f"frame_source: ok; {1e3 * dt:.2f} ms per 1080p frame, read included "
+          f"({1 / dt:.0f} fps on one core)")
+
+
+if __name__ == '__main__':
+    _self_test()
@@ -0,0 +1,97 @@
+"""Check that the controller starts fast.
+
+Runs `python -X importtime -c "import spdsxpro_controller"` in a fresh
+interpreter, reports the slowest imports, and fails if the total is over
+budget or if a heavy backend got imported eagerly.
+
+Then starts the controller itself, with the default pygame backend,
+against a local broker, and times it from process start until the broker
+has its MQTT subscription: how long colors published at startup wait.
+
+    $ python3 import_time_check.py --budget-ms 150 --ready-budget-ms 250
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Only imported once the corresponding feature is used.
+_LAZY_MODULES = ['pygame', 'mido', 'websockets', 'asyncio', 'numpy',
+                 'tracemalloc']
+
+
+def measure(module: str):
+    """ Returns ({module: cumulative us}, set of imported module names) """
+    code = f"import sys, {module}; print(' '.join(sys.modules))"
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative_us)
+    return times, set(proc.stdout.split())
+
+
+def measure_ready(timeout: float = 10.0) -> float:
+    """ Seconds from starting the controller to its MQTT SUBSCRIBE """
+    from local_mqtt_broker import LocalMqttBroker
+    broker = LocalMqttBroker().start()
+    topic = 'import-time-check'
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, 'spdsxpro_controller.py', '-a', broker.host, '-p', str(broker.port),
+         '-t', topic, '-q', '--calibration', ''],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        t = broker.wait_for_subscription(topic, timeout)
+    finally:
+        proc.terminate()
+        proc.wait()
+        broker.stop()
+    if t is None:
+        raise RuntimeError(f"no MQTT subscription within {timeout} s")
+    return t - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='spdsxpro_controller')
+    parser.add_argument('--budget-ms', default=150, type=float,
+                        help='max cumulative import time of --module')
+    parser.add_argument('--ready-budget-ms', default=250, type=float,
+                        help='max time from starting the controller to its MQTT subscription')
+    parser.add_argument('--top', default=10, type=int)
+    args = parser.parse_args()
+
+    times, modules = measure(args.module)
+    total_ms = times[args.module] / 1e3
+    print(f"{args.module}: {total_ms:.1f} ms (budget {args.budget_ms:g} ms)")
+    for name, us in sorted(times.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f"  {us / 1e3:8.1f} ms  {name}")
+
+    ok = True
+    eager = [m for m in _LAZY_MODULES if m in modules]
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+        ok = False
+    if total_ms > args.budget_ms:
+        print("FAIL: over budget")
+        ok = False
+
+    ready_ms = measure_ready() * 1e3
+    print(f"MQTT subscribed after {ready_ms:.1f} ms (budget {args.ready_budget_ms:g} ms)")
+    if ready_ms > args.ready_budget_ms:
+        print("FAIL: MQTT ready over budget")
+        ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""End-to-end load test for the controller, no hardware needed.
+
+Starts a local MQTT broker stand-in, runs spdsxpro_controller.App with the
+capture MIDI backend, and publishes synthetic {"colors": ...} traffic at
+it. Each message's colors encode a sequence number, so every SysEx the
+controller writes can be traced back to the publish that caused it.
+
+For each phase, reports throughput, publish-to-MIDI-write latency
+percentiles, how many messages were merged or lost, and RSS growth.
+
+    $ python3 load_test.py --rate 60 --rate 600 --rate 6000 --duration 5
+    $ python3 load_test.py --rate 100 --burst 50 --colors 5
+    $ python3 load_test.py --rate 6000 --split
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+from paho.mqtt import client as mqtt_client
+
+import spdsxpro_controller
+from local_mqtt_broker import LocalMqttBroker
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def seq_to_rgb(seq: int):
+    return [(seq >> 16) & 0xff, (seq >> 8) & 0xff, seq & 0xff]
+
+
+class Recorder:
+    """ Decodes sequence numbers out of captured user color writes """
+
+    def __init__(self, spd: spdsxpro_controller.SpdSxPro):
+        self.codec = spd.codec
+        self.slot_addrs = {addr: i for i, addr in enumerate(spd.user_color_addrs)}
+        self.lock = threading.Lock()
+        self.published = {}  # seq => perf_counter at publish
+        self.latencies = []
+        self.delivered = set()
+        self.writes = 0
+
+    def on_write(self, t: float, msg):
+        parsed = self.codec.decode(msg)
+        if parsed is None:
+            return
+        _, addr, start, _ = parsed
+        if self.slot_addrs.get(addr) != 0:
+            return  # every slot carries the same seq; count slot 0
+        d = msg[start:start + 12]
+        rgb = [(d[2] << 4) | d[3], (d[6] << 4) | d[7], (d[10] << 4) | d[11]]
+        seq = (rgb[0] << 16) | (rgb[1] << 8) | rgb[2]
+        with self.lock:
+            self.writes += 1
+            t_pub = self.published.get(seq)
+            if t_pub is not None:
+                self.delivered.add(seq)
+                self.latencies.append(t - t_pub)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def run_phase(publisher, topic: str, recorder: Recorder, app, seq0: int,
+              rate: float, burst: int, duration: float, num_colors: int):
+    recorder.published.clear()
+    recorder.latencies.clear()
+    recorder.delivered.clear()
+    received0 = app.received()
+    merged0 = app.sinks[0].stats.merged
+    rss0 = rss_bytes()
+
+    period = burst / rate
+    seq = seq0
+    t0 = time.perf_counter()
+    t_next = t0
+    while time.perf_counter() - t0 < duration:
+        for _ in range(burst):
+            rgb = seq_to_rgb(seq)
+            payload = json.dumps({'colors': [rgb] * num_colors})
+            recorder.published[seq] = time.perf_counter()
+            publisher.publish(topic, payload)
+            seq += 1
+        t_next += period
+        delay = t_next - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    t_pub_end = time.perf_counter()
+    time.sleep(0.5)  # let the pipeline drain
+
+    published = seq - seq0
+    received = app.received() - received0
+    with recorder.lock:
+        lat = sorted(recorder.latencies)
+        delivered = len(recorder.delivered)
+    elapsed = t_pub_end - t0
+    print(f"rate={rate:g}/s burst={burst} colors={num_colors} duration={elapsed:.1f}s")
+    print(f"  published={published} ({published / elapsed:.0f}/s) "
+          f"received={received} lost={published - received}")
+    print(f"  written={delivered} ({delivered / elapsed:.0f}/s) "
+          f"merged={published - delivered} sink_merged={app.sinks[0].stats.merged - merged0}")
+    print(f"  latency_ms p50={1e3 * percentile(lat, .5):.2f} p90={1e3 * percentile(lat, .9):.2f} "
+          f"p99={1e3 * percentile(lat, .99):.2f} max={1e3 * percentile(lat, 1):.2f}")
+    print(f"  rss_growth={(rss_bytes() - rss0) / 1024:.0f} KiB")
+    return seq
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, action='append',
+                        help='messages per second (repeat for several phases)')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='messages published back to back per tick')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per phase')
+    parser.add_argument('--colors', type=int, default=1, choices=range(1, 6),
+                        help='user colors per message')
+    parser.add_argument('-t', default='spdsxpro', help='MQTT topic')
+    parser.add_argument('--split', action='store_true',
+                        help="run the controller's ingest in its own process")
+    args = parser.parse_args()
+
+    broker = LocalMqttBroker().start()
+    options = spdsxpro_controller.parse_args(
+        ['-a', broker.host, '-p', str(broker.port), '-t', args.t, '-b', 'capture', '-q']
+        + (['--split'] if args.split else []))
+    app = spdsxpro_controller.App(options)
+    recorder = Recorder(app.spd)
+    app.spd.midi.on_write = recorder.on_write
+    app_thread = threading.Thread(target=app.run, name="app", daemon=True)
+    app_thread.start()
+
+    publisher = mqtt_client.Client(f'load-test-{os.getpid()}')
+    publisher.connect(broker.host, broker.port)
+    publisher.loop_start()
+    time.sleep(0.5)  # subscriptions settle
+
+    seq = 0
+    for rate in args.rate or [60]:
+        seq = run_phase(publisher, args.t, recorder, app, seq, rate,
+                        args.burst, args.duration, args.colors)
+
+    publisher.loop_stop()
+    app.stop()
+    app_thread.join()
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
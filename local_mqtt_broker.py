@@ -0,0 +1,232 @@
+"""A small in-process MQTT 3.1.1 broker, standing in for mosquitto.
+
+Enough of the protocol for our tools and benchmarks: CONNECT, SUBSCRIBE
+and UNSUBSCRIBE with + and # wildcards, PUBLISH at QoS 0 and 1 (QoS 1 is
+acknowledged, delivered at QoS 0), retained messages, PINGREQ and
+DISCONNECT. No auth, no persistence, no sessions.
+
+    broker = LocalMqttBroker().start()
+    ... connect paho to broker.port ...
+    broker.stop()
+
+Or run it standalone:
+    $ python3 local_mqtt_broker.py -p 1883
+"""
+
+import argparse
+import socket
+import socketserver
+import threading
+import time
+
+_CONNECT = 1
+_CONNACK = 2
+_PUBLISH = 3
+_PUBACK = 4
+_SUBSCRIBE = 8
+_SUBACK = 9
+_UNSUBSCRIBE = 10
+_UNSUBACK = 11
+_PINGREQ = 12
+_PINGRESP = 13
+_DISCONNECT = 14
+
+
+def _encode_length(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        out.append(b | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def _encode_str(s: bytes) -> bytes:
+    return len(s).to_bytes(2, 'big') + s
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    p = pattern.split('/')
+    t = topic.split('/')
+    for i, level in enumerate(p):
+        if level == '#':
+            return True
+        if i >= len(t) or (level != '+' and level != t[i]):
+            return False
+    return len(p) == len(t)
+
+
+def publish_packet(topic: str, payload: bytes, retain: bool = False) -> bytes:
+    body = _encode_str(topic.encode()) + payload
+    return bytes([(_PUBLISH << 4) | int(retain)]) + _encode_length(len(body)) + body
+
+
+class _Handler (socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.subscriptions = set()
+        self.send_lock = threading.Lock()
+
+    def send(self, packet: bytes):
+        with self.send_lock:
+            try:
+                self.request.sendall(packet)
+            except OSError:
+                pass
+
+    def _read_exact(self, f, n: int) -> bytes:
+        data = f.read(n)
+        if len(data) < n:
+            raise EOFError
+        return data
+
+    def handle(self):
+        broker = self.server.broker
+        f = self.request.makefile('rb')
+        try:
+            while True:
+                header = self._read_exact(f, 1)[0]
+                length = 0
+                shift = 0
+                while True:
+                    b = self._read_exact(f, 1)[0]
+                    length |= (b & 0x7f) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = self._read_exact(f, length)
+                if not self._packet(broker, header >> 4, header & 0xf, body):
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            broker._remove(self)
+
+    def _packet(self, broker, kind: int, flags: int, body: bytes) -> bool:
+        if kind == _CONNECT:
+            broker._add(self)
+            self.send(bytes([_CONNACK << 4, 2, 0, 0]))
+        elif kind == _PUBLISH:
+            n = int.from_bytes(body[0:2], 'big')
+            topic = body[2:2 + n].decode()
+            pos = 2 + n
+            qos = (flags >> 1) & 3
+            if qos:
+                self.send(bytes([_PUBACK << 4, 2]) + body[pos:pos + 2])
+                pos += 2
+            broker.publish(topic, body[pos:], retain=bool(flags & 1))
+        elif kind == _SUBSCRIBE:
+            packet_id = body[0:2]
+            pos = 2
+            granted = bytearray()
+            patterns = []
+            while pos < len(body):
+                n = int.from_bytes(body[pos:pos + 2], 'big')
+                patterns.append(body[pos + 2:pos + 2 + n].decode())
+                pos += 3 + n
+                granted.append(0)
+            self.subscriptions.update(patterns)
+            broker._subscribed(patterns)
+            self.send(bytes([(_SUBACK << 4)]) + _encode_length(2 + len(granted))
+                      + packet_id + bytes(granted))
+            for pattern in patterns:
+                for packet in broker._retained_for(pattern):
+                    self.send(packet)
+        elif kind == _UNSUBSCRIBE:
+            pos = 2
+            while pos < len(body):
+                n = int.from_bytes(body[pos:pos + 2], 'big')
+                self.subscriptions.discard(body[pos + 2:pos + 2 + n].decode())
+                pos += 2 + n
+            self.send(bytes([_UNSUBACK << 4, 2]) + body[0:2])
+        elif kind == _PINGREQ:
+            self.send(bytes([_PINGRESP << 4, 0]))
+        elif kind == _DISCONNECT:
+            return False
+        return True
+
+
+class _Server (socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LocalMqttBroker:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.server = _Server((host, port), _Handler)
+        self.server.broker = self
+        self.host, self.port = self.server.server_address
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.retained = {}  # topic => PUBLISH packet
+        self.published = 0
+        self.subscribed = threading.Condition(self.lock)
+        self.subscriptions = []  # (pattern, time.perf_counter()) of every SUBSCRIBE
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="mqtt-broker", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _add(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def _remove(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def _subscribed(self, patterns: list):
+        with self.lock:
+            now = time.perf_counter()
+            self.subscriptions.extend((p, now) for p in patterns)
+            self.subscribed.notify_all()
+
+    def wait_for_subscription(self, pattern: str, timeout: float = None):
+        """ perf_counter time of the first SUBSCRIBE to pattern, or None on timeout """
+        with self.lock:
+            self.subscribed.wait_for(lambda: any(p == pattern for p, _ in self.subscriptions), timeout)
+            return next((t for p, t in self.subscriptions if p == pattern), None)
+
+    def _retained_for(self, pattern: str):
+        with self.lock:
+            return [packet for topic, packet in self.retained.items()
+                    if topic_matches(pattern, topic)]
+
+    def publish(self, topic: str, payload: bytes, retain: bool = False):
+        packet = publish_packet(topic, payload)
+        with self.lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = publish_packet(topic, payload, retain=True)
+                else:
+                    self.retained.pop(topic, None)
+            targets = [c for c in self.clients
+                       if any(topic_matches(p, topic) for p in c.subscriptions)]
+        for client in targets:
+            client.send(packet)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('-p', default=1883, type=int, help='port')
+    args = parser.parse_args()
+    broker = LocalMqttBroker(args.a, args.p)
+    print(f"MQTT broker on {broker.host}:{broker.port}")
+    try:
+        broker.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+"""Simulated SPD-SX PRO and TD-50X, as a MIDI backend.
+
+SimMidi has the same interface as the controller's pygame backend, but
+the device lives in-process, so everything can be exercised and
+benchmarked without hardware:
+
+    $ python3 spdsxpro_controller.py -b sim
+    $ MIDI_SIM="rate=3125,buffer=256,drop=stall" python3 spdsxpro_calibrate.py -b sim
+
+The simulated device:
+  - answers Identity Requests
+  - applies DT1 writes to a model of its parameter address space
+  - answers RQ1 reads with checksummed DT1s, split like the real ones
+  - sends Program Change (and Bank Select) when its kit changes, and
+    timing clock if clock_bpm is set
+
+The link and the device's input buffer are modeled too. Messages take
+len / rate seconds on the wire. A message arriving while `buffer` bytes
+are already waiting is handled per `drop`: "newest" drops it, "oldest"
+drops the oldest waiting one, and "stall" makes the device ignore
+everything for `stall` seconds, like a link that locks up. `loss` drops
+messages at random. Replies arrive `latency` seconds after the request
+is processed.
+
+The identity codes and the parameter map are stand-ins covering only
+what this repo reads and writes; they aren't the units' real contents.
+"""
+
+import heapq
+import os
+import random
+import threading
+import time
+
+import roland_sysex
+
+
+class SimConfig:
+    def __init__(self, latency: float = 0.002, rate: float = 3125, buffer: int = 1024,
+                 drop: str = 'newest', stall: float = 1.0, loss: float = 0.,
+                 max_reply: int = 128, clock_bpm: float = 0, seed: int = None):
+        if drop not in ('newest', 'oldest', 'stall'):
+            raise ValueError(f"drop must be newest, oldest or stall, not {drop!r}")
+        self.latency = latency  # s from processing a request to its reply
+        self.rate = rate  # bytes/s on the wire, 0 for instant
+        self.buffer = buffer  # bytes the device can have waiting
+        self.drop = drop
+        self.stall = stall  # s the device is deaf after a "stall" overflow
+        self.loss = loss  # probability of losing any one message
+        self.max_reply = max_reply  # data bytes per reply DT1
+        self.clock_bpm = clock_bpm  # timing clock, 0 for none
+        self.seed = seed
+
+    @classmethod
+    def parse(cls, spec: str):
+        """ e.g. "latency=0.005,buffer=256,drop=stall" """
+        kwargs = {}
+        for item in filter(None, (spec or '').split(',')):
+            key, value = item.split('=', 1)
+            kwargs[key.strip()] = value.strip() if key.strip() == 'drop' else float(value)
+        for key in ('buffer', 'max_reply', 'seed'):
+            if key in kwargs:
+                kwargs[key] = int(kwargs[key])
+        return cls(**kwargs)
+
+    @classmethod
+    def from_env(cls):
+        return cls.parse(os.environ.get('MIDI_SIM', ''))
+
+
+class _Model:
+    def __init__(self, key: str, dev: int, family: list, kits: int,
+                 current_kit_addr: int, current_kit_size: int):
+        self.key = key
+        self.dev = dev  # default wire device id
+        self.family = family
+        self.kits = kits
+        self.current_kit_addr = current_kit_addr
+        self.current_kit_size = current_kit_size
+
+
+_MODELS = {
+    # SPD-SX PRO at device id 19: the current kit is 4 nybbles
+    'spdsxpro': _Model('spdsxpro', 0x12, [0x16, 0x04], 200, 0, 4),
+    # TD-50X at device id 17: the current kit is one 0-based byte
+    'td50x': _Model('td50x', 0x10, [0x07, 0x04], 100, 0, 1),
+}
+
+# TD-50X kit names: 12 bytes of name then 15 of subname per kit
+TD50X_KIT_NAME_START = 4 << 21
+TD50X_KIT_STEP = 2 << 14
+TD50X_KIT_NAME_LEN = 12
+TD50X_KIT_SUBNAME_LEN = 15
+
+_SPD_PALETTE_START = roland_sysex.unpack4([0x01, 0x00, 0x08, 0x00])
+_SPD_PALETTE_STEP = roland_sysex.unpack4([0x01, 0x00])
+
+_STATUS_CONTROL_CHANGE = 0xb0
+_STATUS_PROGRAM_CHANGE = 0xc0
+_STATUS_TIMING_CLOCK = 0xf8
+_KIT_CHANNEL = 9  # 10, 0-based
+
+
+class SimDevice:
+    """ A device's parameter memory and how it answers messages """
+
+    def __init__(self, model: str = 'spdsxpro', dev: int = None):
+        self.model = _MODELS[model]
+        self.dev = self.model.dev if dev is None else dev
+        self.codec = roland_sysex.Codec(model, self.dev)
+        self.broadcast = roland_sysex.Codec(model, 0x7f)
+        self.memory = {}  # address => 7-bit value
+        self.kit = 1
+        self.writes = 0
+        self.reads = 0
+        self._init_memory()
+
+    def _init_memory(self):
+        self.set_kit(1)
+        if self.model.key == 'td50x':
+            for kit in range(self.model.kits):
+                addr = TD50X_KIT_NAME_START + kit * TD50X_KIT_STEP
+                self.write(addr, f"Kit {kit + 1:03d}".ljust(TD50X_KIT_NAME_LEN).encode())
+                self.write(addr + TD50X_KIT_NAME_LEN,
+                           f"Sim {kit + 1:03d}".ljust(TD50X_KIT_SUBNAME_LEN).encode())
+        else:
+            for i in range(16):
+                addr = _SPD_PALETTE_START + i * _SPD_PALETTE_STEP
+                self.write(addr, f"Color {i + 1}".ljust(16).encode())
+
+    def read(self, addr: int, size: int) -> bytes:
+        return bytes(self.memory.get(addr + i, 0) for i in range(size))
+
+    def write(self, addr: int, data):
+        for i, b in enumerate(data):
+            self.memory[addr + i] = b & 0x7f
+
+    def set_kit(self, kit: int):
+        """ kit as shown on the unit, from 1 """
+        self.kit = kit
+        n = kit - 1
+        if self.model.current_kit_size == 1:
+            data = [n & 0x7f]
+        else:
+            data = roland_sysex.pack_nybbles(n, self.model.current_kit_size)
+        self.write(self.model.current_kit_addr, data)
+
+    def program_change(self) -> list:
+        """ What the unit sends when its kit changes """
+        n = self.kit - 1
+        cc = _STATUS_CONTROL_CHANGE | _KIT_CHANNEL
+        return [bytes([cc, 0, 0]), bytes([cc, 32, n >> 7]),
+                bytes([_STATUS_PROGRAM_CHANGE | _KIT_CHANNEL, n & 0x7f])]
+
+    def identity_reply(self) -> bytes:
+        return bytes([roland_sysex.STATUS_SYSEX, roland_sysex.STATUS_NON_REALTIME, self.dev,
+                      roland_sysex.GENERAL_INFO, roland_sysex.IDENTITY_REPLY,
+                      roland_sysex.VENDOR_ID_ROLAND, *self.model.family, 0x00, 0x00,
+                      0x00, 0x01, 0x00, 0x00, roland_sysex.STATUS_EOX])
+
+    def handle(self, msg, max_reply: int = 128) -> list:
+        """ Process one message from the host. Returns the replies. """
+        end = len(msg)
+        while end and msg[end - 1] == 0:
+            end -= 1
+        msg = bytes(msg[:end])
+        if msg == roland_sysex.IDENTITY_REQUEST_MSG:
+            return [self.identity_reply()]
+        parsed = self.codec.decode(msg) or self.broadcast.decode(msg)
+        if parsed is None:
+            return []
+        command, addr, start, end = parsed
+        if command == roland_sysex.COMMAND_DT1:
+            self.writes += 1
+            self.write(addr, msg[start:end])
+            if addr == self.model.current_kit_addr:
+                self._kit_from_memory()
+            return []
+        if command == roland_sysex.COMMAND_RQ1 and end - start == 4:
+            self.reads += 1
+            size = roland_sysex.unpack4(msg[start:end])
+            replies = []
+            for offset in range(0, size, max_reply):
+                n = min(max_reply, size - offset)
+                replies.append(bytes(self.codec.encode_dt1(addr + offset, self.read(addr + offset, n))))
+            return replies
+        return []
+
+    def _kit_from_memory(self):
+        data = self.read(self.model.current_kit_addr, self.model.current_kit_size)
+        n = 0
+        for b in data:
+            n = (n << (7 if len(data) == 1 else 4)) | b
+        self.kit = n + 1
+
+
+class SimMidi:
+    """ MIDI backend for a SimDevice; see the module docstring.
+        The device is picked by the connection name: "TD-50X" or else the
+        SPD-SX PRO. Configure it with `config` or the MIDI_SIM variable.
+    """
+
+    def __init__(self, midi_connection_name: str = "SPD-SX PRO", latency_ms: int = 0,
+                 config: SimConfig = None, device: SimDevice = None):
+        self.midi_connection_name = midi_connection_name
+        self.latency_ms = latency_ms
+        self.config = config or SimConfig.from_env()
+        model = 'td50x' if midi_connection_name and 'TD-50' in midi_connection_name else 'spdsxpro'
+        self.device = device or SimDevice(model)
+        self.random = random.Random(self.config.seed)
+        self.callback = None
+        self.cond = threading.Condition()
+        self.events = []  # heap of (t, seq, kind, msg)
+        self.seq = 0
+        self.waiting = []  # (done time, size) of messages on the wire or buffered
+        self.busy_until = 0.  # when the wire is free
+        self.deaf_until = 0.
+        self.received = 0
+        self.dropped = 0
+        self.sent = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="midi-sim", daemon=True)
+        self.thread.start()
+        if self.config.clock_bpm:
+            with self.cond:
+                self._push(time.perf_counter(), 'clock', None)
+
+    def _push(self, t: float, kind: str, msg):
+        """ Queue an event; call with self.cond held """
+        heapq.heappush(self.events, (t, self.seq, kind, msg))
+        self.seq += 1
+        self.cond.notify()
+
+    def write_sys_ex(self, msg, when: float = None):
+        """ As AbstractMidi.write_sys_ex: `when` needs latency_ms > 0 """
+        now = time.perf_counter()
+        msg = bytes(msg)
+        with self.cond:
+            self.received += 1
+            start = max(now, self.busy_until)
+            if when is not None and self.latency_ms:
+                start = max(start, when)
+            if self.config.loss and self.random.random() < self.config.loss:
+                self.dropped += 1
+                return
+            self.waiting = [(t, n) for t, n in self.waiting if t > now]
+            if sum(n for _, n in self.waiting) + len(msg) > self.config.buffer:
+                if not self._overflow(now):
+                    self.dropped += 1
+                    return
+            done = start + (len(msg) / self.config.rate if self.config.rate else 0.)
+            self.busy_until = done
+            self.waiting.append((done, len(msg)))
+            self._push(done, 'in', msg)
+
+    def _overflow(self, now: float) -> bool:
+        """ Make room, or not. True if the new message still gets in. """
+        if self.config.drop == 'oldest':
+            pending = [e for e in self.events if e[2] == 'in']
+            if not pending:
+                return False
+            self.events.remove(min(pending))
+            heapq.heapify(self.events)
+            self.waiting.pop(0)
+            self.dropped += 1
+            return True
+        if self.config.drop == 'stall':
+            self.deaf_until = now + self.config.stall
+        return False
+
+    def select_kit(self, kit: int):
+        """ Change kits on the front panel """
+        with self.cond:
+            self.device.set_kit(kit)
+            for msg in self.device.program_change():
+                self._push(time.perf_counter(), 'out', msg)
+
+    def start_input(self, callback):
+        self.callback = callback
+
+    def stop_input(self):
+        self.callback = None
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and (not self.events or self.events[0][0] > time.perf_counter()):
+                    timeout = self.events[0][0] - time.perf_counter() if self.events else None
+                    self.cond.wait(timeout)
+                if not self.running:
+                    return
+                t, _, kind, msg = heapq.heappop(self.events)
+                if kind == 'in':
+                    if t < self.deaf_until:
+                        self.dropped += 1
+                        continue
+                    for reply in self.device.handle(msg, self.config.max_reply):
+                        self._push(t + self.config.latency, 'out', reply)
+                    continue
+                if kind == 'clock':
+                    self._push(t + 60. / (24 * self.config.clock_bpm), 'clock', None)
+                    msg = bytes([_STATUS_TIMING_CLOCK])
+                callback = self.callback
+                self.sent += 1
+            if callback:
+                callback(msg)
+
+
+def portmidi_events(msg) -> list:
+    """ msg as the 4-byte, zero-padded events PortMidi's Input.read gives """
+    msg = bytes(msg)
+    if msg[0] != roland_sysex.STATUS_SYSEX:
+        return [list(msg.ljust(4, b'\0'))]
+    return [list(msg[i:i + 4].ljust(4, b'\0')) for i in range(0, len(msg), 4)]
+
+
+def _self_test():
+    import queue
+
+    got = queue.SimpleQueue()
+    sim = SimMidi("TD-50X", config=SimConfig(latency=0.001, rate=0))
+    sim.start_input(got.put)
+    codec = roland_sysex.Codec('td50x', 0x10)
+
+    # Identity
+    sim.write_sys_ex(bytearray(roland_sysex.IDENTITY_REQUEST_MSG))
+    assert roland_sysex.parse_identity_reply(got.get(timeout=1))['manufacturer'] == 0x41
+
+    # DT1 then RQ1 of the same bytes, across a 7-bit address carry
+    addr = roland_sysex.unpack4([0x04, 0x02, 0x00, 0x7e])
+    sim.write_sys_ex(codec.encode_dt1(addr, b'abcd'))
+    sim.write_sys_ex(codec.encode_rq1(addr, 4))
+    command, got_addr, start, end = codec.decode(reply := got.get(timeout=1))
+    assert (command, got_addr, reply[start:end]) == (roland_sysex.COMMAND_DT1, addr, b'abcd')
+
+    # Big reads are split
+    sim.write_sys_ex(codec.encode_rq1(TD50X_KIT_NAME_START, 300))
+    sizes = [codec.decode(got.get(timeout=1)) for _ in range(3)]
+    assert [e - s for _, _, s, e in sizes] == [128, 128, 44]
+    assert got.empty()
+
+    # Kit changes
+    sim.select_kit(5)
+    assert [got.get(timeout=1) for _ in range(3)][-1] == bytes([0xc9, 4])
+    sim.write_sys_ex(codec.encode_rq1(0, 1))
+    reply = got.get(timeout=1)
+    assert codec.decode(reply)[2:] and reply[codec.model.data_offset] == 4
+    sim.close()
+
+    # A small buffer at MIDI speed overflows
+    sim = SimMidi("SPD-SX PRO", config=SimConfig(rate=3125, buffer=100))
+    for _ in range(10):
+        sim.write_sys_ex(bytes(28))
+    assert sim.dropped == 7, sim.dropped
+    sim.close()
+
+    # Timing clock: 24 per beat, with replies still coming through
+    got = queue.SimpleQueue()
+    sim = SimMidi("TD-50X", config=SimConfig(latency=0.001, rate=0, clock_bpm=600))
+    sim.start_input(got.put)
+    time.sleep(0.1)
+    sim.write_sys_ex(codec.encode_rq1(TD50X_KIT_NAME_START, 12))
+    time.sleep(0.1)
+    sim.close()
+    msgs = []
+    while not got.empty():
+        msgs.append(got.get())
+    clocks = msgs.count(bytes([_STATUS_TIMING_CLOCK]))
+    assert 40 <= clocks <= 56, clocks  # 240/s for 0.2 s
+    assert any(codec.decode(m) for m in msgs if m[0] == roland_sysex.STATUS_SYSEX)
+
+    # The same, as PortMidi hands it over: clock events between the
+    # reply's SysEx events come through the assembler intact.
+    from spdsxpro_controller import MidiMessageAssembler
+    reply = bytes(codec.encode_dt1(TD50X_KIT_NAME_START, b'Kit 001     '))
+    clock = portmidi_events(bytes([_STATUS_TIMING_CLOCK]))[0]
+    events = []
+    for event in portmidi_events(reply):
+        events += [event, clock]
+    assembler = MidiMessageAssembler()
+    out = [m for event in [clock] + events for m in assembler.feed(event)]
+    assert [m for m in out if m[0] == roland_sysex.STATUS_SYSEX] == [reply], out
+    assert out.count(bytes([_STATUS_TIMING_CLOCK])) == len(events) // 2 + 1
+    print("midi_sim: ok")
+
+
+if __name__ == '__main__':
+    _self_test()
@@ -0,0 +1,285 @@
+"""Roland SysEx codec shared by the TD-50X and SPD-SX PRO tools.
+
+Roland parameter addresses and sizes are 4 bytes of 7 bits each. RQ1
+asks for `size` bytes at `addr`; DT1 carries data for `addr`, and is
+both how we write parameters and how the device answers an RQ1:
+
+    F0 41 dev <model...> 11 a a a a s s s s sum F7     RQ1
+    F0 41 dev <model...> 12 a a a a d ... d sum F7     DT1
+
+`dev` is the wire device id, i.e. the device id set on the unit minus 1
+(TD-50X factory id 17 is 0x10). Models are looked up in MODELS; register
+more with register_model().
+
+The encode_* functions write into a caller-provided buffer and return the
+end offset, so hot paths can reuse one bytearray. Pass out=None to get a
+new bytearray instead.
+
+Run this file to check the golden vectors and round trip properties:
+    $ python3 roland_sysex.py
+"""
+
+STATUS_SYSEX = 0xf0
+STATUS_EOX = 0xf7
+VENDOR_ID_ROLAND = 0x41
+COMMAND_RQ1 = 0x11
+COMMAND_DT1 = 0x12
+
+# Universal non-realtime Identity Request / Reply
+STATUS_NON_REALTIME = 0x7e
+CHANNEL_BROADCAST = 0x7f
+GENERAL_INFO = 0x06
+IDENTITY_REQUEST = 0x01
+IDENTITY_REPLY = 0x02
+IDENTITY_REQUEST_MSG = bytes([STATUS_SYSEX, STATUS_NON_REALTIME, CHANNEL_BROADCAST,
+                              GENERAL_INFO, IDENTITY_REQUEST, STATUS_EOX])
+
+
+class Model:
+    def __init__(self, name: str, model_id: list):
+        self.name = name
+        self.model_id = bytes(model_id)
+        # Offsets into a message
+        self.command_offset = 3 + len(self.model_id)
+        self.addr_offset = self.command_offset + 1
+        self.data_offset = self.addr_offset + 4
+        # Framing + model + command + address + checksum
+        self.overhead = self.data_offset + 2
+
+
+MODELS = {}
+
+
+def register_model(key: str, name: str, model_id: list) -> Model:
+    MODELS[key] = Model(name, model_id)
+    return MODELS[key]
+
+
+register_model('td50x', "TD-50X", [0x00, 0x00, 0x00, 0x00, 0x07])
+register_model('spdsxpro', "SPD-SX PRO", [0x00, 0x00, 0x00, 0x00, 0x16])
+
+
+def flatten(*args):
+    out = []
+    for a in args:
+        if isinstance(a, (list, bytes, bytearray)):
+            out.extend(a)
+        else:
+            out.append(a)
+    return out
+
+
+def unpack4(arr):
+    """ Big-endian 7-bit groups to int, e.g. [0x01, 0x00] => 128 """
+    n = 0
+    for x in arr:
+        n = (n << 7) + x
+    return n
+
+
+def pack_bit_runs(val: int, grouping: int, width: int):
+    """ pack each grouping of bits val into a byte, msn first, producing `width` bytes """
+    out = []
+    mask = (1 << grouping) - 1
+    for i in range(width):
+        out.append((val >> (grouping * (width - 1 - i))) & mask)
+    return out
+
+
+def pack_nybbles(val: int, width: int):
+    """ pack each nybble of val into a byte, msn first, producing `width` bytes """
+    return pack_bit_runs(val, 4, width)
+
+
+def pack4(val: int):
+    return pack_bit_runs(val, 7, 4)
+
+
+def checksum(arr, start: int = 0, end: int = None):
+    """ Roland checksum of arr[start:end]: makes address + data + sum == 0 mod 128 """
+    return -sum(arr[start:end]) & 0x7f
+
+
+def _put4(out, offset: int, val: int):
+    out[offset] = (val >> 21) & 0x7f
+    out[offset + 1] = (val >> 14) & 0x7f
+    out[offset + 2] = (val >> 7) & 0x7f
+    out[offset + 3] = val & 0x7f
+
+
+class Codec:
+    """ Encoder/decoder for one model at one wire device id """
+
+    def __init__(self, model, dev: int):
+        self.model = MODELS[model] if isinstance(model, str) else model
+        self.dev = dev
+        self.header = bytes([STATUS_SYSEX, VENDOR_ID_ROLAND, dev]) + self.model.model_id
+
+    def rq1_size(self) -> int:
+        return self.model.overhead + 4
+
+    def dt1_size(self, data_len: int) -> int:
+        return self.model.overhead + data_len
+
+    def _frame(self, out, offset: int, command: int, addr: int, body_len: int) -> int:
+        m = self.model
+        out[offset:offset + len(self.header)] = self.header
+        out[offset + m.command_offset] = command
+        _put4(out, offset + m.addr_offset, addr)
+        end = offset + m.data_offset + body_len
+        out[end] = checksum(out, offset + m.addr_offset, end)
+        out[end + 1] = STATUS_EOX
+        return end + 2
+
+    def encode_rq1(self, addr: int, size: int, out=None, offset: int = 0):
+        """ Write an RQ1 at out[offset:]. Returns the end offset, or a new
+            bytearray when out is None.
+        """
+        if out is None:
+            buf = bytearray(self.rq1_size())
+            self.encode_rq1(addr, size, buf)
+            return buf
+        _put4(out, offset + self.model.data_offset, size)
+        return self._frame(out, offset, COMMAND_RQ1, addr, 4)
+
+    def encode_dt1(self, addr: int, data, out=None, offset: int = 0):
+        """ Write a DT1 at out[offset:]. Returns the end offset, or a new
+            bytearray when out is None.
+        """
+        if out is None:
+            buf = bytearray(self.dt1_size(len(data)))
+            self.encode_dt1(addr, data, buf)
+            return buf
+        start = offset + self.model.data_offset
+        out[start:start + len(data)] = data
+        return self.frame_dt1(addr, len(data), out, offset)
+
+    def frame_dt1(self, addr: int, data_len: int, out, offset: int = 0) -> int:
+        """ Finish a DT1 whose payload the caller already wrote at
+            out[offset + model.data_offset:]. Returns the end offset.
+        """
+        return self._frame(out, offset, COMMAND_DT1, addr, data_len)
+
+    def decode(self, buf, offset: int = 0, end: int = None):
+        """ Parse one RQ1/DT1 from this model in buf[offset:end].
+
+            Returns (command, addr, data_start, data_end), so the payload
+            is buf[data_start:data_end] and nothing is copied. Trailing
+            zero padding after F7 is allowed. Returns None if the message
+            is for another model/device, is malformed, or fails its
+            checksum.
+        """
+        m = self.model
+        if end is None:
+            end = len(buf)
+        while end > offset and buf[end - 1] == 0:
+            end -= 1
+        if end - offset < m.overhead or buf[end - 1] != STATUS_EOX:
+            return None
+        hlen = len(self.header)
+        if bytes(buf[offset:offset + hlen]) != self.header:
+            return None
+        addr_start = offset + m.addr_offset
+        if checksum(buf, addr_start, end - 2) != buf[end - 2]:
+            return None
+        command = buf[offset + m.command_offset]
+        addr = unpack4(buf[addr_start:addr_start + 4])
+        return command, addr, offset + m.data_offset, end - 2
+
+    def decode_into(self, buf, out, out_offset: int = 0):
+        """ Copy a DT1's payload to out[out_offset:]. Returns (addr, length)
+            or None, as decode().
+        """
+        parsed = self.decode(buf)
+        if parsed is None or parsed[0] != COMMAND_DT1:
+            return None
+        _, addr, start, end = parsed
+        out[out_offset:out_offset + end - start] = memoryview(buf)[start:end]
+        return addr, end - start
+
+
+def parse_identity_reply(buf):
+    """ Returns the identity dict, or None if buf isn't an Identity Reply """
+    end = len(buf)
+    while end > 0 and buf[end - 1] == 0:
+        end -= 1
+    if end < 15 or buf[0] != STATUS_SYSEX or buf[end - 1] != STATUS_EOX:
+        return None
+    if (buf[1] != STATUS_NON_REALTIME or buf[3] != GENERAL_INFO
+            or buf[4] != IDENTITY_REPLY):
+        return None
+    return {
+        'dev': buf[2],
+        'manufacturer': buf[5],
+        'family': list(buf[6:8]),
+        'model': list(buf[8:10]),
+        'version': list(buf[10:14]),
+    }
+
+
+# (model, dev, command, addr, size or data, expected hex)
+_GOLDEN = [
+    # SPD-SX PRO device id 19, user color 1 = white
+    ('spdsxpro', 0x12, COMMAND_DT1, unpack4([0x01, 0x00, 0x12, 0x10]),
+     [0, 0, 0xf, 0xf, 0, 0, 0xf, 0xf, 0, 0, 0xf, 0xf],
+     "f0 41 12 00 00 00 00 16 12 01 00 12 10 00 00 0f 0f 00 00 0f 0f 00 00 0f 0f 03 f7"),
+    # user color 5 = fab3ff
+    ('spdsxpro', 0x12, COMMAND_DT1, unpack4([0x01, 0x00, 0x16, 0x10]),
+     [0, 0, 0xf, 0xa, 0, 0, 0xb, 0x3, 0, 0, 0xf, 0xf],
+     "f0 41 12 00 00 00 00 16 12 01 00 16 10 00 00 0f 0a 00 00 0b 03 00 00 0f 0f 14 f7"),
+    # TD-50X current kit
+    ('td50x', 0x10, COMMAND_RQ1, 0, 1,
+     "f0 41 10 00 00 00 00 07 11 00 00 00 00 00 00 00 01 7f f7"),
+    # TD-50X kit 6 name
+    ('td50x', 0x10, COMMAND_RQ1, (4 << 21) + 5 * (2 << 14), 27,
+     "f0 41 10 00 00 00 00 07 11 04 0a 00 00 00 00 00 1b 57 f7"),
+    # Sum divisible by 128 must give a checksum of 0, not 0x80
+    ('td50x', 0x10, COMMAND_RQ1, 0, 0,
+     "f0 41 10 00 00 00 00 07 11 00 00 00 00 00 00 00 00 00 f7"),
+]
+
+
+def _self_test():
+    import random
+
+    # Golden vectors, encoding both ways and decoding back
+    for model, dev, command, addr, arg, expected in _GOLDEN:
+        codec = Codec(model, dev)
+        if command == COMMAND_RQ1:
+            msg = codec.encode_rq1(addr, arg)
+            out = bytearray(64)
+            end = codec.encode_rq1(addr, arg, out, 3)
+        else:
+            msg = codec.encode_dt1(addr, arg)
+            out = bytearray(64)
+            end = codec.encode_dt1(addr, arg, out, 3)
+        assert msg.hex(' ') == expected, (msg.hex(' '), expected)
+        assert out[3:end] == msg
+        parsed = codec.decode(msg + b'\0\0\0')
+        assert parsed is not None and parsed[:2] == (command, addr), parsed
+
+    # Properties
+    rng = random.Random(1)
+    for _ in range(2000):
+        n = rng.randrange(1 << 28)
+        assert unpack4(pack4(n)) == n
+        codec = Codec(rng.choice(list(MODELS)), rng.randrange(0x20))
+        addr = rng.randrange(1 << 28)
+        data = bytes(rng.randrange(128) for _ in range(rng.randrange(0, 40)))
+        msg = codec.encode_dt1(addr, data)
+        assert sum(msg[codec.model.addr_offset:-1]) % 128 == 0
+        assert all(b < 0x80 for b in msg[1:-1])
+        command, got_addr, start, end = codec.decode(msg)
+        assert (command, got_addr, bytes(msg[start:end])) == (COMMAND_DT1, addr, data)
+        out = bytearray(len(data))
+        assert codec.decode_into(msg, out) == (addr, len(data)) and out == data
+        # Any single corrupted payload byte is caught by the checksum
+        i = rng.randrange(codec.model.addr_offset, len(msg) - 1)
+        bad = bytearray(msg)
+        bad[i] = (bad[i] + rng.randrange(1, 128)) & 0x7f
+        assert codec.decode(bad) is None
+    print(f"roland_sysex: {len(_GOLDEN)} golden vectors and round trip properties ok")
+
+
+if __name__ == '__main__':
+    _self_test()
@@ -21,7 +21,7 @@ class AbstractMidi:
     def ensure_init_devices(self):
         pass
 
-    def write_sys_ex(self, msg):
+    def write_sys_ex(self, msg, when=None):
         self.capture = msg
 
 
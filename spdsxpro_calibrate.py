@@ -0,0 +1,209 @@
+"""Measure how fast the SPD-SX PRO takes palette writes.
+
+Writes user colors at increasing rates. After each step it reads the last
+color back with an RQ1 and sends an Identity Request. A step passes when
+both are answered in time and the read-back matches, i.e. the device
+kept up and its MIDI link is still alive. The fastest passing rate, less
+a safety margin, is saved per device identity:
+
+    $ python3 spdsxpro_calibrate.py -i "SPD-SX PRO" -d 19
+    $ python3 spdsxpro_controller.py --calibration spdsxpro_calibration.json
+
+The controller probes the identity at startup and sets its MidiShaper to
+the saved limits. The user colors are read first and restored afterwards.
+"""
+
+import argparse
+import json
+import os
+import queue
+import time
+
+import roland_sysex
+import spdsxpro_controller
+
+DEFAULT_PATH = 'spdsxpro_calibration.json'
+
+
+def identity_key(identity: dict) -> str:
+    """ e.g. "41-4b03-0000-00010000": manufacturer, family, model, version """
+    return '-'.join(''.join(f"{b:02x}" for b in ([v] if isinstance(v, int) else v))
+                    for v in (identity['manufacturer'], identity['family'],
+                              identity['model'], identity['version']))
+
+
+def load(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save(path: str, key: str, result: dict):
+    results = load(path)
+    results[key] = result
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp, path)
+
+
+class Replies:
+    """ MIDI input, for request/reply exchanges. Pass on_message to the
+        backend's start_input.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+
+    def on_message(self, msg: bytes):
+        self.queue.put(msg)
+
+    def drain(self):
+        while not self.queue.empty():
+            self.queue.get()
+
+    def wait_for(self, parse, timeout: float):
+        """ The first parse(msg) that isn't None, or None on timeout """
+        deadline = time.perf_counter() + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            try:
+                result = parse(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                return None
+            if result is not None:
+                return result
+
+
+def probe_identity(spd: spdsxpro_controller.SpdSxPro, replies: Replies, timeout: float = 1.0):
+    spd.request_identity()
+    return replies.wait_for(roland_sysex.parse_identity_reply, timeout)
+
+
+def limits_for(path: str, identity: dict):
+    """ The device's saved (msgs_per_s, bytes_per_s), or None """
+    result = load(path).get(identity_key(identity))
+    if result is None:
+        return None
+    return result['msgs_per_s'], result['bytes_per_s']
+
+
+def read_user_colors(spd, replies: Replies, timeout: float):
+    colors = {}
+    for i in range(len(spd.user_color_addrs)):
+        spd.read_user_color(i)
+        reply = replies.wait_for(spd.parse_user_color, timeout)
+        if reply is not None:
+            colors[reply[0]] = reply[1]
+    return colors
+
+
+def run_step(spd, replies: Replies, rate: float, duration: float, timeout: float) -> dict:
+    """ Write at `rate` for `duration`, then check the device kept up """
+    replies.drain()
+    n = 0
+    rgb = None
+    t0 = time.perf_counter()
+    t_next = t0
+    while t_next - t0 < duration:
+        delay = t_next - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        slot = n % len(spd.user_color_addrs)
+        rgb = (n & 0xff, (n >> 8) & 0xff, 0x80)
+        spd.send_user_color(slot, rgb)
+        n += 1
+        t_next += 1. / rate
+    elapsed = time.perf_counter() - t0
+
+    t_check = time.perf_counter()
+    spd.read_user_color(slot)
+    readback = replies.wait_for(spd.parse_user_color, timeout)
+    identity = probe_identity(spd, replies, timeout)
+    return {
+        'rate': rate,
+        'msgs_per_s': n / elapsed,
+        'bytes_per_s': n * spd.codec.dt1_size(spd._COLOR_DATA_LEN) / elapsed,
+        'readback_ok': readback == (slot, rgb),
+        'identity_ok': identity is not None,
+        'check_ms': 1e3 * (time.perf_counter() - t_check),
+        # Writes that block mean the link, not our clock, set the pace.
+        'kept_pace': elapsed < duration * 1.1,
+    }
+
+
+def calibrate(spd, replies: Replies, rates: list, duration: float, timeout: float):
+    """ Returns the fastest passing step, or None """
+    best = None
+    for rate in rates:
+        step = run_step(spd, replies, rate, duration, timeout)
+        ok = step['readback_ok'] and step['identity_ok'] and step['kept_pace']
+        print(f"rate={rate:g}/s: sent {step['msgs_per_s']:.0f} msgs/s "
+              f"{step['bytes_per_s']:.0f} B/s, readback={step['readback_ok']} "
+              f"identity={step['identity_ok']} check={step['check_ms']:.1f} ms: "
+              f"{'ok' if ok else 'FAIL'}")
+        if not ok:
+            break
+        best = step
+        # Let anything still buffered drain before the next step.
+        time.sleep(timeout)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', default="SPD-SX PRO", help='MIDI connection name')
+    parser.add_argument('-d', default=19, type=int, help='SPD-SX PRO MIDI device id')
+    parser.add_argument('-b', default='pygame', choices=list(spdsxpro_controller._MIDI_BACKENDS),
+                        help='MIDI backend')
+    parser.add_argument('--rates', default='10,20,40,80,120,160,240,320,480,640',
+                        help='messages per second to try, in order')
+    parser.add_argument('--duration', default=2.0, type=float, help='seconds per rate')
+    parser.add_argument('--timeout', default=0.5, type=float,
+                        help='how long to wait for each reply (s)')
+    parser.add_argument('--margin', default=0.8, type=float,
+                        help='fraction of the fastest passing rate to save')
+    parser.add_argument('-o', default=DEFAULT_PATH, help='calibration file')
+    args = parser.parse_args()
+
+    midi = spdsxpro_controller._MIDI_BACKENDS[args.b](args.i)
+    spd = spdsxpro_controller.SpdSxPro(midi, device_id=args.d)
+    replies = Replies()
+    midi.start_input(replies.on_message)
+    try:
+        identity = probe_identity(spd, replies, args.timeout * 2)
+        if identity is None:
+            print("No Identity Reply; is the device connected and its device id right?")
+            return 1
+        key = identity_key(identity)
+        print(f"identity: {key}")
+        saved = read_user_colors(spd, replies, args.timeout)
+        try:
+            best = calibrate(spd, replies, [float(r) for r in args.rates.split(',')],
+                             args.duration, args.timeout)
+        finally:
+            for i, rgb in saved.items():
+                spd.send_user_color(i, rgb)
+        if best is None:
+            print("Failed at the slowest rate; nothing saved")
+            return 1
+        result = {
+            'msgs_per_s': round(best['msgs_per_s'] * args.margin, 1),
+            'bytes_per_s': round(best['bytes_per_s'] * args.margin, 1),
+            'measured_msgs_per_s': round(best['msgs_per_s'], 1),
+            'identity': {k: v for k, v in identity.items() if k != 'dev'},
+            'time': int(time.time()),
+        }
+        save(args.o, key, result)
+        print(f"saved {result['msgs_per_s']} msgs/s, {result['bytes_per_s']} B/s to {args.o}")
+    finally:
+        midi.stop_input()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -3,11 +3,9 @@ from os import environ
 environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"  # so lame
 
 import argparse
-import asyncio
-import pygame
-from pygame.locals import *
-import mido
-import pygame.midi
+import collections
+import heapq
+import http.client
 from paho.mqtt import client as mqtt_client
 import json
 import sys
@@ -15,7 +13,13 @@ import os
 import time
 import random
 import queue
-from websockets.server import serve
+import threading
+
+import roland_sysex
+
+# Keep this module cheap to import: a supervisor restart should be ready
+# for MQTT right away. MIDI backends and the profiler are imported
+# when they're first used. See import_time_check.py.
 
 # Example:
 # Run a mosquitto server on localhost.
@@ -29,11 +33,14 @@ class NoDeviceException (Exception):
 
 
 class MqttListener:
-    def __init__(self, broker: str, port: int, topic: str, queue: queue.SimpleQueue):
+    def __init__(self, broker: str, port: int, topic: str, queue: queue.SimpleQueue,
+                 verbose: bool = True):
         self.broker = broker
         self.port = port
         self.topic = topic
         self.queue = queue
+        self.verbose = verbose
+        self.received = 0
         self.client_id = f'python-mqtt-{random.randint(0, 1000)}'
         self.client = None  # need to connect
 
@@ -59,7 +66,9 @@ class MqttListener:
                 print(f"MQTT: json decode error msg={payload}, ex={ex}")
                 return
 
-            print(f"MQTT: topic={msg.topic}: msg={doc}")
+            userdata.received += 1
+            if userdata.verbose:
+                print(f"MQTT: topic={msg.topic}: msg={doc}")
             userdata.queue.put(doc)
 
         self.client.on_message = on_message
@@ -69,13 +78,65 @@ class MqttListener:
     def start(self):
         self.client.loop_start()
 
-    def poll(self):
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def poll(self, timeout: float = None):
+        """ Next doc, or None. Waits up to `timeout` seconds if given. """
         try:
+            if timeout:
+                return self.queue.get(timeout=timeout)
             return self.queue.get(block=False)
         except queue.Empty:
             return None
 
 
+def _message_length(status: int) -> int:
+    """ Bytes in a channel or system common message, status included """
+    if status < 0xf0:
+        return 2 if 0xc0 <= status < 0xe0 else 3
+    return {0xf1: 2, 0xf2: 3, 0xf3: 2}.get(status, 1)
+
+
+class MidiMessageAssembler:
+    """ Turns PortMidi's 4-byte input events back into whole messages.
+        SysEx arrives spread over several events, with realtime bytes
+        like timing clock allowed in between.
+    """
+
+    def __init__(self):
+        self.sysex = None  # bytearray while inside a SysEx
+
+    def feed(self, data) -> list:
+        if data[0] >= 0xf8:
+            # A realtime byte gets an event of its own, zero padded; the
+            # padding isn't SysEx data.
+            return [bytes(data[:1])]
+        out = []
+        if self.sysex is None and data[0] != roland_sysex.STATUS_SYSEX:
+            if data[0] & 0x80:
+                out.append(bytes(data[:_message_length(data[0])]))
+            return out
+        for b in data:
+            if b == roland_sysex.STATUS_SYSEX:
+                self.sysex = bytearray([b])
+            elif b >= 0xf8:
+                out.append(bytes([b]))
+            elif self.sysex is None:
+                break
+            elif b & 0x80 and b != roland_sysex.STATUS_EOX:
+                self.sysex = None  # truncated by another status byte
+                break
+            else:
+                self.sysex.append(b)
+                if b == roland_sysex.STATUS_EOX:
+                    out.append(bytes(self.sysex))
+                    self.sysex = None
+                    break
+        return out
+
+
 class AbstractMidi:
     """ Used as an argument to SpdSxPro.init """
 
@@ -83,57 +144,359 @@ class AbstractMidi:
     # Can only get one command in, and the connection stops working.
     _RECONNECT_MIDI_PER_COMMAND = True
 
-    def __init__(self, midi_connection_name: str):
+    verbose = True  # log every message written
+
+    def __init__(self, midi_connection_name: str, latency_ms: int = 0):
+        """ latency_ms > 0 enables scheduled output: PortMidi queues each
+            message and the driver sends it at its timestamp.
+        """
+        self._pm = None
         self.midi_connection_name = midi_connection_name
         self.midi_output = None
-        pygame.midi.init()
+        self.midi_input = None
+        self.latency_ms = latency_ms
+        # Reconnecting would drop whatever PortMidi has queued and restart
+        # its clock, so scheduled mode keeps the connection.
+        self.reconnect_per_command = self._RECONNECT_MIDI_PER_COMMAND and not latency_ms
+        # PortMidi calls come from the sink, App and input threads.
+        self.lock = threading.RLock()
+        self.input_thread = None
+
+    @property
+    def pm(self):
+        """ pygame.midi, imported on first use: it takes longer than the
+            rest of startup put together, and MQTT shouldn't wait for it.
+        """
+        if self._pm is None:
+            import pygame.midi
+            self._pm = pygame.midi
+        return self._pm
 
     def ensure_init_devices(self):
         """ init """
-        is_init = pygame.midi.get_init()
-        if self._RECONNECT_MIDI_PER_COMMAND and is_init:
+        is_init = self.pm.get_init()
+        if self.reconnect_per_command and is_init:
             if self.midi_output:
                 self.midi_output.close()
                 self.midi_output = None
-            pygame.midi.quit()
-            is_init = False
+            # Restarting PortMidi would close the input too, so while it's
+            # open only the output is reconnected.
+            if self.midi_input is None:
+                self.pm.quit()
+                is_init = False
 
         if not is_init:
-            pygame.midi.init()
+            self.pm.init()
 
         if self.midi_output is None:
             dev = self.find_output_device(self.midi_connection_name)
-            self.midi_output = pygame.midi.Output(dev, latency=0)
+            self.midi_output = self.pm.Output(dev, latency=self.latency_ms)
 
-    def write_sys_ex(self, msg):
-        hex = " ".join(f"{b:02x}" for b in msg)
-        print(f'write_sys_ex([{hex}])')
-        self.ensure_init_devices()
-        while len(msg) % 4 > 0:
-            msg.append(0)  # pad to 4
-        self.midi_output.write_sys_ex(0, msg)
+    def write_sys_ex(self, msg, when: float = None):
+        """ Send now, or at `when` on the time.perf_counter() clock.
+            Scheduling needs latency_ms > 0, and `when` can be at most
+            latency_ms ahead; earlier times are sent right away.
+        """
+        if self.verbose:
+            hex = " ".join(f"{b:02x}" for b in msg)
+            print(f'write_sys_ex([{hex}])')
+        with self.lock:
+            self.ensure_init_devices()
+            while len(msg) % 4 > 0:
+                msg.append(0)  # pad to 4
+            timestamp = 0
+            if when is not None and self.latency_ms:
+                # PortMidi sends at timestamp + latency, on its own ms clock.
+                ahead_ms = round((when - time.perf_counter()) * 1e3)
+                timestamp = max(0, self.pm.time() + ahead_ms - self.latency_ms)
+            self.midi_output.write_sys_ex(timestamp, msg)
 
-    def find_output_device(self, name: str):
-        """ Find the output device called `name` """
-        num_midi_devices = pygame.midi.get_count()
+    def start_input(self, callback):
+        """ Call `callback(msg: bytes)` with each whole message the device
+            sends, on a background thread.
+        """
+        with self.lock:
+            if not self.pm.get_init():
+                self.pm.init()
+            self.midi_input = self.pm.Input(self.find_input_device(self.midi_connection_name))
+        self.input_thread = threading.Thread(target=self._read_input, args=(callback,),
+                                             name="midi-in", daemon=True)
+        self.input_thread.start()
+
+    def stop_input(self):
+        if self.input_thread:
+            with self.lock:
+                midi_input, self.midi_input = self.midi_input, None
+            self.input_thread.join()
+            self.input_thread = None
+            with self.lock:
+                midi_input.close()
+
+    # PortMidi has no blocking read, so poll at this interval.
+    _INPUT_POLL_INTERVAL = 0.001
+
+    def _read_input(self, callback):
+        assembler = MidiMessageAssembler()
+        while True:
+            with self.lock:
+                if self.midi_input is None:
+                    return
+                events = self.midi_input.read(64) if self.midi_input.poll() else []
+            if not events:
+                time.sleep(self._INPUT_POLL_INTERVAL)
+                continue
+            for data, _ in events:
+                for msg in assembler.feed(data):
+                    callback(msg)
+
+    def _find_device(self, name: str, want_input: bool):
+        num_midi_devices = self.pm.get_count()
         for idx in range(num_midi_devices):
-            device_info = pygame.midi.get_device_info(idx)
+            device_info = self.pm.get_device_info(idx)
             if not device_info:
                 continue
-            _, device_name, _, is_output, _ = device_info
+            _, device_name, is_input, is_output, _ = device_info
             device_name = device_name.decode(encoding="ascii")
-            if device_name == name and is_output == 1:
+            if device_name == name and (is_input if want_input else is_output) == 1:
                 return idx
-        raise NoDeviceException(f'No output device named "{name}"')
+        kind = "input" if want_input else "output"
+        raise NoDeviceException(f'No {kind} device named "{name}"')
+
+    def find_output_device(self, name: str):
+        """ Find the output device called `name` """
+        return self._find_device(name, want_input=False)
 
+    def find_input_device(self, name: str):
+        """ Find the input device called `name` """
+        return self._find_device(name, want_input=True)
 
-class SpdSxPro:
-    _STATUS_SYSEX = 0xf0
-    _STATUS_EOX = 0xf7
-    _COMMAND_DT1 = 0x12
-    _VENDOR_ID_ROLAND = 0x41
-    _MODEL_SPDSXPRO = [0x00, 0x00, 0x00, 0x00, 0x16]
 
+class CaptureMidi:
+    """ Records SysEx instead of sending it. For dry runs and benchmarks. """
+
+    def __init__(self, midi_connection_name: str = None, latency_ms: int = 0,
+                 keep: int = 1024):
+        self.midi_connection_name = midi_connection_name
+        self.latency_ms = latency_ms
+        self.capture = None  # the last message
+        self.messages = collections.deque(maxlen=keep)  # (perf_counter, msg)
+        self.count = 0
+        self.on_write = None  # callable(t, msg), e.g. for benchmarks
+        self.on_input = None
+
+    def write_sys_ex(self, msg, when: float = None):
+        """ Records `when` for scheduled messages, as if sent on time """
+        now = time.perf_counter()
+        t = now if when is None or not self.latency_ms else max(now, when)
+        self.capture = msg
+        self.messages.append((t, msg))
+        self.count += 1
+        if self.on_write:
+            self.on_write(t, msg)
+
+    def start_input(self, callback):
+        self.on_input = callback
+
+    def stop_input(self):
+        self.on_input = None
+
+    def receive(self, msg: bytes):
+        """ Feed `msg` to the input callback, as if the device sent it """
+        if self.on_input:
+            self.on_input(bytes(msg))
+
+
+def _sim_midi(midi_connection_name: str, latency_ms: int = 0):
+    """ Simulated device, configured by the MIDI_SIM variable; see midi_sim.py """
+    import midi_sim
+    return midi_sim.SimMidi(midi_connection_name, latency_ms)
+
+
+# -b choices. Constructed with the MIDI connection name and latency_ms.
+_MIDI_BACKENDS = {
+    'pygame': AbstractMidi,
+    'capture': CaptureMidi,
+    'sim': _sim_midi,
+}
+
+
+class Pacer:
+    """ Token buckets for a message rate and a byte rate. Allows bursts of
+        up to `burst` seconds' worth. msgs_per_s=None leaves messages
+        unlimited.
+    """
+
+    def __init__(self, msgs_per_s: float, bytes_per_s: float, burst: float = 0.05):
+        self.set_limits(msgs_per_s, bytes_per_s, burst)
+        self.msgs = self.max_msgs
+        self.bytes = self.max_bytes
+        self.t = time.perf_counter()
+        self.waited = 0.
+
+    def set_limits(self, msgs_per_s: float, bytes_per_s: float, burst: float = 0.05):
+        self.msgs_per_s = msgs_per_s
+        self.bytes_per_s = bytes_per_s
+        self.max_msgs = max(1., msgs_per_s * burst) if msgs_per_s else 1.
+        self.max_bytes = bytes_per_s * burst
+
+    def _refill(self, now: float):
+        dt = now - self.t
+        self.t = now
+        if self.msgs_per_s:
+            self.msgs = min(self.max_msgs, self.msgs + dt * self.msgs_per_s)
+        self.bytes = min(self.max_bytes, self.bytes + dt * self.bytes_per_s)
+
+    def delay(self, nbytes: int) -> float:
+        """ Seconds until a message of nbytes fits """
+        self._refill(time.perf_counter())
+        # A message bigger than the bucket only has to wait for a full one.
+        need = (min(nbytes, self.max_bytes) - self.bytes) / self.bytes_per_s
+        if self.msgs_per_s:
+            need = max(need, (1 - self.msgs) / self.msgs_per_s)
+        return need
+
+    def take(self, nbytes: int):
+        if self.msgs_per_s:
+            self.msgs -= 1
+        self.bytes -= nbytes
+
+    def wait(self, nbytes: int):
+        """ Block until nbytes fit, and take them """
+        need = self.delay(nbytes)
+        if need > 0:
+            time.sleep(need)
+            self.waited += need
+            self._refill(time.perf_counter())
+        self.take(nbytes)
+
+
+PRIORITY_REALTIME = 0  # live colors
+PRIORITY_INTERACTIVE = 1  # requests someone is waiting on
+PRIORITY_BULK = 2  # dumps and scans
+_PRIORITY_NAMES = ['realtime', 'interactive', 'bulk']
+
+
+class MidiShaper:
+    """ Shares one MIDI output between live colors, requests and bulk
+        transfers without letting the big ones get in the way.
+
+        Messages wait in a queue per priority, and a thread sends the most
+        urgent one whenever the byte budget allows: 31.25 kbaud at 10 bits
+        a byte is 3125 B/s. Bulk transfers are queued message by message,
+        so a color change waits behind at most the one message already
+        sent, not the rest of a dump. A message written with a `key` (say,
+        the user color slot it sets) replaces a queued one with the same
+        key, so when colors come faster than the budget, only the latest
+        ones wait.
+    """
+
+    MIDI_BYTES_PER_S = 3125
+
+    def __init__(self, midi, bytes_per_s: float = MIDI_BYTES_PER_S,
+                 msgs_per_s: float = None, burst: float = 0.02):
+        self.midi = midi
+        self.pacer = Pacer(msgs_per_s, bytes_per_s, burst)
+        self.burst = burst
+        self.queues = [collections.deque() for _ in _PRIORITY_NAMES]  # [msg, when, t, key]
+        self.keyed = {}  # key => its queued entry
+        self.sent = [0] * len(_PRIORITY_NAMES)
+        self.max_wait = [0.] * len(_PRIORITY_NAMES)
+        self.replaced = 0
+        self.errors = 0
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="midi-shaper", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stops sending; whatever is still queued is dropped """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+
+    def set_limits(self, msgs_per_s: float, bytes_per_s: float):
+        with self.cond:
+            self.pacer.set_limits(msgs_per_s, bytes_per_s, self.burst)
+            self.cond.notify()
+
+    def write(self, msg, when: float = None, priority: int = PRIORITY_REALTIME, key=None):
+        """ Queue msg; see AbstractMidi.write_sys_ex for `when`. Timed
+            messages are never replaced.
+        """
+        with self.cond:
+            entry = self.keyed.get(key) if key is not None and when is None else None
+            if entry is not None:
+                # Keeps its place in line, and its age for max_wait.
+                entry[0] = msg
+                self.replaced += 1
+                return
+            entry = [msg, when, time.perf_counter(), key]
+            self.queues[priority].append(entry)
+            if key is not None and when is None:
+                self.keyed[key] = entry
+            self.cond.notify()
+
+    def write_many(self, msgs, priority: int = PRIORITY_BULK):
+        """ Queue a transfer. Anything more urgent can go between its messages. """
+        t = time.perf_counter()
+        with self.cond:
+            self.queues[priority].extend([msg, None, t, None] for msg in msgs)
+            self.cond.notify()
+
+    def queued(self) -> int:
+        with self.cond:
+            return sum(len(q) for q in self.queues)
+
+    def _next(self):
+        for priority, q in enumerate(self.queues):
+            if q:
+                return priority, q
+        return None, None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.running:
+                        return
+                    priority, q = self._next()
+                    if q is None:
+                        self.cond.wait()
+                        continue
+                    # Wait for the budget, but look again if something more
+                    # urgent arrives meanwhile.
+                    delay = self.pacer.delay(len(q[0][0]))
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                entry = q.popleft()
+                msg, when, t, key = entry
+                if key is not None and self.keyed.get(key) is entry:
+                    del self.keyed[key]
+                self.pacer.take(len(msg))
+            self.max_wait[priority] = max(self.max_wait[priority], time.perf_counter() - t)
+            try:
+                self.midi.write_sys_ex(msg, when)
+            except Exception as ex:
+                self.errors += 1
+                print(f"midi-shaper: exception in output: {ex}")
+                continue
+            self.sent[priority] += 1
+
+    def summary(self) -> str:
+        parts = [f"{name}={self.sent[i]}(max_wait_ms={1e3 * self.max_wait[i]:.1f})"
+                 for i, name in enumerate(_PRIORITY_NAMES)]
+        return (f"{' '.join(parts)} replaced={self.replaced} errors={self.errors} "
+                f"queued={self.queued()}")
+
+
+class SpdSxPro:
     # Address layout constants from the SPD-SX PRO MIDI impl doc.
     _SETUP_START = [0x01, 0x00, 0x00, 0x00]
     _COLOR_TABLE_START = [0x08, 0x00]
@@ -143,125 +506,854 @@ class SpdSxPro:
     # Palette positions of user colors 1 through 5
     _USER_PALETTE_INDICES = [10, 11, 12, 13, 14]
 
-    def __init__(self, midi: AbstractMidi, device_id: int):
+    # Current kit number, as 4 nybbles
+    _CURRENT_KIT = [0x00, 0x00, 0x00, 0x00]
+    _CURRENT_KIT_SIZE = 4
+
+    # RGB, each channel as 4 bytes of split nybbles
+    _COLOR_DATA_LEN = 12
+
+    def __init__(self, midi: AbstractMidi, device_id: int, shaper: MidiShaper = None):
         self.midi = midi
+        self.shaper = shaper  # in front of midi, if given
         self.device_id = device_id
+        self.codec = roland_sysex.Codec('spdsxpro', device_id - 1)
+        self.user_color_addrs = [self.palette_rgb_addr(i) for i in self._USER_PALETTE_INDICES]
+
+    def write(self, msg, when: float = None, priority: int = PRIORITY_REALTIME, key=None):
+        """ All output goes through here, so it can be shaped """
+        if self.shaper:
+            self.shaper.write(msg, when, priority, key)
+        else:
+            self.midi.write_sys_ex(msg, when)
+
+    @classmethod
+    def palette_rgb_addr(cls, palette_index: int) -> int:
+        unpack4 = roland_sysex.unpack4
+        return (unpack4(cls._SETUP_START)
+                + unpack4(cls._COLOR_TABLE_START)
+                + palette_index * unpack4(cls._COLOR_TABLE_STEP)
+                + unpack4(cls._COLOR_TABLE_RGB))
 
     @staticmethod
-    def _flatten(*args):
+    def color_data(rgb: tuple[int, int, int], out=None, offset: int = 0):
+        """ Split nybble format, e.g. 0xab is [0x00, 0x00, 0x0a, 0x0b].
+            Values are clipped to 0..255, as ColorRing.put does.
+        """
+        if out is None:
+            out = bytearray(SpdSxPro._COLOR_DATA_LEN)
+        for c in rgb:
+            c = min(255, max(0, int(c)))
+            out[offset + 2] = (c >> 4) & 0xf
+            out[offset + 3] = c & 0xf
+            offset += 4
+        return out
+
+    def format_user_color(self, user_color_index: int, rgb: tuple[int, int, int]):
+        """ The DT1 message setting one of the 5 user colors """
+        msg = bytearray(self.codec.dt1_size(self._COLOR_DATA_LEN))
+        self.color_data(rgb, msg, self.codec.model.data_offset)
+        self.codec.frame_dt1(self.user_color_addrs[user_color_index],
+                             self._COLOR_DATA_LEN, msg)
+        return msg
+
+    def send_user_color(self, user_color_index: int, rgb: tuple[int, int, int],
+                        when: float = None):
+        """ There are 5 user color slots to set. See AbstractMidi.write_sys_ex for `when`. """
+        self.write(self.format_user_color(user_color_index, rgb), when,
+                   key=('user_color', user_color_index))
+
+    def format_palette(self, colors: dict) -> list:
+        """ DT1 messages setting user color i to colors[i], padded the way
+            write_sys_ex would, so they can be kept and sent as they are.
+        """
         out = []
-        for a in args:
-            if isinstance(a, list):
-                out.extend(a)
-            else:
-                out.append(a)
+        for i, rgb in colors.items():
+            msg = self.format_user_color(i, rgb)
+            msg.extend(bytes(-len(msg) % 4))
+            out.append(msg)
         return out
 
-    @staticmethod
-    def _unpack4(arr):
-        n = 0
-        for x in arr:
-            n = (n << 7) + x
-        return n
+    def get_current_kit(self):
+        """ Ask for the current kit. The answer is a DT1; see parse_current_kit. """
+        addr = roland_sysex.unpack4(self._CURRENT_KIT)
+        self.write(self.codec.encode_rq1(addr, self._CURRENT_KIT_SIZE),
+                   priority=PRIORITY_INTERACTIVE)
+
+    def request_identity(self):
+        """ The answer is parsed by roland_sysex.parse_identity_reply """
+        self.write(bytearray(roland_sysex.IDENTITY_REQUEST_MSG), priority=PRIORITY_INTERACTIVE)
+
+    def read_user_color(self, user_color_index: int):
+        """ Ask for a user color. The answer is a DT1; see parse_user_color. """
+        self.write(self.codec.encode_rq1(self.user_color_addrs[user_color_index],
+                                         self._COLOR_DATA_LEN),
+                   priority=PRIORITY_INTERACTIVE)
+
+    def parse_user_color(self, msg):
+        """ (user color index, rgb) if msg is a DT1 of a user color """
+        parsed = self.codec.decode(msg)
+        if parsed is None or parsed[0] != roland_sysex.COMMAND_DT1:
+            return None
+        _, addr, start, end = parsed
+        if addr not in self.user_color_addrs or end - start != self._COLOR_DATA_LEN:
+            return None
+        rgb = tuple((msg[i + 2] << 4) | msg[i + 3] for i in range(start, end, 4))
+        return self.user_color_addrs.index(addr), rgb
+
+    def parse_current_kit(self, msg) -> int:
+        """ The kit number, as shown on the unit, if msg answers get_current_kit """
+        parsed = self.codec.decode(msg)
+        if parsed is None:
+            return None
+        command, addr, start, end = parsed
+        if (command != roland_sysex.COMMAND_DT1 or addr != roland_sysex.unpack4(self._CURRENT_KIT)
+                or end - start != self._CURRENT_KIT_SIZE):
+            return None
+        kit = 0
+        for b in msg[start:end]:
+            kit = (kit << 4) | (b & 0xf)
+        return kit + 1
+
+
+def parse_rgb(color) -> tuple:
+    """ [r, g, b] or "rrggbb" """
+    if isinstance(color, str):
+        n = int(color.lstrip('#'), 16)
+        return ((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff)
+    return tuple(color)
+
+
+class KitPresets:
+    """ User colors per kit, with each kit's DT1 messages encoded at load
+        time so a kit change costs nothing but the writes.
+
+        A presets file maps kit numbers, as shown on the unit, to up to 5
+        user colors; "default" covers any other kit:
+            {"1": ["ff0000", "00ff00"], "12": [[0, 0, 255]], "default": ["ffffff"]}
+    """
+
+    def __init__(self, spd: SpdSxPro, presets: dict):
+        self.colors = {}  # kit => {user color index: rgb}
+        self.messages = {}  # kit => [DT1]
+        for key, colors in presets.items():
+            kit = key if key == 'default' else int(key)
+            self.colors[kit] = {i: parse_rgb(c) for i, c in enumerate(colors[:5])}
+            self.messages[kit] = spd.format_palette(self.colors[kit])
+
+    @classmethod
+    def load(cls, spd: SpdSxPro, path: str):
+        with open(path) as f:
+            return cls(spd, json.load(f))
+
+    def get(self, kit: int):
+        """ (colors, messages) for kit, or None """
+        key = kit if kit in self.colors else 'default'
+        if key not in self.colors:
+            return None
+        return self.colors[key], self.messages[key]
+
+
+class KitTracker:
+    """ Follows the current kit from the SPD-SX PRO's MIDI input: Program
+        Change on the kit control channel, with Bank Select for kits past
+        128, and replies to SpdSxPro.get_current_kit().
+    """
+
+    _STATUS_CONTROL_CHANGE = 0xb0
+    _STATUS_PROGRAM_CHANGE = 0xc0
+    _CC_BANK_MSB = 0
+    _CC_BANK_LSB = 32
+
+    def __init__(self, spd: SpdSxPro, channel: int = 10, on_change=None):
+        self.spd = spd
+        self.channel = channel - 1 if channel else None  # None: any channel
+        self.on_change = on_change  # callable(kit), on the MIDI input thread
+        self.kit = None
+        self.bank_msb = 0
+        self.bank_lsb = 0
+
+    def on_message(self, msg: bytes):
+        status = msg[0]
+        if status == roland_sysex.STATUS_SYSEX:
+            kit = self.spd.parse_current_kit(msg)
+            if kit is None or kit == self.kit:
+                return  # polling; only changes matter
+        elif status < 0xf0 and self.channel in (None, status & 0xf):
+            kind = status & 0xf0
+            if kind == self._STATUS_CONTROL_CHANGE and msg[1] == self._CC_BANK_MSB:
+                self.bank_msb = msg[2]
+                return
+            if kind == self._STATUS_CONTROL_CHANGE and msg[1] == self._CC_BANK_LSB:
+                self.bank_lsb = msg[2]
+                return
+            if kind != self._STATUS_PROGRAM_CHANGE:
+                return
+            # Selecting the same kit again still reapplies its preset.
+            kit = (((self.bank_msb << 7) | self.bank_lsb) << 7) + msg[1] + 1
+        else:
+            return
+        self.kit = kit
+        if self.on_change:
+            self.on_change(kit)
+
+class SinkStats:
+    """ Per-sink counters and a window of recent submit-to-output latencies """
+
+    def __init__(self, window: int = 1024):
+        self.applied = 0
+        self.merged = 0
+        self.errors = 0
+        self.scheduled = 0
+        self.presets = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def summary(self) -> str:
+        out = (f"applied={self.applied} merged={self.merged} errors={self.errors}"
+               f" scheduled={self.scheduled} presets={self.presets}")
+        lat = sorted(self.latencies)
+        if lat:
+            def pct(p):
+                return 1e3 * lat[min(len(lat) - 1, int(len(lat) * p))]
+            out += f" latency_ms(p50={pct(.5):.2f} p95={pct(.95):.2f} max={1e3 * lat[-1]:.2f})"
+        return out
+
+
+class OutputSink:
+    """ One destination for user colors, with its own thread.
+
+        `submit` never blocks: colors land in a latest-wins slot per user
+        color index, and the worker applies whatever is pending at most
+        `max_rate` times per second. A slow sink only coalesces its own
+        updates; it can't hold up the others.
+
+        `schedule` queues colors for a given time instead. Sinks whose
+        device can time output itself set `scheduled_output` and get each
+        frame in apply_at() up to `lead` seconds early; the rest get it
+        through the normal submit path once it's due.
+
+        `preset` is for kit changes: it goes out ahead of everything else,
+        regardless of the rate limit.
+
+        `correction`, a color_pipeline.Correction, is applied to
+        everything on its way out.
+    """
+
+    scheduled_output = False
+
+    def __init__(self, name: str, max_rate: float):
+        self.name = name
+        self.min_interval = 1. / max_rate
+        self.lead = 0.
+        self.cond = threading.Condition()
+        self.pending = {}  # user color index => (rgb, submit time)
+        self.timed = []  # heap of (when, seq, colors dict)
+        self.timed_seq = 0
+        self.presets = []  # (colors dict, payload, t)
+        self.correction = None
+        self.stats = SinkStats()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"sink-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
 
     @staticmethod
-    def _pack_bit_runs(val: int, grouping: int, width: int):
-        """ pack each grouping of bits val into a byte, msn first, producing `width` bytes """
+    def _items(colors):
+        return colors.items() if isinstance(colors, dict) else enumerate(colors)
+
+    def submit(self, colors, t: float = None):
+        """ colors[i] is the rgb for user color i. `colors` is a list of
+            all of them, or a dict holding just the ones that changed.
+        """
+        if t is None:
+            t = time.perf_counter()
+        with self.cond:
+            self._merge(self._items(colors), t)
+            self.cond.notify()
+
+    def _merge(self, items, t: float):
+        for i, rgb in items:
+            if i in self.pending:
+                self.stats.merged += 1
+                t_first = self.pending[i][1]
+            else:
+                t_first = t
+            # Latency counts from the oldest update this write covers.
+            self.pending[i] = (rgb, t_first)
+
+    def schedule(self, colors, when: float):
+        """ Output colors at `when`, on the time.perf_counter() clock """
+        with self.cond:
+            heapq.heappush(self.timed, (when, self.timed_seq, dict(self._items(colors))))
+            self.timed_seq += 1
+            self.cond.notify()
+
+    def preset(self, colors: dict, payload=None):
+        """ Output colors now, replacing whatever is pending for those
+            slots. `payload` is the same colors already encoded for a
+            sink that understands it.
+        """
+        with self.cond:
+            for i in colors:
+                self.pending.pop(i, None)
+            self.presets.append((colors, payload, time.perf_counter()))
+            self.cond.notify()
+
+    def apply(self, colors: dict):
+        """ Output colors, a dict of user color index => rgb """
+        raise NotImplementedError
+
+    def apply_preset(self, colors: dict, payload):
+        self.apply(colors)
+
+    def apply_at(self, colors: dict, when: float):
+        """ Queue colors on the device for output at `when` """
+        raise NotImplementedError
+
+    def _output(self, fn, colors: dict, *args) -> bool:
+        try:
+            if self.correction:
+                colors = self.correction.apply(colors)
+            fn(colors, *args)
+        except Exception as ex:
+            self.stats.errors += 1
+            print(f"{self.name}: exception in output: {ex}")
+            return False
+        return True
+
+    def _run(self):
+        t_next = 0  # earliest start of the next rate-limited write
+        while True:
+            with self.cond:
+                while True:
+                    if not self.running:
+                        return
+                    now = time.perf_counter()
+                    timed_due = self.timed and self.timed[0][0] - self.lead <= now
+                    pending_due = self.pending and t_next <= now
+                    if self.presets or timed_due or pending_due:
+                        break
+                    wake = [self.timed[0][0] - self.lead] if self.timed else []
+                    if self.pending:
+                        wake.append(t_next)
+                    self.cond.wait(min(wake) - now if wake else None)
+                presets, self.presets = self.presets, []
+                timed = []
+                while self.timed and self.timed[0][0] - self.lead <= now:
+                    when, _, colors = heapq.heappop(self.timed)
+                    if self.scheduled_output:
+                        timed.append((when, colors))
+                    else:
+                        self._merge(colors.items(), when)
+                pending = {}
+                if self.pending and t_next <= now:
+                    pending, self.pending = self.pending, {}
+                    # Keep write slots on a fixed grid while busy, so a source
+                    # running at max_rate isn't pushed back a little every write.
+                    t_next = max(t_next, now - self.min_interval) + self.min_interval
+
+            for colors, payload, t in presets:
+                if self.correction:
+                    payload = None  # encoded from the uncorrected colors
+                if self._output(self.apply_preset, colors, payload):
+                    self.stats.presets += 1
+                    self.stats.latencies.append(time.perf_counter() - t)
+            for when, colors in timed:
+                if self._output(self.apply_at, colors, when):
+                    self.stats.scheduled += 1
+            if not pending:
+                continue
+            if self._output(self.apply, {i: rgb for i, (rgb, _) in pending.items()}):
+                now = time.perf_counter()
+                self.stats.applied += 1
+                self.stats.latencies.extend(now - t for _, t in pending.values())
+
+
+class SpdSxProSink (OutputSink):
+    def __init__(self, spd: 'SpdSxPro', max_rate: float = 60):
+        super().__init__("spdsxpro", max_rate)
+        self.spd = spd
+        latency_ms = getattr(spd.midi, 'latency_ms', 0)
+        self.scheduled_output = bool(latency_ms)
+        self.lead = latency_ms / 1e3
+
+    def apply(self, colors: dict):
+        for i, rgb in colors.items():
+            self.spd.send_user_color(i, rgb)
+
+    def apply_at(self, colors: dict, when: float):
+        for i, rgb in colors.items():
+            self.spd.send_user_color(i, rgb, when)
+
+    def apply_preset(self, colors: dict, payload):
+        """ payload: the DT1 messages from SpdSxPro.format_palette """
+        if payload is None:
+            return self.apply(colors)
+        for i, msg in zip(colors, payload):
+            self.spd.write(msg, key=('user_color', i))
+
+
+class WledSink (OutputSink):
+    """ Mirror user colors onto a WLED node via the JSON API.
+        User color i becomes the primary color of segment i.
+    """
+
+    def __init__(self, host: str, max_rate: float = 20, timeout: float = 1.0):
+        super().__init__(f"wled:{host}", max_rate)
+        self.host = host
+        self.timeout = timeout
+        self.conn = None  # kept alive between requests
+
+    def apply(self, colors: dict):
+        doc = {'seg': [{'id': i, 'col': [list(rgb)]} for i, rgb in colors.items()]}
+        body = json.dumps(doc)
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, timeout=self.timeout)
+        try:
+            self.conn.request("POST", "/json/state", body=body,
+                              headers={"Content-Type": "application/json"})
+            self.conn.getresponse().read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            raise
+
+
+class JitterBuffer:
+    """ Plays out timestamped frames at their scheduled times.
+
+        A batched doc carries several frames:
+            {"t0": 1700000000.0,
+             "frames": [{"t": 0.000, "colors": [[255, 0, 0]]},
+                        {"t": 0.016, "colors": [[250, 0, 0]]}, ...]}
+        Each frame is due at t0 + t plus `delay`, which absorbs network
+        jitter. t0 is the producer's Unix time; without it, t counts from
+        when the doc arrived. Frames that would go out more than `late`
+        seconds after they were due are dropped.
+    """
+
+    def __init__(self, delay: float = 0.1, late: float = 0.02, capacity: int = 1024):
+        self.delay = delay
+        self.late = late
+        self.capacity = capacity
+        self.heap = []  # (due, seq, colors), due on the perf_counter clock
+        self.seq = 0
+        self.played = 0
+        self.dropped_late = 0
+        self.dropped_full = 0
+
+    def push(self, doc: dict):
+        """ doc: a frames doc that passed check_doc """
+        # Map producer wall-clock times onto perf_counter once per doc.
+        now = time.perf_counter()
+        if 't0' in doc:
+            offset = now - time.time() + self.delay + doc['t0']
+        else:
+            offset = now + self.delay
+        for frame in doc['frames']:
+            if len(self.heap) >= self.capacity:
+                self.dropped_full += 1
+                continue
+            heapq.heappush(self.heap, (frame['t'] + offset, self.seq, frame['colors']))
+            self.seq += 1
+
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: float, lookahead: float = 0):
+        """ (due, colors) of every frame due by `now + lookahead`, oldest
+            first. Sinks that schedule output ask for frames early.
+        """
         out = []
-        mask = (1 << grouping) - 1
-        for i in range(width):
-            out.append((val >> (grouping * (width - 1 - i))) & mask)
+        while self.heap and self.heap[0][0] <= now + lookahead:
+            due, _, colors = heapq.heappop(self.heap)
+            if now - due > self.late:
+                self.dropped_late += 1
+                continue
+            out.append((due, colors))
+            self.played += 1
         return out
 
-    @staticmethod
-    def pack_nybbles(val: int, width: int):
-        """ pack each nybble of val into a byte, msn first, producing `width` bytes """
-        return SpdSxPro._pack_bit_runs(val, 4, width)
+    def summary(self) -> str:
+        return (f"played={self.played} queued={len(self.heap)} "
+                f"late={self.dropped_late} full={self.dropped_full}")
 
-    @staticmethod
-    def pack4(val: int):
-        return SpdSxPro._pack_bit_runs(val, 7, 4)
 
-    @staticmethod
-    def checksum(arr):
-        sum = 0
-        for b in arr:
-            sum += b
-        return 128 - (sum % 128)
-
-    def _format_dt1_message(self, addr: int, data: bytearray):
-        msg = self._flatten(
-            self._STATUS_SYSEX,
-            self._VENDOR_ID_ROLAND,
-            self.device_id - 1,
-            self._MODEL_SPDSXPRO,
-            self._COMMAND_DT1
-        )
-        payload = []
-        payload.extend(self.pack4(addr))
-        payload.extend(data)
-        msg.extend(payload)
-        msg.append(self.checksum(payload))
-        msg.append(self._STATUS_EOX)
-        return msg
+def _is_number(x) -> bool:
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
 
-    def send_user_color(self, user_color_index: int, rgb: tuple[int, int, int]):
-        """ There are 5 user color slots to set """
-        palette_index = self._USER_PALETTE_INDICES[user_color_index]
+USER_COLORS = 5  # SPD-SX PRO user color slots
 
-        setup_start = self._unpack4(self._SETUP_START)
-        setup_color_table_start = self._unpack4(self._COLOR_TABLE_START)
-        setup_color_table_step = self._unpack4(self._COLOR_TABLE_STEP)
-        setup_color_rgb = self._unpack4(self._COLOR_TABLE_RGB)
 
-        addr = 0
-        addr += setup_start
-        addr += setup_color_table_start
-        addr += palette_index * setup_color_table_step
-        addr += setup_color_rgb
+def _check_colors(colors):
+    """ colors as a list, or as a dict with int keys. Raises ValueError. """
+    if isinstance(colors, dict):
+        # JSON object keys are always strings
+        try:
+            colors = {int(k): v for k, v in colors.items()}
+        except ValueError:
+            raise ValueError('"colors" keys must be user color numbers') from None
+        slots = colors
+    elif isinstance(colors, list):
+        if len(colors) > USER_COLORS:
+            raise ValueError(f'"colors" has {len(colors)} entries, at most {USER_COLORS}')
+        slots = range(len(colors))
+    else:
+        raise ValueError('"colors" must be a list or an object')
+    for i in slots:
+        if not 0 <= i < USER_COLORS:
+            raise ValueError(f"user color {i} isn't in 0..{USER_COLORS - 1}")
+        c = colors[i]
+        if not isinstance(c, list) or len(c) != 3 or not all(map(_is_number, c)):
+            raise ValueError(f"user color {i}: expected three numbers, got {c!r}")
+    return colors
 
-        data = []
-        data.extend(self.pack_nybbles(rgb[0], 4))
-        data.extend(self.pack_nybbles(rgb[1], 4))
-        data.extend(self.pack_nybbles(rgb[2], 4))
 
-        msg = self._format_dt1_message(addr, data)
+def check_doc(doc):
+    """ Raises ValueError unless doc is a colors doc or a frames doc.
+        Object-form "colors" get their keys converted to ints in place.
+    """
+    if not isinstance(doc, dict):
+        raise ValueError(f"expected an object, got {type(doc).__name__}")
+    if 'frames' not in doc:
+        frames = [doc]
+    elif not isinstance(doc['frames'], list):
+        raise ValueError('"frames" must be a list')
+    else:
+        frames = doc['frames']
+        if 't0' in doc and not _is_number(doc['t0']):
+            raise ValueError('"t0" must be a number')
+    for frame in frames:
+        if not isinstance(frame, dict) or 'colors' not in frame:
+            raise ValueError('every frame needs "colors"')
+        if frame is not doc and not _is_number(frame.get('t')):
+            raise ValueError('every frame needs a number "t"')
+        frame['colors'] = _check_colors(frame['colors'])
 
-        self.midi.write_sys_ex(msg)
 
-class App:
-    _FPS = 60
+class Ingest:
+    """ MQTT docs in, colors out through `emit(colors, t, due)`. `due` is
+        set for jitter-buffered frames, `lookahead` seconds before they're
+        due. Runs inside App, or on its own in the --split ingest process.
+    """
 
-    def __init__(self, options):
+    def __init__(self, options, lookahead: float, emit):
         self.queue = queue.SimpleQueue()
         self.mqtt = MqttListener(broker=options.a,
                                  port=options.p,
                                  topic=options.t,
-                                 queue=self.queue)
+                                 queue=self.queue,
+                                 verbose=not options.q)
+        self.verbose = not options.q
+        self.jitter = JitterBuffer(delay=options.jitter_delay, late=options.late)
+        self.lookahead = lookahead
+        self.emit = emit
+        self.errors = 0  # docs dropped as malformed
         self.mqtt.connect()
         self.mqtt.subscribe()
-        midi = AbstractMidi(options.i)
-        self.spd = SpdSxPro(midi, device_id=options.d)
+
+    def start(self):
+        self.mqtt.start()
+
+    def stop(self):
+        self.mqtt.stop()
+
+    def step(self, max_wait: float) -> int:
+        """ Sleep until a message arrives or the next frame is due, then
+            emit everything that's ready. Returns how many were emitted.
+        """
+        emitted = 0
+        timeout = max_wait
+        due = self.jitter.next_due()
+        if due is not None:
+            wake = due - self.lookahead
+            timeout = min(timeout, max(wake - time.perf_counter(), 1e-4))
+        doc = self.mqtt.poll(timeout)
+        # Everything that arrived since the last tick. The sinks
+        # coalesce, so a burst costs one write per slot.
+        while doc is not None:
+            if self.verbose:
+                print(f'doc={doc}')
+            try:
+                check_doc(doc)
+                if 'space' in doc:
+                    import color_pipeline
+                    color_pipeline.convert_doc(doc)
+                if 'frames' in doc:
+                    self.jitter.push(doc)
+                else:
+                    self.emit(doc['colors'], time.perf_counter(), None)
+                    emitted += 1
+            except (ValueError, TypeError) as ex:
+                self._drop(ex)
+            doc = self.mqtt.poll()
+        for due, colors in self.jitter.pop_due(time.perf_counter(), self.lookahead):
+            try:
+                self.emit(colors, time.perf_counter(), due)
+            except (ValueError, TypeError) as ex:
+                self._drop(ex)
+                continue
+            emitted += 1
+        return emitted
+
+    def _drop(self, ex: Exception):
+        # A bad doc mustn't take down ingest, least of all its own process
+        self.errors += 1
+        print(f"ingest: dropped doc: {ex}")
+
+
+def _ingest_main(options, ring_name: str, lookahead: float, doorbell, stop):
+    """ The --split ingest process: MQTT and JSON decoding, feeding the
+        ring that App reads in the output process.
+    """
+    import color_ring
+    ring = color_ring.ColorRing.attach(ring_name, options.ring_size)
+    ingest = Ingest(options, lookahead, lambda colors, t, due: ring.put(colors, t, due))
+    ingest.start()
+    t_stats = time.time() + App._STATS_INTERVAL
+    try:
+        while not stop.is_set():
+            if ingest.step(1. / App._FPS):
+                doorbell.set()
+            if time.time() > t_stats:
+                t_stats += App._STATS_INTERVAL
+                print(f"ingest: received={ingest.mqtt.received} errors={ingest.errors} written={ring.head} "
+                      f"jitter: {ingest.jitter.summary()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ingest.stop()
+        ring.close()
+
+
+class App:
+    _FPS = 60
+    _STATS_INTERVAL = 10
+
+    def __init__(self, options):
+        self.options = options
+        self.running = False
+        midi = _MIDI_BACKENDS[options.b](options.i, latency_ms=options.midi_latency)
+        self.shaper = MidiShaper(midi, bytes_per_s=options.midi_byte_rate)
+        self.spd = SpdSxPro(midi, device_id=options.d, shaper=self.shaper)
+        self.sinks = [SpdSxProSink(self.spd)]
+        for host in options.w:
+            self.sinks.append(WledSink(host, max_rate=options.wled_rate))
+        if options.correct:
+            self._set_corrections(options.correct)
+        # How far ahead of their due time frames go to the sinks
+        self.lookahead = max(sink.lead for sink in self.sinks)
+        self.kit_poll = options.kit_poll
+        self.kit_presets = None
+        self.kits = None
+        if options.presets:
+            self.kit_presets = KitPresets.load(self.spd, options.presets)
+            self.kits = KitTracker(self.spd, options.kit_channel, self._on_kit)
+        self.calibration = options.calibration if os.path.exists(options.calibration) else None
+        # Color sources besides MQTT, each on its own thread
+        self.sources = []
+        if options.audio:
+            import audio_source
+            self.sources.append(audio_source.AudioSource(
+                options.audio, self._emit, block=options.audio_block,
+                rate=options.audio_rate, channels=options.audio_channels))
+        if options.frames:
+            import frame_source
+            self.sources.append(frame_source.FrameSource(
+                options.frames, self._emit, size=options.frame_size, fps=options.frame_rate,
+                threshold=options.frame_threshold, samples=options.frame_samples))
+        self.input_listeners = [self.kits.on_message] if self.kits else []
+        self.input_started = False
+        self.ingest = None
+        self.ring = None
+        if options.split:
+            # Ingest runs in another process, started by run().
+            import color_ring
+            import multiprocessing
+            self.ring = color_ring.ColorRing.create(options.ring_size)
+            self.doorbell = multiprocessing.Event()
+            self.stop_ingest = multiprocessing.Event()
+            self.ingest_process = None
+        else:
+            self.ingest = Ingest(options, self.lookahead, self._emit)
+
+    def _set_corrections(self, specs: list):
+        """ specs: "NAME=GAMMA[:RRGGBB]"; NAME is a sink name, or a prefix
+            of sink names up to a ':', so "wled" covers every WLED host.
+        """
+        import color_pipeline
+        for spec in specs:
+            name, _, value = spec.partition('=')
+            correction = color_pipeline.Correction.parse(value)
+            matched = [sink for sink in self.sinks
+                       if sink.name == name or sink.name.startswith(name + ':')]
+            if not matched:
+                print(f"--correct {spec}: no sink named {name}")
+            for sink in matched:
+                sink.correction = correction
+                print(f"{sink.name}: {correction}")
+
+    def received(self) -> int:
+        """ Color updates received so far """
+        return self.ring.written() if self.ring else self.ingest.mqtt.received
 
     def get_current_kit(self):
-        self.spd.get_current_kit()
+        try:
+            self.spd.get_current_kit()
+        except NoDeviceException as ex:
+            print(f"get_current_kit: {ex}")
+
+    def _on_input(self, msg: bytes):
+        for listener in self.input_listeners:
+            listener(msg)
+
+    def _apply_calibration(self):
+        """ Pace SpdSxPro output to the limits saved for this device """
+        import spdsxpro_calibrate
+        replies = spdsxpro_calibrate.Replies()
+        self.input_listeners.append(replies.on_message)
+        try:
+            identity = spdsxpro_calibrate.probe_identity(self.spd, replies)
+        finally:
+            self.input_listeners.remove(replies.on_message)
+        if identity is None:
+            print("calibration: no Identity Reply, output not paced")
+            return
+        key = spdsxpro_calibrate.identity_key(identity)
+        limits = spdsxpro_calibrate.limits_for(self.calibration, identity)
+        if limits is None:
+            print(f"calibration: {key} not in {self.calibration}, output not paced")
+            return
+        msgs_per_s, bytes_per_s = limits
+        # Never faster than the link itself
+        bytes_per_s = min(bytes_per_s, self.shaper.pacer.bytes_per_s)
+        self.shaper.set_limits(msgs_per_s, bytes_per_s)
+        print(f"calibration: {key}: pacing to {msgs_per_s:g} msgs/s, {bytes_per_s:g} B/s")
+
+    def _on_kit(self, kit: int):
+        print(f"kit: {kit}")
+        preset = self.kit_presets.get(kit)
+        if preset is None:
+            return
+        colors, messages = preset
+        for sink in self.sinks:
+            sink.preset(colors, messages)
+
+    def print_stats(self):
+        for sink in self.sinks:
+            print(f"{sink.name}: {sink.stats.summary()}")
+        print(f"midi: {self.shaper.summary()}")
+        for source in self.sources:
+            print(f"{source.name}: {source.summary()}")
+        if self.ring:
+            print(f"ring: written={self.ring.written()} read={self.ring.tail} "
+                  f"overruns={self.ring.overruns}")
+        else:
+            print(f"ingest: errors={self.ingest.errors}")
+            print(f"jitter: {self.ingest.jitter.summary()}")
+
+    def _emit(self, colors, t: float, due: float):
+        for sink in self.sinks:
+            if due is None:
+                sink.submit(colors, t)
+            else:
+                sink.schedule(colors, due)
+
+    def _start_ingest(self):
+        if self.ingest:
+            self.ingest.start()
+            return
+        import multiprocessing
+        self.ingest_process = multiprocessing.Process(
+            target=_ingest_main, name="ingest", daemon=True,
+            args=(self.options, self.ring.name, self.lookahead, self.doorbell, self.stop_ingest))
+        self.ingest_process.start()
+
+    def _stop_ingest(self):
+        if self.ingest:
+            self.ingest.stop()
+            return
+        self.stop_ingest.set()
+        if self.ingest_process:
+            self.ingest_process.join()
+
+    def _step(self, max_wait: float):
+        if self.ingest:
+            self.ingest.step(max_wait)
+            return
+        if self.doorbell.wait(max_wait):
+            self.doorbell.clear()
+        for colors, t, due in self.ring.read():
+            self._emit(colors, t, due)
+        if not self.ingest_process.is_alive():
+            print(f"ingest process exited ({self.ingest_process.exitcode})")
+            self.running = False
+
+    def stop(self):
+        """ Make run() return. Safe to call from another thread. """
+        self.running = False
 
     def run(self):
-        self.mqtt.start()
-        while True:
-            doc = self.mqtt.poll()
-            if doc is not None:
-                print(f'doc={doc}')
-                arr = doc['colors']
-                for i in range(len(arr)):
-                    try:
-                        self.spd.send_user_color(i, rgb = doc['colors'][i])
-                    except Exception as ex:
-                        print(f"Exception sending color to sample pad: {ex}")
-            time.sleep(1. / self._FPS)
+        self.shaper.start()
+        for sink in self.sinks:
+            sink.start()
+        self._start_ingest()
+        for source in self.sources:
+            source.start()
+        self.running = True
+        t_stats = time.time() + self._STATS_INTERVAL
+        t_kit = None
+        if self.kits or self.calibration:
+            try:
+                self.spd.midi.start_input(self._on_input)
+                self.input_started = True
+            except NoDeviceException as ex:
+                print(f"MIDI input: {ex}")
+        if self.calibration and self.input_started:
+            self._apply_calibration()
+        if self.kits and self.input_started:
+            t_kit = time.time()
+        try:
+            while self.running:
+                self._step(1. / self._FPS)
+                if t_kit is not None and time.time() >= t_kit:
+                    self.get_current_kit()
+                    t_kit = t_kit + self.kit_poll if self.kit_poll else None
+                if time.time() > t_stats:
+                    t_stats += self._STATS_INTERVAL
+                    self.print_stats()
+        finally:
+            if self.input_started:
+                self.spd.midi.stop_input()
+            for source in self.sources:
+                source.stop()
+            self._stop_ingest()
+            for sink in self.sinks:
+                sink.stop()
+            self.shaper.stop()
+            self.print_stats()
+            if self.ring:
+                self.ring.close()
 
-def main():
-    """main"""
+
+def _frame_size(text: str) -> tuple:
+    """ "1920x1080" => (1920, 1080) """
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     for opt, val, type, help in [
         ('-a', 'localhost', str, 'MQTT broker IP'),
@@ -270,10 +1362,80 @@ def main():
         ('-i', "SPD-SX PRO", str, 'MIDI connection name'),
         ('-d', 19, int, 'SPD-SX PRO MIDI device id'),
     ]:
-        parser.add_argument(opt, default=val, help=help)
-    args = parser.parse_args()
+        parser.add_argument(opt, default=val, type=type, help=help)
+    parser.add_argument('-b', default='pygame', choices=list(_MIDI_BACKENDS),
+                        help='MIDI backend')
+    parser.add_argument('--midi-latency', default=0, type=int,
+                        help='PortMidi output latency (ms). Above 0, timed frames '
+                        'are queued on the driver this far ahead and sent on time')
+    parser.add_argument('--midi-byte-rate', default=MidiShaper.MIDI_BYTES_PER_S, type=float,
+                        help='MIDI output budget in bytes/s (31.25 kbaud is 3125)')
+    parser.add_argument('-q', action='store_true',
+                        help="don't log every message")
+    parser.add_argument('--jitter-delay', default=0.1, type=float,
+                        help='playout delay for batched "frames" docs (s)')
+    parser.add_argument('--late', default=0.02, type=float,
+                        help='drop frames more than this late (s)')
+    parser.add_argument('-w', action='append', default=[],
+                        help='WLED host to mirror colors to (repeatable)')
+    parser.add_argument('--wled-rate', default=20, type=float,
+                        help='max WLED updates per second, per host')
+    parser.add_argument('--correct', action='append', default=[],
+                        help='SINK=GAMMA[:RRGGBB]: gamma and white point for a sink '
+                        '(spdsxpro, wled, or wled:HOST; repeatable)')
+    parser.add_argument('--audio',
+                        help="WAV file, or '-' for raw 16-bit PCM on stdin, to derive colors from")
+    parser.add_argument('--audio-block', default=1024, type=int,
+                        help='samples per analysis block; colors lag audio by less than one')
+    parser.add_argument('--audio-rate', default=48000, type=int, help='sample rate of stdin PCM')
+    parser.add_argument('--audio-channels', default=2, type=int, help='channels of stdin PCM')
+    parser.add_argument('--frames', action='append',
+                        help="image file, raw RGB file (.rgb/.raw), or '-' for raw RGB frames "
+                        'on stdin, to take a 5-color palette from (repeatable)')
+    parser.add_argument('--frame-size', type=_frame_size, help='WxH of raw RGB frames')
+    parser.add_argument('--frame-rate', default=30, type=float,
+                        help='frames per second from files; stdin sets its own pace')
+    parser.add_argument('--frame-threshold', default=8, type=float,
+                        help='only send a palette color that moved more than this (0-255)')
+    parser.add_argument('--frame-samples', default=4096, type=int,
+                        help='pixels per frame to fit the palette to')
+    parser.add_argument('--split', action='store_true',
+                        help='run MQTT ingest in its own process, feeding output through shared memory')
+    parser.add_argument('--ring-size', default=256, type=int,
+                        help='records in the --split shared memory ring')
+    parser.add_argument('--presets',
+                        help='JSON file of user colors per kit, applied on kit change')
+    parser.add_argument('--kit-channel', default=10, type=int,
+                        help='MIDI channel of kit Program Changes (0: any)')
+    parser.add_argument('--kit-poll', default=0, type=float,
+                        help='also read the current kit every this many seconds (0: at startup only)')
+    parser.add_argument('--calibration', default='spdsxpro_calibration.json',
+                        help='pace output to the limits spdsxpro_calibrate.py saved here')
+    parser.add_argument('--profile', action='store_true',
+                        help='start the sampling profiler now (SIGUSR1 toggles it)')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='start allocation tracing now (SIGUSR2 writes a diff)')
+    parser.add_argument('--profile-dir', default='.',
+                        help='where profiles and allocation diffs are written')
+    return parser.parse_args(argv)
+
+
+def main():
+    """main"""
+    args = parse_args()
     print(str(args))
-    App(args).run()
+
+    import controller_profiling
+    profiling = controller_profiling.Profiling(args.profile_dir)
+    profiling.install()
+    if args.profile:
+        profiling.toggle_profiler()
+    if args.tracemalloc:
+        profiling.allocation_diff()
+    try:
+        App(args).run()
+    finally:
+        profiling.shutdown()
 
 if __name__ == '__main__':
     main()
@@ -3,6 +3,7 @@
 from websockets.server import serve
 import queue
 import random
+import threading
 import time
 import os
 import sys
@@ -12,7 +13,10 @@ import pygame.midi
 import mido
 from pygame.locals import *
 import pygame
+import numpy
 import asyncio
+import color_pipeline
+import roland_sysex
 from os import environ
 environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"  # so lame
 
@@ -31,44 +35,73 @@ class NoDeviceException (Exception):
 
 
 class ColorPicker:
+    # Rendered gradients, keyed by (w, h). Shared by every picker of that size.
+    _gradient_cache = {}
+
     def __init__(self, x, y, w, h):
         self.rect = pygame.Rect(x, y, w, h)
-        self.image = pygame.Surface((w, h))
-        self.image.fill((255, 255, 255))
         self.rad = h//2
         self.pwidth = w-self.rad*2
-        for i in range(self.pwidth):
-            color = pygame.Color(0)
-            color.hsla = (int(360*i/self.pwidth), 100, 50, 100)
-            pygame.draw.rect(self.image, color,
-                             (i+self.rad, h//3, 1, h-2*h//3))
+        self.image, self.hues = self._gradient(w, h, self.rad, self.pwidth)
         self.p = 0
+        self.dragging = False
 
-    def get_color(self):
-        color = pygame.Color(0)
-        color.hsla = (int(self.p * self.pwidth), 100, 50, 100)
-        return color
+    @classmethod
+    def _gradient(cls, w, h, rad, pwidth):
+        """ Render the hue bar in one vectorized pass and cache it.
+
+            Returns the surface and the (pwidth, 3) array of column colors,
+            which doubles as the lookup table for get_color.
+        """
+        key = (w, h)
+        if key not in cls._gradient_cache:
+            # HSL with s=100%, l=50% is the pure hue.
+            hues = (color_pipeline.hue_table(pwidth) * 255.0 + 0.5).astype(numpy.uint8)
+
+            pixels = numpy.full((w, h, 3), 255, dtype=numpy.uint8)
+            pixels[rad:rad + pwidth, h//3:h - h//3] = hues[:, None, :]
+            cls._gradient_cache[key] = (pygame.surfarray.make_surface(pixels),
+                                        hues)
+        return cls._gradient_cache[key]
 
-    def update(self):
-        moude_buttons = pygame.mouse.get_pressed()
-        mouse_pos = pygame.mouse.get_pos()
-        if moude_buttons[0] and self.rect.collidepoint(mouse_pos):
-            self.p = (mouse_pos[0] - self.rect.left - self.rad) / self.pwidth
-            self.p = (max(0, min(self.p, 1)))
+    def get_color(self):
+        r, g, b = self.hues[min(int(self.p * self.pwidth), self.pwidth - 1)]
+        return pygame.Color(int(r), int(g), int(b))
+
+    def handle_event(self, event) -> bool:
+        """ Track drags from mouse events. Returns True if `p` moved. """
+        if event.type == MOUSEBUTTONDOWN and event.button == 1:
+            self.dragging = self.rect.collidepoint(event.pos)
+        elif event.type == MOUSEBUTTONUP and event.button == 1:
+            self.dragging = False
+        elif event.type != MOUSEMOTION:
+            return False
+        if not self.dragging or not self.rect.collidepoint(event.pos):
+            return False
+        p = (event.pos[0] - self.rect.left - self.rad) / self.pwidth
+        p = max(0, min(p, 1))
+        if p == self.p:
+            return False
+        self.p = p
+        return True
 
     def draw(self, surf):
+        """ Returns the dirty rect """
         surf.blit(self.image, self.rect)
         center = self.rect.left + self.rad + self.p * self.pwidth, self.rect.centery
         pygame.draw.circle(surf, self.get_color(),
                            center, self.rect.height // 2)
+        return self.rect
 
 
 class MqttListener:
-    def __init__(self, broker: str, port: int, topic: str, queue: queue.SimpleQueue):
+    def __init__(self, broker: str, port: int, topic: str, queue: queue.SimpleQueue,
+                 notify=None):
         self.broker = broker
         self.port = port
         self.topic = topic
         self.queue = queue
+        self.notify = notify  # called from the MQTT thread after each put
         self.client_id = f'python-mqtt-{random.randint(0, 1000)}'
         self.client = None  # need to connect
 
@@ -103,6 +136,8 @@ class MqttListener:
 
     def _publish(self, obj: tuple[int, int, int]):
         self.queue.put(obj)
+        if self.notify:
+            self.notify()
 
     def poll(self) -> tuple[int, int, int]:
         try:
@@ -119,9 +154,6 @@ class MyMidi:
 class SpdSxPro:
     _device_name = "SPD-SX PRO"
 
-    # confusing docs.. which is it?
-    _MODEL_SPDSXPRO = [0x00, 0x00, 0x00, 0x00, 0x16]
-
     _STATUS_SYSEX = 0xf0
     _STATUS_EOX = 0xf7
     _STATUS_NON_REALTIME = 0x7e
@@ -129,10 +161,6 @@ class SpdSxPro:
     _STATUS_TIMING_CLOCK = 0xf8
     _STATUS_PROGRAM_CHANGE = 0xc9
 
-    _COMMAND_RQ1 = 0x11
-    _COMMAND_DT1 = 0x12
-
-    _VENDOR_ID_ROLAND = 0x41
     _RESET_PER_COMMAND = True
     # _RESET_PER_COMMAND = False
 
@@ -155,84 +183,20 @@ class SpdSxPro:
         self.devices = None
         self.midi_input = None
         self.midi_output = None
+        self.on_input = None  # callable(data: list, parsed: dict or None)
         pygame.midi.init()
 
     def done(self):
         return self.identity is not None
 
-    @staticmethod
-    def flatten(*args):
-        out = []
-        for a in args:
-            if isinstance(a, list):
-                out.extend(a)
-            else:
-                out.append(a)
-        return out
-
-    @staticmethod
-    def unpack4(arr):
-        n = 0
-        for x in arr:
-            n = (n << 7) + x
-        return n
-
-    @staticmethod
-    def pack_bit_runs(val: int, grouping: int, width: int):
-        """ pack each grouping of bits val into a byte, msn first, producing `width` bytes """
-        out = []
-        mask = (1 << grouping) - 1
-        for i in range(width):
-            out.append((val >> (grouping * (width - 1 - i))) & mask)
-        return out
-
-    @staticmethod
-    def pack_nybbles(val: int, width: int):
-        """ pack each nybble of val into a byte, msn first, producing `width` bytes """
-        return SpdSxPro.pack_bit_runs(val, 4, width)
-
-    @staticmethod
-    def pack4(val: int):
-        return SpdSxPro.pack_bit_runs(val, 7, 4)
-
-    @staticmethod
-    def checksum(arr):
-        sum = 0
-        for b in arr:
-            sum += b
-        return 128 - (sum % 128)
+    def _codec(self):
+        return roland_sysex.Codec('spdsxpro', self.identity['dev'])
 
     def format_rq1_message(self, addr: int, size: int):
-        msg = self.flatten(
-            self._STATUS_SYSEX,
-            self._VENDOR_ID_ROLAND,
-            self.identity['dev'],
-            self._MODEL_SPDSXPRO,
-            self._COMMAND_RQ1
-        )
-        payload = []
-        payload.extend(self.pack4(addr))
-        payload.extend(self.pack4(size))
-        msg.extend(payload)
-        msg.append(self.checksum(payload))
-        msg.append(self._STATUS_EOX)
-        return msg
+        return self._codec().encode_rq1(addr, size)
 
     def format_dt1_message(self, addr: int, data: bytearray):
-        msg = self.flatten(
-            self._STATUS_SYSEX,
-            self._VENDOR_ID_ROLAND,
-            self.identity['dev'],
-            self._MODEL_SPDSXPRO,
-            self._COMMAND_DT1
-        )
-        payload = []
-        payload.extend(self.pack4(addr))
-        payload.extend(data)
-        msg.extend(payload)
-        msg.append(self.checksum(payload))
-        msg.append(self._STATUS_EOX)
-        return msg
+        return self._codec().encode_dt1(addr, data)
 
     def find_devices(self, name: str):
         """Find the TD-50X devices"""
@@ -328,14 +292,14 @@ class SpdSxPro:
         self.midi_output.write_sys_ex(0, msg)
 
     def send_dt1_poke(self, addr: int, data: bytearray):
-        addr_buf = self.pack4(addr)
+        addr_buf = roland_sysex.pack4(addr)
         _printSync(
             f"send_dt1_poke(addr={_stringify(addr_buf)}, data={_stringify(data)})")
         msg = self.format_dt1_message(addr, data)
         self.write_sysex(msg)
 
     def get_current_kit(self):
-        addr = self.unpack4([0x00, 0x00, 0x00, 0x00])
+        addr = roland_sysex.unpack4([0x00, 0x00, 0x00, 0x00])
         msg = self.format_rq1_message(addr, 4)
         self.write_sysex(msg)
 
@@ -358,10 +322,10 @@ class SpdSxPro:
         ###
 
         # address layout constants derived from the above spec
-        setup_start = self.unpack4([0x01, 0x00, 0x00, 0x00])
-        setup_color_table_start = self.unpack4([0x08, 0x00])
-        setup_color_table_step = self.unpack4([0x01, 0x00])
-        setup_color_rgb = self.unpack4([0x10])
+        setup_start = roland_sysex.unpack4([0x01, 0x00, 0x00, 0x00])
+        setup_color_table_start = roland_sysex.unpack4([0x08, 0x00])
+        setup_color_table_step = roland_sysex.unpack4([0x01, 0x00])
+        setup_color_rgb = roland_sysex.unpack4([0x10])
 
         color_id = [10, 11, 12, 13, 14][idx]  # choose from user color ids
 
@@ -371,9 +335,9 @@ class SpdSxPro:
             color_id * setup_color_table_step + setup_color_rgb
 
         data = []
-        data.extend(self.pack_nybbles(rgb[0], 4))
-        data.extend(self.pack_nybbles(rgb[1], 4))
-        data.extend(self.pack_nybbles(rgb[2], 4))
+        data.extend(roland_sysex.pack_nybbles(rgb[0], 4))
+        data.extend(roland_sysex.pack_nybbles(rgb[1], 4))
+        data.extend(roland_sysex.pack_nybbles(rgb[2], 4))
 
         colorHex = '(' + ','.join([f'{x:02x}' for x in rgb]) + ')'
         _printSync(f"Set color {color_id} to {colorHex}")
@@ -402,19 +366,169 @@ class SpdSxPro:
 
         for event in pygame.midi.Input.read(self.midi_input, 16):
             data, _ = event
+            if data[0] >= self._STATUS_TIMING_CLOCK:
+                # Realtime (clock, active sensing, ...) comes in an event of
+                # its own, many times a second; nothing here wants it.
+                continue
             _printSync(f'in: {_stringify(data)}')
+            parsed = None
             if self.sysex_response_buffer is not None:
                 self.sysex_response_buffer.extend(data)
                 if self._STATUS_EOX in data:
                     # Full sysex packet
-                    self.parse_sysex(self.sysex_response_buffer)
+                    parsed = self.parse_sysex(self.sysex_response_buffer)
                     self.sysex_response_buffer = None
                     # self.reconnect_midi()
+            if self.on_input:
+                self.on_input(data, parsed)
         return True
 
 
+class MidiWorker:
+    """ Owns the SpdSxPro and does all of its device I/O on a background thread.
+
+        Colors go into a latest-wins mailbox with one entry per user color
+        slot, so a burst of picker drags collapses into one write per slot.
+        MIDI input is reported back to the GUI thread as pygame events.
+    """
+
+    # Posted to the pygame event queue. Attributes: data, parsed.
+    MIDI_INPUT_EVENT = pygame.USEREVENT + 2
+    # Posted when device availability changes. Attributes: error (or None).
+    MIDI_STATUS_EVENT = pygame.USEREVENT + 3
+
+    # How often to poll MIDI input when there is nothing to send.
+    _POLL_INTERVAL = 0.01
+    # Backoff for retrying a missing device.
+    _RETRY_MIN = 0.5
+    _RETRY_MAX = 5.0
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.colors = {}  # user color index => rgb; latest wins
+        self.commands = []  # one-shot SpdSxPro method names
+        self.running = False
+        self.thread = None
+        self.spd = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(
+            target=self._run, name="midi-worker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+
+    def set_user_color(self, idx: int, rgb: tuple[int, int, int]):
+        with self.cond:
+            self.colors[idx] = rgb
+            self.cond.notify()
+
+    def get_current_kit(self):
+        self._command('get_current_kit')
+
+    def resetIdentity(self):
+        self._command('resetIdentity')
+
+    def _command(self, name: str):
+        with self.cond:
+            self.commands.append(name)
+            self.cond.notify()
+
+    @staticmethod
+    def _post(event_type, **attrs):
+        pygame.event.post(pygame.event.Event(event_type, **attrs))
+
+    def _on_input(self, data, parsed):
+        self._post(self.MIDI_INPUT_EVENT, data=data, parsed=parsed)
+
+    def _connect(self):
+        """ Returns True when the device is open """
+        if self.spd is not None and self.spd.midi_input is not None:
+            return True
+        try:
+            if self.spd is None:
+                self.spd = SpdSxPro()
+                self.spd.on_input = self._on_input
+            self.spd.init_devices()
+        except NoDeviceException as ex:
+            self._post(self.MIDI_STATUS_EVENT, error=str(ex))
+            return False
+        except Exception as ex:
+            # e.g. PortMidi failing to open a device that's going away
+            _printSync(f"midi-worker: connect failed: {ex!r}")
+            self._post(self.MIDI_STATUS_EVENT, error=str(ex))
+            return False
+        self._post(self.MIDI_STATUS_EVENT, error=None)
+        return True
+
+    def _requeue(self, colors: dict, commands: list, delay: float):
+        """ Put back what wasn't sent, under anything newer, and wait """
+        with self.cond:
+            colors.update(self.colors)
+            self.colors = colors
+            self.commands[:0] = commands
+            if self.running:
+                self.cond.wait(delay)
+
+    def _run(self):
+        retry = self._RETRY_MIN
+        while True:
+            with self.cond:
+                if self.running and not self.colors and not self.commands:
+                    self.cond.wait(self._POLL_INTERVAL)
+                if not self.running:
+                    break
+                colors, self.colors = self.colors, {}
+                commands, self.commands = self.commands, []
+
+            if not self._connect():
+                # Keep only the newest colors; they'll go out on reconnect.
+                self._requeue(colors, commands, retry)
+                retry = min(retry * 2, self._RETRY_MAX)
+                continue
+
+            try:
+                # Drop each item only once it's gone out
+                while commands:
+                    getattr(self.spd, commands[0])()
+                    commands.pop(0)
+                for idx in list(colors):
+                    self.spd.set_user_color(idx, colors[idx])
+                    del colors[idx]
+                self.spd.loop()
+            except Exception as ex:
+                # Anything here leaves the device in an unknown state:
+                # reopen it, after a backoff so a persistent fault can't spin.
+                _printSync(f"midi-worker: {ex!r}")
+                midi_input, self.spd.midi_input = self.spd.midi_input, None
+                if midi_input is not None:
+                    try:
+                        midi_input.close()
+                    except Exception as close_ex:
+                        _printSync(f"midi-worker: closing input: {close_ex!r}")
+                self._post(self.MIDI_STATUS_EVENT, error=str(ex))
+                self._requeue(colors, commands, retry)
+                retry = min(retry * 2, self._RETRY_MAX)
+                continue
+            retry = self._RETRY_MIN
+
+        if pygame.midi.get_init():
+            pygame.midi.quit()
+
+
 class SpdSxProGui:
     _FPS = 60
+    # How long to block in pygame.event.wait when nothing is happening.
+    _IDLE_TIMEOUT_MS = 100
+
+    # Posted from the MQTT thread to wake the render loop.
+    _MQTT_EVENT = pygame.USEREVENT + 1
 
     _KEY_COLORS = {
         '0': (0x00, 0x00, 0x00),  # black
@@ -437,33 +551,37 @@ class SpdSxProGui:
 
         print("MQTT starting")
         self.mqtt = MqttListener(
-            "localhost", 1883, "spdsxpro/color/1", self.queue)
+            "localhost", 1883, "spdsxpro/color/1", self.queue,
+            notify=lambda: pygame.event.post(pygame.event.Event(self._MQTT_EVENT)))
         self.mqtt.connect()
         self.mqtt.subscribe()
         print("MQTT connected")
 
-        self.spd = SpdSxPro()
+        self.spd = MidiWorker()
         self.user_colors = ['0', '0', '0', '0', '0']
 
-        try:
-            self.spd.init_devices()
-        except NoDeviceException as ex:
-            _printSync(ex)
-            sys.exit(1)
-
         self.running = True
         self.screen = pygame.display.set_mode((640, 480))
 
         self.picker = ColorPicker(50, 50, 400, 60)
         self.known_picker_color = None
+        self.picker_dirty = True
+        self.dot_dirty = True
         pygame.display.set_caption('SPD-SX PRO midi control')
 
     def draw(self):
-        pos = pygame.Vector2(self.screen.get_width(), self.screen.get_height())
-        pos = pos / 2
-        dotColor = self.rgb[0]
-        self.picker.draw(self.screen)
-        pygame.draw.circle(self.screen, dotColor, pos, 40)
+        """ Redraw only what changed. Returns the list of dirty rects. """
+        dirty = []
+        if self.picker_dirty:
+            dirty.append(self.picker.draw(self.screen))
+            self.picker_dirty = False
+        if self.dot_dirty:
+            pos = pygame.Vector2(self.screen.get_width(), self.screen.get_height())
+            pos = pos / 2
+            dotColor = self.rgb[0]
+            dirty.append(pygame.draw.circle(self.screen, dotColor, pos, 40))
+            self.dot_dirty = False
+        return dirty
 
     def _set_user_color_key(self, user_color_index: int, key: str):
         if key not in self._KEY_COLORS:
@@ -476,14 +594,14 @@ class SpdSxProGui:
             user_color_index [0,4] which user color to adjust
         """
         self.rgb[user_color_index] = rgb
+        self.dot_dirty = True
         print(f'self.rgb={self.rgb}')
         self.spd.set_user_color(user_color_index, self.rgb[user_color_index])
 
     def stop(self):
         self.running = False
         self.mqtt.stop()
-        if pygame.midi.get_init():
-            pygame.midi.quit()
+        self.spd.stop()
         pygame.quit()
         raise SystemExit
 
@@ -501,43 +619,66 @@ class SpdSxProGui:
             return
         print(f"New color: {new_color}")
         self._set_user_color(0, new_color)
-        self.draw()
+
+    def handle_event(self, event):
+        if event.type == pygame.QUIT:
+            self.stop()
+        if event.type == KEYDOWN:
+            try:
+                key = chr(event.key)
+            except ValueError:
+                return
+            if key == 'q':
+                self.stop()
+            if key == 'k':
+                self.get_current_kit()
+            if key == 'i':
+                self.spd.resetIdentity()
+            else:
+                # TODO support more color indexes
+                user_color_idx = 0
+                self._set_user_color_key(user_color_idx, key)
+        if event.type == self._MQTT_EVENT:
+            self.pollMqtt()
+        if event.type == MidiWorker.MIDI_INPUT_EVENT:
+            if event.parsed is not None:
+                _printSync(f'midi: {event.parsed}')
+        if event.type == MidiWorker.MIDI_STATUS_EVENT:
+            if event.error is not None:
+                _printSync(f'midi: {event.error}')
+            else:
+                _printSync('midi: device connected')
+        if self.picker.handle_event(event):
+            self.picker_dirty = True
 
     def run(self):
         self.mqtt.start()
+        self.spd.start()
+
+        self.screen.fill((0, 0, 0))
+        self.draw()
+        pygame.display.flip()
 
         _printSync('Press # keys for colors')
         while self.running:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.stop()
-                if event.type == KEYDOWN:
-                    try:
-                        key = chr(event.key)
-                    except ValueError:
-                        continue
-                    if key == 'q':
-                        self.stop()
-                    if key == 'k':
-                        self.get_current_kit()
-                    if key == 'i':
-                        self.spd.resetIdentity()
-                    else:
-                        # TODO support more color indexes
-                        user_color_idx = 0
-                        self._set_user_color_key(user_color_idx, key)
-            self.spd.loop()
-
-            self.picker.update()
+            # Sleep until there is input. MIDI is polled by the worker.
+            event = pygame.event.wait(self._IDLE_TIMEOUT_MS)
+            if event.type != pygame.NOEVENT:
+                self.handle_event(event)
+                for event in pygame.event.get():
+                    self.handle_event(event)
+
             picker_color = self.picker.get_color()
             if self.known_picker_color is None or picker_color != self.known_picker_color:
                 self.known_picker_color = picker_color
                 print(f"picker_color change: {picker_color}")
                 self._set_user_color(0, (picker_color[0], picker_color[1], picker_color[2]))
-            self.pollMqtt()
-            self.draw()
-            pygame.display.flip()
-            dt = self.clock.tick(self._FPS) / 1000  # convert msec to sec
+
+            dirty = self.draw()
+            if dirty:
+                pygame.display.update(dirty)
+                # Cap the frame rate while dragging; idle frames cost nothing.
+                self.clock.tick(self._FPS)
 
 
 SpdSxProGui().run()
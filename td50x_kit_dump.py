@@ -0,0 +1,339 @@
+"""Back up every TD-50X kit's parameters to one file.
+
+Reads each kit's parameter block with RQ1s of at most --chunk bytes, with
+--window of them in flight, and copies each DT1 reply's payload straight
+into a preallocated, memory-mapped dump file. The file records which
+chunks have arrived, so an interrupted dump picks up where it stopped:
+
+    $ python3 td50x_kit_dump.py kits.dump            # all 100 kits
+    $ python3 td50x_kit_dump.py kits.dump            # again, to resume
+    $ python3 td50x_kit_dump.py kits.dump --show 5   # print a kit's name
+    $ python3 td50x_kit_dump.py names.dump --block 0000:1b
+    $ python3 td50x_kit_dump.py -b sim /tmp/kits.dump
+
+There's no published map of which addresses in a kit hold parameters,
+so by default each kit's whole range is swept: 2 << 14 addresses from
+(4 << 21) + kit * (2 << 14), 256 RQ1s of 128 bytes per kit. --block
+reads only the given blocks instead.
+
+Roland devices don't answer reads of unmapped addresses, so the sweep
+has to be cheap where nothing answers:
+  - A chunk times out --timeout (0.1 s) after the later of its RQ1 and
+    the last reply. A timeout that short is still safe while a slow
+    link is busy streaming earlier replies.
+  - Once --skip-after (2) chunks in a --span (0x800 addresses) have
+    timed out and none in it has answered, the rest of the span is
+    marked missing without being asked for.
+  - Missing chunks are recorded in the file, so a resumed dump doesn't
+    ask again unless --retry-missing is given.
+
+Expected runtime for all 100 kits: each unmapped span costs about one
+timeout, 1600 spans, so at most about 3 minutes. Mapped data arrives at
+the link's rate. USB MIDI takes seconds per megabyte. A 31250-baud DIN
+link runs at about 3 kB/s, so every mapped kilobyte there costs about
+a third of a second.
+
+File layout, all little-endian:
+    0   magic "TD50XDMP", version, kits, chunk size, block count (u32s)
+    28  blocks: (address offset in kit, size) u32 pairs
+    ... chunk states, one byte each: 0 to do, 1 done, 2 missing
+    ... data, page aligned: kits * (sum of block sizes) bytes, kit major
+"""
+
+import argparse
+import mmap
+import os
+import queue
+import struct
+import time
+
+import roland_sysex
+from spdsxpro_controller import _MIDI_BACKENDS
+
+_DEVICE_ID = 0x10
+_CODEC = roland_sysex.Codec('td50x', _DEVICE_ID)
+
+KIT_COUNT = 100
+KIT_START = 4 << 21
+KIT_STEP = 2 << 14
+KIT_NAME_LEN = 12
+
+_MAGIC = b'TD50XDMP'
+_VERSION = 1
+_HEADER = struct.Struct('<8sIIII')
+_BLOCK = struct.Struct('<II')
+
+CHUNK_TODO = 0
+CHUNK_DONE = 1
+CHUNK_MISSING = 2
+
+
+class KitDump:
+    """ The dump file, and where each chunk of each kit lives in it """
+
+    def __init__(self, path: str, blocks: list, kits: int = KIT_COUNT, chunk: int = 128):
+        self.path = path
+        self.blocks = blocks  # [(address offset in kit, size)]
+        self.kits = kits
+        self.chunk = chunk
+        # Per kit: chunk numbers and data offsets where each block starts
+        self.block_chunks = []
+        self.block_data = []
+        n = 0
+        data = 0
+        for _, size in blocks:
+            self.block_chunks.append(n)
+            self.block_data.append(data)
+            n += -(-size // chunk)
+            data += size
+        self.chunks_per_kit = n
+        self.kit_bytes = data
+        self.states_offset = _HEADER.size + len(blocks) * _BLOCK.size
+        self.data_offset = -(-(self.states_offset + self.chunk_count()) // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.size = self.data_offset + kits * self.kit_bytes
+        self.file = None
+        self.mm = None
+
+    def chunk_count(self) -> int:
+        return self.kits * self.chunks_per_kit
+
+    def _header(self) -> bytes:
+        out = _HEADER.pack(_MAGIC, _VERSION, self.kits, self.chunk, len(self.blocks))
+        return out + b''.join(_BLOCK.pack(*block) for block in self.blocks)
+
+    def open(self, fresh: bool = False):
+        """ Open or create the file. An existing dump with the same layout is resumed. """
+        header = self._header()
+        resume = False
+        if not fresh and os.path.exists(self.path) and os.path.getsize(self.path) == self.size:
+            with open(self.path, 'rb') as f:
+                resume = f.read(len(header)) == header
+        self.file = open(self.path, 'r+b' if resume else 'w+b')
+        if not resume:
+            self.file.truncate(self.size)
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+        if not resume:
+            self.mm[:len(header)] = header
+        return resume
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+    def state(self, n: int) -> int:
+        return self.mm[self.states_offset + n]
+
+    def set_state(self, n: int, state: int):
+        self.mm[self.states_offset + n] = state
+
+    def locate(self, n: int):
+        """ (address, size, data offset) of chunk n """
+        kit, c = divmod(n, self.chunks_per_kit)
+        b = len(self.block_chunks) - 1
+        while self.block_chunks[b] > c:
+            b -= 1
+        offset = (c - self.block_chunks[b]) * self.chunk
+        addr_offset, size = self.blocks[b]
+        return (KIT_START + kit * KIT_STEP + addr_offset + offset,
+                min(self.chunk, size - offset),
+                self.data_offset + kit * self.kit_bytes + self.block_data[b] + offset)
+
+    def chunk_at(self, addr: int):
+        """ (chunk number, byte offset in it) holding address addr, or None """
+        kit, addr_offset = divmod(addr - KIT_START, KIT_STEP)
+        if addr < KIT_START or kit >= self.kits:
+            return None
+        for b, (start, size) in enumerate(self.blocks):
+            if start <= addr_offset < start + size:
+                c, offset = divmod(addr_offset - start, self.chunk)
+                return kit * self.chunks_per_kit + self.block_chunks[b] + c, offset
+        return None
+
+    def kit_data(self, kit: int) -> memoryview:
+        """ Kit's bytes (kit counts from 1), blocks back to back """
+        start = self.data_offset + (kit - 1) * self.kit_bytes
+        return memoryview(self.mm)[start:start + self.kit_bytes]
+
+
+class Dumper:
+    """ Keeps `window` RQ1s in flight until every chunk is done or missing """
+
+    def __init__(self, midi, dump: KitDump, window: int = 8, timeout: float = 0.1,
+                 retries: int = 0, span: int = 0x800, skip_after: int = 2):
+        self.midi = midi
+        self.dump = dump
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.span = span
+        self.skip_after = skip_after  # 0 asks for every chunk
+        self.replies = queue.SimpleQueue()
+        self.in_flight = {}  # chunk => [time sent, bytes received]
+        self.tries = {}  # chunk => attempts, only for chunks that timed out
+        self.t_reply = 0.  # when the last reply arrived
+        self.span_misses = {}  # span => chunks in it that timed out
+        self.span_hits = set()  # spans with at least one chunk done
+        self.bytes_in = 0
+        self.done = 0
+        self.missing = 0
+        self.skipped = 0  # of missing, never asked for
+
+    def on_message(self, msg: bytes):
+        self.replies.put(msg)
+
+    def _send(self, n: int):
+        addr, size, _ = self.dump.locate(n)
+        self.midi.write_sys_ex(_CODEC.encode_rq1(addr, size))
+        self.in_flight[n] = [time.perf_counter(), 0]
+
+    def _reply(self, msg: bytes):
+        parsed = _CODEC.decode(msg)
+        if parsed is None or parsed[0] != roland_sysex.COMMAND_DT1:
+            return
+        _, addr, start, end = parsed
+        where = self.dump.chunk_at(addr)
+        if where is None:
+            return
+        n, offset = where
+        self.t_reply = time.perf_counter()
+        sent = self.in_flight.get(n)
+        if sent is None:
+            return  # late reply to a retried or finished chunk
+        _, size, data_offset = self.dump.locate(n)
+        length = min(end - start, size - offset)
+        # Straight from the MIDI message into the file
+        self.dump.mm[data_offset + offset:data_offset + offset + length] = \
+            memoryview(msg)[start:start + length]
+        self.bytes_in += length
+        # A chunk longer than the device's replies comes in several DT1s.
+        sent[1] += length
+        if sent[1] >= size:
+            del self.in_flight[n]
+            self.dump.set_state(n, CHUNK_DONE)
+            self.done += 1
+            self.span_hits.add(addr // self.span)
+
+    def _skip(self, n: int) -> bool:
+        """ Marks chunk n missing, unasked, if its span looks unmapped """
+        if not self.skip_after:
+            return False
+        span = self.dump.locate(n)[0] // self.span
+        if span in self.span_hits or self.span_misses.get(span, 0) < self.skip_after:
+            return False
+        self.dump.set_state(n, CHUNK_MISSING)
+        self.missing += 1
+        self.skipped += 1
+        return True
+
+    def run(self, retry_missing: bool = False, progress: float = 1.0):
+        dump = self.dump
+        todo = (n for n in range(dump.chunk_count())
+                if dump.state(n) == CHUNK_TODO or (retry_missing and dump.state(n) == CHUNK_MISSING))
+        retry = []
+        t0 = time.perf_counter()
+        t_progress = t0 + progress
+        exhausted = False
+        while True:
+            while len(self.in_flight) < self.window:
+                if retry:
+                    self._send(retry.pop())
+                    continue
+                n = next(todo, None)
+                if n is None:
+                    exhausted = True
+                    break
+                if not self._skip(n):
+                    self._send(n)
+            if exhausted and not self.in_flight and not retry:
+                break
+            try:
+                self._reply(self.replies.get(timeout=self.timeout / 4))
+                while True:
+                    self._reply(self.replies.get(block=False))
+            except queue.Empty:
+                pass
+            now = time.perf_counter()
+            for n, (t, _) in list(self.in_flight.items()):
+                # Replies come in order; don't give up on a chunk while
+                # the ones before it are still arriving.
+                if now - max(t, self.t_reply) < self.timeout:
+                    continue
+                del self.in_flight[n]
+                self.tries[n] = self.tries.get(n, 0) + 1
+                if self.tries[n] > self.retries:
+                    dump.set_state(n, CHUNK_MISSING)
+                    self.missing += 1
+                    span = dump.locate(n)[0] // self.span
+                    self.span_misses[span] = self.span_misses.get(span, 0) + 1
+                else:
+                    retry.append(n)
+            if now > t_progress:
+                t_progress += progress
+                print(f"{self.done + self.missing} chunks, {self.bytes_in / (now - t0):.0f} B/s, "
+                      f"{self.missing} missing ({self.skipped} skipped)")
+                dump.mm.flush()
+        return time.perf_counter() - t0
+
+
+def parse_block(text: str):
+    """ "OFFSET:SIZE", both hex; OFFSET is a 7-bit packed address in the kit """
+    offset, size = text.split(':')
+    return roland_sysex.unpack4(bytes.fromhex(offset.zfill(8))), int(size, 16)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='dump file')
+    parser.add_argument('-i', default="TD-50X", help='MIDI connection name')
+    parser.add_argument('-b', default='pygame', choices=list(_MIDI_BACKENDS), help='MIDI backend')
+    parser.add_argument('--kits', default=KIT_COUNT, type=int, help='kits to dump, from kit 1')
+    parser.add_argument('--block', action='append', type=parse_block,
+                        help='OFFSET:SIZE in hex to read per kit, e.g. 0000:1b (repeatable; '
+                        'default: the whole kit)')
+    parser.add_argument('--chunk', default=128, type=int, help='bytes per RQ1')
+    parser.add_argument('--window', default=8, type=int, help='RQ1s in flight')
+    parser.add_argument('--timeout', default=0.1, type=float,
+                        help='seconds to wait for a reply, after the last one')
+    parser.add_argument('--retries', default=0, type=int, help='before a chunk counts as missing')
+    parser.add_argument('--span', default='800', type=lambda x: int(x, 16),
+                        help='addresses, in hex, given up on together once they look unmapped')
+    parser.add_argument('--skip-after', default=2, type=int,
+                        help='missing chunks that mark a span unmapped (0 asks for everything)')
+    parser.add_argument('--retry-missing', action='store_true',
+                        help='ask again for chunks a previous run marked missing')
+    parser.add_argument('--fresh', action='store_true', help='start over instead of resuming')
+    parser.add_argument('--show', type=int, help="print a kit's name from the dump and exit")
+    args = parser.parse_args()
+
+    dump = KitDump(args.path, args.block or [(0, KIT_STEP)], args.kits, args.chunk)
+    if args.show:
+        if not dump.open():
+            print(f"{args.path}: no dump with this layout")
+            return 1
+        name = bytes(dump.kit_data(args.show)[:KIT_NAME_LEN]).decode('ascii', 'replace')
+        print(f"{args.show:03d}:[{name}]")
+        dump.close()
+        return 0
+
+    resumed = dump.open(fresh=args.fresh)
+    midi = _MIDI_BACKENDS[args.b](args.i)
+    midi.verbose = False
+    dumper = Dumper(midi, dump, args.window, args.timeout, args.retries, args.span, args.skip_after)
+    midi.start_input(dumper.on_message)
+    print(f"{'Resuming' if resumed else 'Starting'} {args.path}: {args.kits} kits of "
+          f"{dump.kit_bytes} bytes, {dump.chunk_count()} chunks")
+    try:
+        elapsed = dumper.run(args.retry_missing)
+        print(f"done in {elapsed:.1f} s: {dumper.done} chunks read, {dumper.missing} missing "
+              f"({dumper.skipped} skipped), {dumper.bytes_in} bytes")
+    except KeyboardInterrupt:
+        print("Interrupted; run again to resume")
+    finally:
+        midi.stop_input()
+        dump.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
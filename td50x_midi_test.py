@@ -2,27 +2,56 @@
 from os import environ
 environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"  # Really!?
 
-import sys
+import argparse
+import json
 import os
+import queue
+import random
+import sys
+import threading
 import time
-import pygame.midi
-import mido
+
+from paho.mqtt import client as mqtt_client
+
+import roland_sysex
+from spdsxpro_controller import _MIDI_BACKENDS, NoDeviceException
+
+# Follows the TD-50X's current kit and publishes it for stream overlays.
+#
+# Kit names for all 100 kits are read once at startup into a catalog, so
+# a Program Change is published straight from memory. Each change goes
+# out as a retained MQTT message, to any WebSocket clients (--ws), and to
+# kit.txt, replaced atomically so readers never see half a write.
+#
+#   $ python3 td50x_midi_test.py -a localhost -t td50x/kit --ws 8765
+#   $ python3 td50x_midi_test.py -b sim        # no kit needed
+#
+# The message:
+#   {"kit": 5, "name": "Kit 005", "subname": "...", "t": 1700000000.0}
 
 # https://www.pygame.org/docs/ref/midi.html#pygame.midi.Output.write_sys_ex
 # Current Kit? Addr = 00 00 00 00
 
 
-_MODEL_TD50X = [0, 0, 0, 0, 7]
-_COMMAND_RQ1 = 0x11
 _STATUS_SYSEX = 0xf0
 _STATUS_EOX = 0xf7
 _STATUS_TIMING_CLOCK = 0xf8
 _STATUS_PROGRAM_CHANGE = 0xc9
-_VENDOR_ID_ROLAND = 0x41
 _DEVICE_ID = 0x10
 _TARGET_DEVICE_NAME = "TD-50X"
+_CODEC = roland_sysex.Codec('td50x', _DEVICE_ID)
+
+_KIT_COUNT = 100
+_KIT_OFFSET = 0
+_KIT_NAME_START = 4 << 21
+_KIT_STEP = 2 << 14
+_KIT_NAME_LEN = 12
+_KIT_SUBNAME_LEN = 15
+
+# How often to ask for the current kit, and to give up on a name request.
+_CURRENT_KIT_INTERVAL = 0.5
+_NAME_TIMEOUT = 0.5
 
-last_kit = None
 
 def printSync(s, **kwargs):
     print(s)
@@ -30,178 +59,240 @@ def printSync(s, **kwargs):
     pass
 
 
-def flatten(*args):
-    out = []
-    for a in args:
-        if isinstance(a, list):
-            out.extend(a)
-        else:
-            out.append(a)
-    return out
+def prepare_sysex_msg(addr:int, size:int):
+    """RQ1 for `size` bytes at `addr`"""
+    return _CODEC.encode_rq1(addr, size)
 
 
-def unpack4(arr):
-    n = 0
-    for x in arr:
-        n = (n << 7) + x
-    return n
+def kit_name_addr(kit: int) -> int:
+    return _KIT_NAME_START + (kit - 1) * _KIT_STEP
 
-def pack4(n):
-    out = []
-    for i in range(4):
-        out.append((n >> 21) & 0x7f)
-        n <<= 7
-    return out
 
+def parse_sysex(buf):
+    """ ('kit', kit) for a current kit reply, ('name', kit, name, subname)
+        for a kit name reply, else None. Kits count from 1.
+    """
+    parsed = _CODEC.decode(buf)
+    if parsed is None or parsed[0] != roland_sysex.COMMAND_DT1:
+        return None
+    _, addr, start, end = parsed
+    data = buf[start:end]
 
-def checksum(arr):
-    sum = 0
-    for b in arr:
-        sum += b
-    return 128 - (sum % 128)
+    if addr == _KIT_OFFSET:
+        return 'kit', int(data[0]) + 1
+    if addr >= _KIT_NAME_START and len(data) >= _KIT_NAME_LEN + _KIT_SUBNAME_LEN:
+        kit = (addr - _KIT_NAME_START) // _KIT_STEP
+        name = bytes(b & 0x7f for b in data[0:_KIT_NAME_LEN]).decode(encoding='ascii')
+        sub = bytes(b & 0x7f for b in data[_KIT_NAME_LEN:_KIT_NAME_LEN + _KIT_SUBNAME_LEN])
+        sub = sub.decode(encoding='ascii')
+        return 'name', kit + 1, name.rstrip(' '), sub.rstrip(' ')
+    return None
 
 
-def prepare_sysex_msg(addr:int, size:int):
-    """add the status fields and checksum to the message"""
-    msg = flatten(
-        _STATUS_SYSEX, _VENDOR_ID_ROLAND, _DEVICE_ID, _MODEL_TD50X, _COMMAND_RQ1
-    )
-    payload = []
-    payload.extend(pack4(addr))
-    payload.extend(pack4(size))
-    msg.extend(payload)
-    msg.append(checksum(payload))
-    msg.append(_STATUS_EOX)
-    #printSync(f'msg={[f"{x:02x}" for x in msg]}')
-    return msg
-
-
-def find_devices():
-    """Find the TD-50X devices"""
-    num_midi_devices = pygame.midi.get_count()
-    printSync(f"Found {num_midi_devices} MIDI devices")
-    printSync(f"Searching devices for name=[{_TARGET_DEVICE_NAME}]")
-    input_device_id = None
-    output_device_id = None
-    for m in range(num_midi_devices):
-        device_info = pygame.midi.get_device_info(m)
-        if not device_info:
-            continue
-        iface, dname, is_input, is_output, opened = device_info
-        dname = dname.decode(encoding="ascii")
-        printSync(f"  [{m}] [{dname}] {is_input} {is_output}")
-        if dname == _TARGET_DEVICE_NAME:
-            if is_input == 1:
-                input_device_id = m
-            if is_output == 1:
-                output_device_id = m
-    if input_device_id is None or output_device_id is None:
-        if input_device_id is None:
-            printSync("No input device found")
-        if output_device_id is None:
-            printSync("No output device found")
+def write_kit_file(path: str, kit: int, name: str, sub: str):
+    """ Replace `path` in one step, so a reader sees the old or the new """
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        print(f"{kit:03d}:{name:12}\n{sub}", file=f)
+    os.replace(tmp, path)
+
+
+class KitWebSocketServer:
+    """ Sends each kit message to every connected client, and the latest
+        one to clients as they connect.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.clients = set()
+        self.latest = None
+        self.loop = None
+
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(ready,), name="kit-ws", daemon=True).start()
+        ready.wait()
+
+    def _run(self, ready):
+        import asyncio
+        import websockets
+
+        async def handler(ws):
+            self.clients.add(ws)
+            try:
+                if self.latest:
+                    await ws.send(self.latest)
+                await ws.wait_closed()
+            finally:
+                self.clients.discard(ws)
+
+        async def serve():
+            self.loop = asyncio.get_running_loop()
+            async with websockets.serve(handler, self.host, self.port):
+                printSync(f"WebSocket: serving kit changes on ws://{self.host}:{self.port}")
+                ready.set()
+                await asyncio.Future()
+
+        asyncio.run(serve())
+
+    def publish(self, payload: str):
+        def send():
+            import websockets
+            self.latest = payload
+            websockets.broadcast(self.clients, payload)
+        self.loop.call_soon_threadsafe(send)
+
+
+class KitPublisher:
+    """ Publishes kit changes; repeats are skipped """
+
+    def __init__(self, broker: str, port: int, topic: str, kit_file: str = None,
+                 ws: KitWebSocketServer = None):
+        self.topic = topic
+        self.kit_file = kit_file
+        self.ws = ws
+        self.last = None
+        self.payload = None
+        self.client = None
+        if broker:
+            self.client = mqtt_client.Client(f'td50x-kit-{random.randint(0, 1000)}')
+            self.client.on_connect = self._on_connect
+            # Connects, and reconnects, in the background.
+            self.client.connect_async(broker, port)
+            self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        printSync(f"MQTT: {'Connected' if rc == 0 else f'Failed({rc})'}")
+        if rc == 0 and self.payload:
+            client.publish(self.topic, self.payload, retain=True)
+
+    def publish(self, kit: int, name: str, sub: str):
+        if (kit, name, sub) == self.last:
+            return
+        self.last = (kit, name, sub)
+        self.payload = json.dumps({'kit': kit, 'name': name, 'subname': sub, 't': time.time()})
+        printSync(f"{kit:03d}:[{name:12}][{sub}]")
+        if self.client:
+            self.client.publish(self.topic, self.payload, retain=True)
+        if self.ws:
+            self.ws.publish(self.payload)
+        if self.kit_file:
+            write_kit_file(self.kit_file, kit, name, sub)
+
+    def stop(self):
+        if self.client:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+
+class KitTracker:
+    """ Current kit and the kit name catalog, fed by MIDI input """
+
+    def __init__(self, midi, publisher: KitPublisher):
+        self.midi = midi
+        self.publisher = publisher
+        self.inbox = queue.SimpleQueue()  # from the MIDI input thread
+        self.catalog = {}  # kit => (name, subname)
+        self.kit = None
+        self.to_scan = list(range(1, _KIT_COUNT + 1))
+        self.pending = None  # (kit, time requested) of the name request in flight
+
+    def on_message(self, msg: bytes):
+        self.inbox.put(msg)
+
+    def request(self, msg):
+        self.midi.write_sys_ex(msg)
+
+    def _request_name(self, kit: int):
+        self.pending = (kit, time.time())
+        self.request(prepare_sysex_msg(kit_name_addr(kit), _KIT_NAME_LEN + _KIT_SUBNAME_LEN))
+
+    def _set_kit(self, kit: int):
+        self.kit = kit
+        if kit in self.catalog:
+            self.publisher.publish(kit, *self.catalog[kit])
+        elif self.pending is None or self.pending[0] != kit:
+            # Jump the scan queue; the overlay is waiting on this one.
+            if self.pending:
+                self.to_scan.insert(0, self.pending[0])
+            self._request_name(kit)
+
+    def handle(self, msg: bytes):
+        if msg[0] == _STATUS_PROGRAM_CHANGE:
+            self._set_kit(msg[1] + 1)
+        elif msg[0] == _STATUS_SYSEX:
+            parsed = parse_sysex(msg)
+            if parsed is None:
+                return
+            if parsed[0] == 'kit':
+                if parsed[1] != self.kit:
+                    self._set_kit(parsed[1])
+                return
+            _, kit, name, sub = parsed
+            self.catalog[kit] = (name, sub)
+            if self.pending and self.pending[0] == kit:
+                self.pending = None
+            if kit == self.kit:
+                self.publisher.publish(kit, name, sub)
+
+    def step(self, timeout: float):
+        try:
+            msg = self.inbox.get(timeout=timeout)
+            while True:
+                self.handle(msg)
+                msg = self.inbox.get(block=False)
+        except queue.Empty:
+            pass
+        # One name request in flight at a time, retried if unanswered.
+        if self.pending and time.time() - self.pending[1] > _NAME_TIMEOUT:
+            self._request_name(self.pending[0])
+        while self.pending is None and self.to_scan:
+            kit = self.to_scan.pop(0)
+            if kit not in self.catalog:
+                self._request_name(kit)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', default=_TARGET_DEVICE_NAME, help='MIDI connection name')
+    parser.add_argument('-b', default='pygame', choices=list(_MIDI_BACKENDS), help='MIDI backend')
+    parser.add_argument('-a', default='localhost', help="MQTT broker IP ('' for none)")
+    parser.add_argument('-p', default=1883, type=int, help='MQTT broker port')
+    parser.add_argument('-t', default='td50x/kit', help='MQTT topic')
+    parser.add_argument('--ws', type=int, help='also serve kit changes on this WebSocket port')
+    parser.add_argument('--ws-host', default='127.0.0.1', help='WebSocket address')
+    parser.add_argument('--kit-file', default='kit.txt', help="kit file ('' for none)")
+    args = parser.parse_args()
+
+    midi = _MIDI_BACKENDS[args.b](args.i)
+    midi.verbose = False
+    ws = None
+    if args.ws:
+        ws = KitWebSocketServer(args.ws_host, args.ws)
+        ws.start()
+    publisher = KitPublisher(args.a, args.p, args.t, args.kit_file or None, ws)
+    tracker = KitTracker(midi, publisher)
+    try:
+        midi.start_input(tracker.on_message)
+    except NoDeviceException as ex:
+        printSync(str(ex))
         sys.exit(0)
-    return input_device_id, output_device_id
-
-def parse_sysex(buf) -> int:
-    ok = True
-    ok = ok or buf[0] == 0xf0
-    ok = ok or buf[1] == 0x41
-    dev = buf[2] 
-    ok = ok or buf[3:8] == [0,0,0,0,7]
-    ok = ok or buf[8] == 0x12
-    addr = buf[9:13]
-    data = buf[13:-2]
-    sum = buf[-2]
-    ok = ok or buf[-1] == 0xf7
-    if not ok:
-        return None
-    addr = unpack4(addr)
-    # s = "".join(s[13:-4])
-    # s.decode(encoding="ascii")
-    # printSync(f'{[f"{b:02x}" for b in buf]}')
-
-    kit_offset = 0
-    kit_name_start = 4 << 21
-    kit_step = 2 << 14
-    if addr == kit_offset:
-        kit = int(data[0]) + 1
-        #printSync(f"Current kit: {kit:03d}")
-        return kit
-    if addr > kit_name_start:
-        kit = int((addr - kit_name_start) / kit_step)
-        name = bytes(b & 0x7f for b in data[0:12]).decode(encoding='ascii')
-        sub = bytes(b & 0x7f for b in data[12:12+15]).decode(encoding='ascii')
-        name = name.rstrip(' ')
-        sub = sub.rstrip(' ')
-        #global last_kit
-        #if last_kit is not None and last_kit != kit:
-        #    last_kit = kit
-        printSync(f"{kit+1:03d}:[{name:12}][{sub}]")
-        with open('kit.txt', 'w') as f:
-            print(f"{kit+1:03d}:{name:12}\n{sub}", file=f)
-        return None
-    return None
+
+    t_current_kit = 0
+    try:
+        while True:
+            now = time.time()
+            if now - t_current_kit > _CURRENT_KIT_INTERVAL:
+                t_current_kit = now
+                tracker.request(prepare_sysex_msg(_KIT_OFFSET, 1))
+            tracker.step(0.01)
+    except KeyboardInterrupt:
+        printSync("Keyboard Interrupt. Exiting")
+    finally:
+        midi.stop_input()
+        publisher.stop()
 
 
-# Initialize Midi
-pygame.midi.init()
-
-devices = find_devices()
-printSync(f"Devices found: in=[{devices[0]}], out=[{devices[1]}]")
-midi_input = pygame.midi.Input(devices[0])
-midi_output = pygame.midi.Output(devices[1])
-
-try:
-    pending = None
-    kit_init_index = 1
-    sysex_response_buffer = None
-    sent = False
-
-    t_current_kit = time.time()
-
-    while True:
-        if pending is None and kit_init_index <= 100:
-            #printSync(f"kit_init_index:{kit_init_index}")
-            pending = kit_init_index
-            kit_init_index += 1
-
-        if pending is not None and not sent:
-            #printSync(f"pending:{pending}")
-            kit_addr = (4 << 21) + (pending - 1) * (2 << 14)
-            msg = prepare_sysex_msg(kit_addr, 27)
-            midi_output.write_sys_ex(0, msg)
-            sent = True
-
-        now = time.time()
-        if t_current_kit is None or now - t_current_kit > 0.5:
-            t_current_kit = now
-            msg = prepare_sysex_msg(0, 1)
-            midi_output.write_sys_ex(0, msg)
-
-        for event in pygame.midi.Input.read(midi_input, 16):
-            data, timestamp = event
-            if sysex_response_buffer is not None:
-                sysex_response_buffer.extend(data)
-                if _STATUS_EOX in data:
-                    pending = parse_sysex(sysex_response_buffer)
-                    sysex_response_buffer = None
-                    if pending is not None:
-                        sent = False
-            elif data[0] == _STATUS_SYSEX:
-                sysex_response_buffer = data
-            elif data[0] == _STATUS_TIMING_CLOCK:
-                continue  # clock sync message
-            elif data[0] == _STATUS_PROGRAM_CHANGE:
-                # printSync(f'Kit changed to {data[1]+1:02d}')
-                if pending is None:
-                    pending = data[1] + 1
-            else:
-                #printSync(f'{[f"{d:02x}" for d in data]} {timestamp * 1e-3 : .3f}')
-                pass
-        time.sleep(0.001)
-
-except KeyboardInterrupt:
-    midi_output.close()
-    midi_input.close()
-    printSync("Keyboard Interrupt. Exiting")
+if __name__ == '__main__':
+    main()
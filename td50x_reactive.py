@@ -0,0 +1,332 @@
+# Suppress the hello message from PyGame
+from os import environ
+environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+
+import argparse
+import collections
+import random
+import socket
+import sys
+import threading
+import time
+
+import numpy
+
+from spdsxpro_controller import AbstractMidi, CaptureMidi, NoDeviceException, SpdSxPro, SpdSxProSink
+from wled_realtime import DdpSender, FramePacer, LocalUdpReceiver
+
+# Drum-hit reactive lighting.
+#
+# Note-on events from the TD-50X flash WLED strips and SPD-SX PRO user
+# colors. The hit path runs on the MIDI input thread and does a table
+# lookup plus one UDP send per strip; the decay is played out afterwards,
+# on the strips and the pad's user color, by a render thread from
+# envelopes computed at startup.
+#
+# Example, measure hit-to-send latency (from the hit until the UDP send
+# returns) against local stand-ins:
+#   $ python3 td50x_reactive.py --synthetic 20 --seconds 5
+# Real kit, two strips, and the pad:
+#   $ python3 td50x_reactive.py -s wled-1.local:300 -s wled-2.local:150 --spd
+
+_STATUS_NOTE_ON = 0x90
+_STATUS_MASK = 0xf0
+_TARGET_DEVICE_NAME = "TD-50X"
+
+# TD-50X default note assignments => (color, SPD-SX PRO user color index)
+_PAD_COLORS = {
+    36: ((0xff, 0x00, 0x00), 0),  # kick
+    38: ((0xff, 0xff, 0xff), 1),  # snare head
+    40: ((0xff, 0x80, 0x00), 1),  # snare rim
+    48: ((0x00, 0x00, 0xff), 2),  # tom 1
+    50: ((0x00, 0x00, 0xff), 2),  # tom 1 rim
+    45: ((0x00, 0x80, 0xff), 2),  # tom 2
+    47: ((0x00, 0x80, 0xff), 2),  # tom 2 rim
+    43: ((0x80, 0x00, 0xff), 2),  # tom 3
+    58: ((0x80, 0x00, 0xff), 2),  # tom 3 rim
+    41: ((0xff, 0x00, 0xff), 2),  # tom 4
+    39: ((0xff, 0x00, 0xff), 2),  # tom 4 rim
+    46: ((0xff, 0xff, 0x00), 3),  # hi-hat open
+    42: ((0x80, 0x80, 0x00), 3),  # hi-hat closed
+    44: ((0x40, 0x40, 0x00), 3),  # hi-hat pedal
+    49: ((0x00, 0xff, 0xff), 4),  # crash 1
+    55: ((0x00, 0xff, 0xff), 4),  # crash 1 edge
+    57: ((0x00, 0xff, 0x80), 4),  # crash 2
+    52: ((0x00, 0xff, 0x80), 4),  # crash 2 edge
+    51: ((0x00, 0xff, 0x00), 4),  # ride
+    59: ((0x00, 0xff, 0x00), 4),  # ride edge
+    53: ((0x80, 0xff, 0x80), 4),  # ride bell
+}
+
+
+def printSync(s, **kwargs):
+    print(s)
+    sys.stdout.flush()
+
+
+class PadAction:
+    """ What one note does. `frames[velocity, age]` is the precomputed
+        rgb of the flash `age` frames after a hit at `velocity`.
+    """
+
+    def __init__(self, rgb, user_color_index, envelope):
+        self.user_color_index = user_color_index
+        self.frames = (envelope[:, :, None] *
+                       numpy.array(rgb, dtype=numpy.float32)).astype(numpy.uint8)
+
+
+class Reactor:
+    # Hits whose latency is kept for the report
+    _LATENCY_WINDOW = 10000
+
+    def __init__(self, senders: list, spd_sink=None, fps: float = 60,
+                 decay: float = 0.4, gamma: float = 2.0):
+        self.senders = senders
+        self.spd_sink = spd_sink
+        self.fps = fps
+        self.lock = threading.Lock()
+        self.voices = {}  # note => (velocity, hit time)
+        self.hits = 0
+        # The most recent hits' latencies; percentiles are over these.
+        self.latencies = collections.deque(maxlen=self._LATENCY_WINDOW)
+        self.running = False
+
+        # envelope[velocity, age]: velocity curve times exponential decay,
+        # long enough to fall below one LSB.
+        num_frames = int(fps * decay * 6) + 1
+        ages = numpy.arange(num_frames, dtype=numpy.float32) / fps
+        levels = (numpy.arange(128, dtype=numpy.float32) / 127) ** gamma
+        envelope = levels[:, None] * numpy.exp(-ages / decay)[None, :]
+        self.num_frames = num_frames
+
+        # Fixed-cost dispatch: one list index per note.
+        self.dispatch = [None] * 128
+        for note, (rgb, user_color_index) in _PAD_COLORS.items():
+            self.dispatch[note] = PadAction(rgb, user_color_index, envelope)
+
+    def on_midi(self, data, t_in: float):
+        """ Called on the input thread for each MIDI event.
+            t_in is when the event arrived, on the perf_counter clock.
+        """
+        status, note, velocity = data[0], data[1], data[2]
+        if status & _STATUS_MASK != _STATUS_NOTE_ON or velocity == 0:
+            return
+        action = self.dispatch[note]
+        if action is None:
+            return
+        rgb = action.frames[velocity, 0]
+        with self.lock:
+            self.voices[note] = (velocity, t_in)
+            for sender in self.senders:
+                sender.fill(rgb)
+                sender.send()
+        self.latencies.append(time.perf_counter() - t_in)
+        self.hits += 1
+        if self.spd_sink:
+            self.spd_sink.submit({action.user_color_index: tuple(int(c) for c in rgb)}, t_in)
+
+    def render(self):
+        """ Play out decays on the strips and the SPD-SX PRO user colors.
+            Runs on its own thread at `fps`.
+        """
+        pacer = FramePacer(self.fps)
+        black = numpy.zeros(3, dtype=numpy.uint8)
+        last = None
+        spd_last = {}  # user color index => rgb last submitted, until it's black
+        while self.running:
+            now = time.perf_counter()
+            slots = {}
+            with self.lock:
+                rgb = black
+                for note, (velocity, t_hit) in list(self.voices.items()):
+                    age = int((now - t_hit) * self.fps)
+                    if age >= self.num_frames:
+                        del self.voices[note]
+                        continue
+                    action = self.dispatch[note]
+                    frame = action.frames[velocity, age]
+                    rgb = numpy.maximum(rgb, frame)
+                    i = action.user_color_index
+                    slots[i] = numpy.maximum(slots.get(i, black), frame)
+                if last is None or (rgb != last).any():
+                    for sender in self.senders:
+                        sender.fill(rgb)
+                        sender.send()
+                    last = rgb
+            if self.spd_sink:
+                self._render_spd(slots, spd_last, now)
+            pacer.wait()
+
+    def _render_spd(self, slots: dict, spd_last: dict, now: float):
+        # Slots whose last voice ended go back to black.
+        changed = {}
+        for i in set(slots) | set(spd_last):
+            rgb = tuple(int(c) for c in slots[i]) if i in slots else (0, 0, 0)
+            if spd_last.get(i) != rgb:
+                changed[i] = rgb
+            if any(rgb):
+                spd_last[i] = rgb
+            else:
+                spd_last.pop(i, None)
+        if changed:
+            self.spd_sink.submit(changed, now)
+
+    def start(self):
+        self.running = True
+        self.render_thread = threading.Thread(target=self.render, name="render", daemon=True)
+        self.render_thread.start()
+
+    def stop(self):
+        self.running = False
+        self.render_thread.join()
+
+    def report(self):
+        if not self.latencies:
+            printSync("no hits")
+            return
+        # Until the UDP send returns; the network and WLED come on top.
+        lat = numpy.array(self.latencies) * 1e3
+        printSync(f"hits={self.hits} hit-to-send latency_ms (last {len(lat)}): "
+                  f"p50={numpy.percentile(lat, 50):.3f} "
+                  f"p99={numpy.percentile(lat, 99):.3f} max={lat.max():.3f}")
+        if self.spd_sink:
+            printSync(f"spdsxpro: {self.spd_sink.stats.summary()}")
+
+
+class MidiInputThread:
+    """ Reads the TD-50X and calls `callback(data, t_in)` on this thread """
+
+    # PortMidi has no blocking read, so poll at this interval.
+    _POLL_INTERVAL = 0.0005
+
+    def __init__(self, name: str, callback):
+        import pygame.midi
+        self.midi = pygame.midi
+        self.midi.init()
+        self.input = self.midi.Input(self._find_input(name))
+        self.callback = callback
+        self.running = False
+
+    def _find_input(self, name: str):
+        for idx in range(self.midi.get_count()):
+            _, dname, is_input, _, _ = self.midi.get_device_info(idx)
+            if dname.decode(encoding="ascii") == name and is_input == 1:
+                return idx
+        raise NoDeviceException(f'No input device named "{name}"')
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="midi-in", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.input.close()
+
+    def _run(self):
+        while self.running:
+            if not self.input.poll():
+                time.sleep(self._POLL_INTERVAL)
+                continue
+            now_ms = self.midi.time()
+            now = time.perf_counter()
+            for data, timestamp in self.input.read(64):
+                # Backdate by how long PortMidi held the event.
+                self.callback(data, now - max(0, now_ms - timestamp) * 1e-3)
+
+
+class SyntheticInput:
+    """ Stand-in for the TD-50X: random hits at `rate` per second """
+
+    def __init__(self, rate: float, callback):
+        self.rate = rate
+        self.callback = callback
+        self.notes = sorted(_PAD_COLORS)
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="synthetic-in", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def _run(self):
+        while self.running:
+            time.sleep(random.expovariate(self.rate))
+            note = random.choice(self.notes)
+            velocity = random.randint(1, 127)
+            self.callback([_STATUS_NOTE_ON | 9, note, velocity, 0], time.perf_counter())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', default=_TARGET_DEVICE_NAME, help='MIDI input name')
+    parser.add_argument('-s', dest='strips', action='append', default=[],
+                        help='WLED strip as HOST:NUM_LEDS (repeatable)')
+    parser.add_argument('--spd', action='store_true', help='also flash SPD-SX PRO user colors')
+    parser.add_argument('--spd-name', default="SPD-SX PRO", help='SPD-SX PRO MIDI connection name')
+    parser.add_argument('-d', default=19, type=int, help='SPD-SX PRO MIDI device id')
+    parser.add_argument('--spd-rate', default=200, type=float,
+                        help='max SPD-SX PRO palette writes per second')
+    parser.add_argument('--fps', default=60, type=float, help='decay frame rate')
+    parser.add_argument('--decay', default=0.4, type=float, help='decay time constant (s)')
+    parser.add_argument('--synthetic', default=None, type=float, metavar='RATE',
+                        help='use a synthetic input at RATE hits/s and local stand-in outputs')
+    parser.add_argument('--seconds', default=None, type=float, help='stop after this long')
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    senders = []
+    receivers = []
+    for strip in args.strips or (['local:300', 'local:150'] if args.synthetic else []):
+        host, num_leds = strip.rsplit(':', 1)
+        num_leds = int(num_leds)
+        if args.synthetic:
+            receiver = LocalUdpReceiver(num_leds).start()
+            receivers.append(receiver)
+            senders.append(DdpSender(receiver.addr[0], num_leds, port=receiver.addr[1], sock=sock))
+        else:
+            senders.append(DdpSender(host, num_leds, sock=sock))
+
+    spd_sink = None
+    if args.synthetic:
+        spd_sink = SpdSxProSink(SpdSxPro(CaptureMidi(), device_id=args.d), max_rate=args.spd_rate)
+    elif args.spd:
+        spd_midi = AbstractMidi(args.spd_name)
+        # Reconnecting per command restarts PortMidi, which would close
+        # the TD-50X input MidiInputThread holds open. Keep the output.
+        spd_midi.reconnect_per_command = False
+        spd_sink = SpdSxProSink(SpdSxPro(spd_midi, device_id=args.d), max_rate=args.spd_rate)
+
+    reactor = Reactor(senders, spd_sink, fps=args.fps, decay=args.decay)
+    if args.synthetic:
+        source = SyntheticInput(args.synthetic, reactor.on_midi)
+    else:
+        source = MidiInputThread(args.i, reactor.on_midi)
+
+    if spd_sink:
+        spd_sink.start()
+    reactor.start()
+    source.start()
+    printSync("Reacting to hits. Ctrl-C to stop.")
+    try:
+        t_end = None if args.seconds is None else time.perf_counter() + args.seconds
+        while t_end is None or time.perf_counter() < t_end:
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    source.stop()
+    reactor.stop()
+    if spd_sink:
+        spd_sink.stop()
+    for receiver in receivers:
+        receiver.close()
+    reactor.report()
+
+
+if __name__ == '__main__':
+    main()
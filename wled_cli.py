@@ -0,0 +1,180 @@
+"""Apply JSON state to many WLED nodes at once.
+
+Python replacement for get_json.sh / put_json.sh. Every node gets a
+`wled.WLED` client sharing one aiohttp session, whose connector keeps
+connections alive per host, and requests fan out concurrently with a
+bound on how many are in flight. The default bound, 32, lets a 20-node
+setup go out in a single round. One node failing doesn't stop the
+others; each node's error is reported on its own line.
+
+Examples:
+    $ python3 wled_cli.py -n wled-1.local get
+    $ python3 wled_cli.py -n wled-1.local -n wled-2.local put '{"on":true,"bri":128}'
+    $ python3 wled_cli.py -N nodes.txt batch show.jsonl
+
+A batch file has one JSON object per line:
+    {"t": 0.0, "state": {"on": true, "bri": 255}}
+    {"t": 0.5, "state": {"bri": 64}, "nodes": ["wled-2.local"]}
+`t` is seconds from the start of the batch; `nodes` defaults to all.
+"""
+
+import asyncio
+import json
+import time
+
+import aiohttp
+import click
+from wled import WLED
+
+
+class WledPool:
+    """ Keep-alive clients for a set of WLED nodes """
+
+    def __init__(self, hosts: list, concurrency: int = 32,
+                 per_host: int = 2, timeout: float = 5.0):
+        self.hosts = hosts
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.session = None
+        self.clients = {}
+        self.semaphore = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit_per_host=self.per_host,
+                                         keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.clients = {host: WLED(host, request_timeout=self.timeout, session=self.session)
+                        for host in self.hosts}
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def _request(self, host: str, uri: str, method: str, data: dict = None):
+        async with self.semaphore:
+            then = time.perf_counter()
+            try:
+                # WLED.request adds "v" to state posts, so give each its own copy.
+                result = await self.clients[host].request(
+                    uri, method=method, data=None if data is None else dict(data))
+            except Exception as ex:
+                # Anything, e.g. a host not in the pool, fails just this node
+                return host, time.perf_counter() - then, ex
+            return host, time.perf_counter() - then, result
+
+    async def gather(self, uri: str, method: str = "GET", data: dict = None,
+                     hosts: list = None):
+        """ Returns [(host, seconds, result or exception)] """
+        return await asyncio.gather(*(self._request(host, uri, method, data)
+                                      for host in hosts or self.hosts))
+
+    async def get(self, hosts: list = None):
+        return await self.gather("/json", hosts=hosts)
+
+    async def put_state(self, state: dict, hosts: list = None):
+        return await self.gather("/json/state", method="POST", data=state, hosts=hosts)
+
+
+def _report(results, verbose: bool = False) -> int:
+    """ Print one line per host. Returns how many failed. """
+    failed = 0
+    for host, dt, result in results:
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"{host}: {1e3 * dt:8.1f} ms: error: {type(result).__name__}: {result}")
+        elif verbose:
+            print(f"{host}: {1e3 * dt:8.1f} ms: {json.dumps(result)}")
+        else:
+            print(f"{host}: {1e3 * dt:8.1f} ms: ok")
+    return failed
+
+
+def _load_batch(path: str):
+    steps = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            steps.append(json.loads(line))
+    steps.sort(key=lambda step: step.get('t', 0))
+    return steps
+
+
+async def _run_batch(pool: WledPool, steps: list):
+    t0 = time.perf_counter()
+    for step in steps:
+        delay = t0 + step.get('t', 0) - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        results = await pool.put_state(step['state'], hosts=step.get('nodes'))
+        t = time.perf_counter() - t0
+        print(f"t={t:8.3f}: state={json.dumps(step['state'])}")
+        _report(results)
+
+
+@click.group()
+@click.option('-n', '--node', 'nodes', multiple=True, help='WLED host (repeatable)')
+@click.option('-N', '--nodes-file', type=click.Path(exists=True),
+              help='file of WLED hosts, one per line')
+@click.option('-c', '--concurrency', default=32, help='max requests in flight')
+@click.option('--timeout', default=5.0, help='per-request timeout (s)')
+@click.pass_context
+def main(ctx, nodes, nodes_file, concurrency, timeout):
+    hosts = list(nodes)
+    if nodes_file:
+        with open(nodes_file) as f:
+            hosts.extend(line.strip() for line in f if line.strip())
+    ctx.obj = {'hosts': hosts or ['wled-1.local'],
+               'concurrency': concurrency, 'timeout': timeout}
+
+
+def _pool(ctx):
+    return WledPool(ctx.obj['hosts'], concurrency=ctx.obj['concurrency'],
+                    timeout=ctx.obj['timeout'])
+
+
+@main.command()
+@click.pass_context
+def get(ctx):
+    """ Print each node's full JSON """
+    async def run():
+        async with _pool(ctx) as pool:
+            _report(await pool.get(), verbose=True)
+    asyncio.run(run())
+
+
+@main.command()
+@click.argument('doc', default='{"on":true}')
+@click.pass_context
+def put(ctx, doc):
+    """ Apply one JSON state document to every node """
+    state = json.loads(doc)
+
+    async def run():
+        async with _pool(ctx) as pool:
+            then = time.perf_counter()
+            results = await pool.put_state(state)
+            failed = _report(results)
+            print(f"{len(results)} nodes in {1e3 * (time.perf_counter() - then):.1f} ms, "
+                  f"{failed} failed")
+    asyncio.run(run())
+
+
+@main.command()
+@click.argument('path', type=click.Path(exists=True))
+@click.pass_context
+def batch(ctx, path):
+    """ Play a file of timed state changes """
+    steps = _load_batch(path)
+
+    async def run():
+        async with _pool(ctx) as pool:
+            await _run_batch(pool, steps)
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
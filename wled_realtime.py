@@ -0,0 +1,252 @@
+"""Stream full LED frames to WLED over its UDP realtime protocols.
+
+DDP (UDP 4048) carries up to 480 RGB pixels per packet, with a byte offset
+so big strips go out as several packets and the last one sets PUSH.
+WLED's own realtime port (UDP 21324) takes DRGB for strips up to 490 LEDs
+and DNRGB (with a start index) for anything larger.
+
+Each sender owns one preallocated `frame` bytearray (RGB, 3 bytes per LED)
+and prebuilt packet headers. Write pixels into `frame`, then call `send()`;
+packets go out with sendmsg() straight from slices of `frame`, so nothing
+is allocated or copied per frame.
+
+Example, two strips at 60 FPS against local stand-in receivers:
+    $ python3 wled_realtime.py --loopback -s a:300 -s b:1200 --fps 60
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+import numpy
+
+DDP_PORT = 4048
+REALTIME_PORT = 21324
+
+
+class _UdpFrameSender:
+    def __init__(self, host: str, port: int, num_leds: int, sock=None):
+        if num_leds < 1:
+            raise ValueError(f"a strip needs at least one LED, not {num_leds}")
+        self.addr = (host, port)
+        self.num_leds = num_leds
+        self.frame = bytearray(3 * num_leds)
+        self.sock = sock or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.packets = []  # [header, frame slice] per packet
+        self.frames_sent = 0
+
+    def pixels(self):
+        """ (num_leds, 3) uint8 NumPy view onto `frame` """
+        return numpy.frombuffer(self.frame, dtype=numpy.uint8).reshape(-1, 3)
+
+    def fill(self, rgb: tuple[int, int, int]):
+        self.pixels()[:] = rgb
+
+    def _before_send(self):
+        pass
+
+    def send(self):
+        self._before_send()
+        for buffers in self.packets:
+            self.sock.sendmsg(buffers, (), 0, self.addr)
+        self.frames_sent += 1
+
+
+class DdpSender (_UdpFrameSender):
+    """ Distributed Display Protocol: http://www.3waylabs.com/ddp/ """
+
+    _VER1 = 0x40
+    _PUSH = 0x01
+    _TYPE_RGB8 = 0x0b
+    _DEST_DISPLAY = 0x01
+    # 480 RGB pixels keeps each datagram inside a 1500 byte MTU.
+    _MAX_DATA = 1440
+
+    def __init__(self, host: str, num_leds: int, port: int = DDP_PORT, sock=None):
+        super().__init__(host, port, num_leds, sock)
+        view = memoryview(self.frame)
+        for offset in range(0, len(self.frame), self._MAX_DATA):
+            length = min(self._MAX_DATA, len(self.frame) - offset)
+            header = bytearray(10)
+            header[0] = self._VER1
+            header[2] = self._TYPE_RGB8
+            header[3] = self._DEST_DISPLAY
+            header[4:8] = offset.to_bytes(4, 'big')
+            header[8:10] = length.to_bytes(2, 'big')
+            self.packets.append([header, view[offset:offset + length]])
+        self.packets[-1][0][0] |= self._PUSH
+        self.seq = 0
+
+    def _before_send(self):
+        # 4 bit sequence number, 0 means "unused", so cycle through 1..15.
+        self.seq = self.seq % 15 + 1
+        for header, _ in self.packets:
+            header[1] = self.seq
+
+
+class DrgbSender (_UdpFrameSender):
+    """ WLED realtime UDP: DRGB for up to 490 LEDs, else DNRGB chunks """
+
+    _PROTOCOL_DRGB = 2
+    _PROTOCOL_DNRGB = 4
+    _DRGB_MAX_LEDS = 490
+    _DNRGB_MAX_LEDS = 489
+
+    def __init__(self, host: str, num_leds: int, port: int = REALTIME_PORT,
+                 timeout: int = 2, sock=None):
+        """ `timeout`: seconds WLED holds the last frame before resuming
+            its normal effect; 255 holds forever.
+        """
+        super().__init__(host, port, num_leds, sock)
+        view = memoryview(self.frame)
+        if num_leds <= self._DRGB_MAX_LEDS:
+            header = bytearray([self._PROTOCOL_DRGB, timeout])
+            self.packets.append([header, view])
+            return
+        for start in range(0, num_leds, self._DNRGB_MAX_LEDS):
+            count = min(self._DNRGB_MAX_LEDS, num_leds - start)
+            header = bytearray([self._PROTOCOL_DNRGB, timeout,
+                                start >> 8, start & 0xff])
+            self.packets.append([header, view[3 * start:3 * (start + count)]])
+
+
+class FramePacer:
+    """ Drift-free frame clock. Deadlines are t0 + n * period, so sleep
+        error doesn't accumulate. If we fall more than a frame behind,
+        skip ahead rather than bursting to catch up.
+    """
+
+    def __init__(self, fps: float):
+        self.period = 1. / fps
+        self.t0 = time.perf_counter()
+        self.n = 0
+        self.skipped = 0
+
+    def wait(self):
+        self.n += 1
+        deadline = self.t0 + self.n * self.period
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -self.period:
+            behind = int(-delay / self.period)
+            self.n += behind
+            self.skipped += behind
+
+
+class LocalUdpReceiver:
+    """ Stand-in for a WLED node. Binds a local port and reassembles
+        DDP or DRGB/DNRGB frames into `frame`, counting complete frames.
+    """
+
+    def __init__(self, num_leds: int, host: str = '127.0.0.1', port: int = 0):
+        self.frame = bytearray(3 * num_leds)
+        self.frames = 0
+        self.packets = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.addr = self.sock.getsockname()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name=f"udp-receiver-{self.addr[1]}")
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.sock.close()
+
+    def _run(self):
+        buf = bytearray(2048)
+        while True:
+            try:
+                n = self.sock.recv_into(buf)
+            except OSError:
+                return  # closed
+            self.packets += 1
+            self._on_packet(memoryview(buf)[:n])
+
+    def _on_packet(self, pkt):
+        if pkt[0] & 0xc0 == DdpSender._VER1:
+            offset = int.from_bytes(pkt[4:8], 'big')
+            length = int.from_bytes(pkt[8:10], 'big')
+            self.frame[offset:offset + length] = pkt[10:10 + length]
+            if pkt[0] & DdpSender._PUSH:
+                self.frames += 1
+        elif pkt[0] == DrgbSender._PROTOCOL_DRGB:
+            self.frame[0:len(pkt) - 2] = pkt[2:]
+            self.frames += 1
+        elif pkt[0] == DrgbSender._PROTOCOL_DNRGB:
+            start = 3 * ((pkt[2] << 8) | pkt[3])
+            data = pkt[4:]
+            self.frame[start:start + len(data)] = data
+            if start + len(data) >= len(self.frame):
+                self.frames += 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', dest='strips', action='append', default=[],
+                        help='strip as HOST:NUM_LEDS (repeatable)')
+    parser.add_argument('--protocol', choices=['ddp', 'drgb'], default='ddp')
+    parser.add_argument('--fps', type=float, default=60)
+    parser.add_argument('--seconds', type=float, default=None,
+                        help='stop after this long')
+    parser.add_argument('--loopback', action='store_true',
+                        help='send to local stand-in receivers instead of HOSTs')
+    args = parser.parse_args()
+    strips = args.strips or ['wled-1.local:300']
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    senders = []
+    receivers = []
+    for strip in strips:
+        host, num_leds = strip.rsplit(':', 1)
+        num_leds = int(num_leds)
+        if num_leds < 1:
+            parser.error(f"{strip}: a strip needs at least one LED")
+        port = DDP_PORT if args.protocol == 'ddp' else REALTIME_PORT
+        if args.loopback:
+            receiver = LocalUdpReceiver(num_leds).start()
+            receivers.append(receiver)
+            host, port = receiver.addr
+        if args.protocol == 'ddp':
+            senders.append(DdpSender(host, num_leds, port=port, sock=sock))
+        else:
+            senders.append(DrgbSender(host, num_leds, port=port, sock=sock))
+
+    # Moving rainbow. Hue per LED is fixed; only the phase changes.
+    phases = [numpy.linspace(0, 1, s.num_leds, endpoint=False) for s in senders]
+    channel_offsets = numpy.array([0., 1. / 3, 2. / 3])
+
+    pacer = FramePacer(args.fps)
+    t_start = time.perf_counter()
+    t_report = t_start + 1
+    frames_at_report = 0
+    try:
+        while args.seconds is None or time.perf_counter() - t_start < args.seconds:
+            shift = pacer.n * pacer.period * 0.25
+            for sender, phase in zip(senders, phases):
+                wave = numpy.cos(2 * numpy.pi * (phase[:, None] + shift + channel_offsets))
+                sender.pixels()[:] = (wave * 127.5 + 127.5).astype(numpy.uint8)
+                sender.send()
+            pacer.wait()
+            now = time.perf_counter()
+            if now >= t_report:
+                frames = senders[0].frames_sent
+                line = f'fps={frames - frames_at_report:4d} skipped={pacer.skipped}'
+                if receivers:
+                    line += ' received=' + ','.join(str(r.frames) for r in receivers)
+                print(line)
+                frames_at_report = frames
+                t_report += 1
+    except KeyboardInterrupt:
+        pass
+    for receiver in receivers:
+        receiver.close()
+
+
+if __name__ == '__main__':
+    main()